@@ -1,3 +1,4 @@
+from typing import Optional
 from enum import Enum
 import datetime
 import os
@@ -10,21 +11,123 @@ from .errors import ConfigError
 CONFIG = None
 
 IP_INFO_EXPIRY = datetime.timedelta(days=7)
+
+# Expired IP info are still used for this long, while
+# they are refreshed in background.
+IP_INFO_MAX_STALENESS = datetime.timedelta(days=1)
+
+# IP info that are about to expire are refreshed in
+# background if they are used at least N times within
+# this time before the expiry.
+IP_INFO_REFRESH_AHEAD = datetime.timedelta(hours=12)
+IP_INFO_REFRESH_AHEAD_MIN_HITS = 3
+
+IP_INFO_REFRESH_MAX_CONCURRENT = 4
+IP_INFO_REFRESH_RETRY_INTERVAL = 5 * 60  # seconds
 TRACEROUTE_EXPIRY = datetime.timedelta(days=7)
 
 DNS_QUERY_TIMEOUT = 5
+DNS_QUERY_RETRY_INTERVAL = 1  # seconds
 DNS_CACHE_TTL = 30 * 60  # seconds
+DNS_NEGATIVE_CACHE_TTL = 5 * 60  # seconds
+
+# Per enricher: the pool that runs the queries is shared by
+# all the enrichers of the process, and it's sized accordingly.
+RIPESTAT_MAX_CONCURRENT_QUERIES = 8
+
+# Timeouts of RIPEstat queries; when the query is performed
+# to enrich a traceroute, they are reduced to fit in what's
+# left of MAX_ENRICHMENT_TIME, down to RIPESTAT_MIN_TIMEOUT.
+RIPESTAT_CONNECT_TIMEOUT = 3.05  # seconds
+RIPESTAT_READ_TIMEOUT = 10  # seconds
+RIPESTAT_MIN_TIMEOUT = 1  # seconds
+RIPESTAT_MAX_RETRIES = 2
+RIPESTAT_RETRY_BACKOFF = 0.5  # seconds, doubled at every retry
+
+# Max rate of the RIPEstat queries of each worker process. It's
+# lowered when RIPEstat throttles the queries (HTTP 429).
+RIPESTAT_RATE_LIMIT = 10  # queries per second
+RIPESTAT_RATE_LIMIT_BURST = 20
+RIPESTAT_RATE_LIMIT_MIN = 1  # queries per second
+
+# After these many consecutive failures RIPEstat is not queried
+# for a while: traceroutes are enriched using the IP info that
+# are already known, and the missing ones are backfilled later.
+RIPESTAT_CIRCUIT_BREAKER_THRESHOLD = 5
+RIPESTAT_CIRCUIT_BREAKER_RESET_TIMEOUT = 30  # seconds
+
+IP_INFO_BACKFILL_INTERVAL = 60  # seconds
+IP_INFO_BACKFILL_MAX_PENDING = 10000
+# N. of passes after which an IP whose info can't be fetched
+# because of transient failures is not backfilled anymore.
+IP_INFO_BACKFILL_MAX_ATTEMPTS = 5
+
+# IP info dispatched to the other workers are sent in
+# batches: a batch is published as soon as it's full (n. of
+# entries or size of the message, in bytes) or when its
+# oldest entry has been waiting for MAX_LINGER seconds.
+IPINFO_BATCH_MAX_ENTRIES = 500
+IPINFO_BATCH_MAX_SIZE = 64 * 1024
+IPINFO_BATCH_MAX_LINGER = 0.5  # seconds
+
+# Default n. of hosts of the same traceroute that
+# an enricher resolves (DNS lookups) in parallel; their
+# IP info are then fetched by the shared RIPEstat pool.
+DEFAULT_HOST_CONCURRENCY = 4
 
 MAX_ENRICHMENT_TIME = datetime.timedelta(minutes=2)
 
+# Jobs that a worker can't decode because they were sent by a more
+# recent version are sent back to the queue after this delay, until
+# the job would be expired anyway.
+ENRICHMENT_JOBS_RETRY_DELAY = 10  # seconds
+ENRICHMENT_JOBS_MAX_RETRIES = int(
+    MAX_ENRICHMENT_TIME.total_seconds() / ENRICHMENT_JOBS_RETRY_DELAY
+)
+
+RENDERED_TRACEROUTES_CACHE_SIZE = 1024
+RENDERED_TRACEROUTES_CACHE_TTL = 10 * 60  # seconds
+# Enriched traceroutes that may still be updated by the
+# IP info backfiller are cached for a shorter time.
+RENDERED_TRACEROUTES_PENDING_CACHE_TTL = 30  # seconds
+
+LAST_SEEN_FLUSH_INTERVAL = 30  # seconds
+LAST_SEEN_BUFFER_SIZE = 10000
+
 SOCKET_IO_DATA_EVENT = "traceroute_host_enriched"
+SOCKET_IO_DATA_BATCH_EVENT = "traceroute_hosts_enriched"
 SOCKET_IO_ERROR_EVENT = "traceroute_host_enrichment_error"
 SOCKET_IO_ENRICHMENT_COMPLETED_EVENT = "traceroute_enrichment_completed"
 
+# Host events of the same traceroute are sent in batches
+# (see enrichers/socketio_emitter.py).
+SOCKET_IO_HOST_EVENTS_MAX_LINGER = 0.2  # seconds
+SOCKET_IO_HOST_EVENTS_MAX_BATCH = 100
+SOCKET_IO_EMITTER_QUEUE_SIZE = 10000
+
 IXP_NETWORKS_UPDATE_INTERVAL = 3 * 60 * 60  # 3 hours
 
+# Between full syncs, only the PeeringDB objects that changed
+# are retrieved. Full syncs rewrite all the IXP prefixes, so
+# this must be shorter than IP_INFO_EXPIRY.
+IXP_NETWORKS_FULL_SYNC_INTERVAL = 24 * 60 * 60  # 24 hours
+
 HOUSEKEEPER_INTERVAL = 6 * 60 * 60  # 6 hours
 
+IP_INFO_SNAPSHOT_INTERVAL = 15 * 60  # seconds
+
+IP_INFO_SWEEP_INTERVAL = 10 * 60  # seconds
+IP_INFO_SWEEP_BATCH_SIZE = 1000
+
+IP_INFO_LOAD_BATCH_SIZE = 1000
+
+
+# Encoding of the messages sent over RabbitMQ (see
+# enrichers/codecs.py). Messages are always decoded on the
+# basis of their content type, whatever the setting is.
+WIRE_FORMATS = ("json", "msgpack")
+DEFAULT_WIRE_FORMAT = "json"
+
 
 class ConfigMode(Enum):
 
@@ -136,6 +239,15 @@ def load_config(config_file_path: str = None):
 
             params["port"] = int(params["port"])
 
+    wire_format = params.get("wire_format", DEFAULT_WIRE_FORMAT)
+    if wire_format not in WIRE_FORMATS:
+        raise ConfigError(
+            "RabbitMQ configuration error, 'wire_format' must be one of " +
+            ", ".join(WIRE_FORMATS)
+        )
+
+    params["wire_format"] = wire_format
+
     # Workers
     # ----------------------
 
@@ -161,6 +273,20 @@ def load_config(config_file_path: str = None):
 
             CONFIG["workers"][param] = val
 
+    val = CONFIG["workers"].get("host_concurrency", DEFAULT_HOST_CONCURRENCY)
+    if not isinstance(val, int):
+        if not str(val).isdigit():
+            raise ConfigError("Workers configuration error: "
+                              "'workers.host_concurrency' must be an integer")
+
+        val = int(val)
+
+    if val < 1:
+        raise ConfigError("Workers configuration error: "
+                          "'workers.host_concurrency' must be >= 1")
+
+    CONFIG["workers"]["host_concurrency"] = val
+
     # Web
     # ----------------------
 
@@ -206,6 +332,23 @@ def get_rabbitmq_url():
     )
 
 
+def get_wire_format() -> str:
+    return load_config()["rabbitmq"]["wire_format"]
+
+
+def get_total_enrichers() -> int:
+    cfg = load_config()["workers"]
+    return cfg["consumers"] * cfg["enrichers"]
+
+
+def get_host_concurrency() -> int:
+    return load_config()["workers"]["host_concurrency"]
+
+
+def get_ip_info_snapshot_path() -> Optional[str]:
+    return load_config()["workers"].get("ip_info_snapshot_path", None)
+
+
 def get_flask_secret_key():
     load_config()
     return CONFIG["web"]["flask"]["secret_key"]
@@ -4,10 +4,13 @@ import logging
 
 import pika
 
+from .codecs import EncodedMessage, VERSION_HEADER
 from .constants import (
     ENRICHMENT_JOBS_QUEUE_NAME,
+    ENRICHMENT_JOBS_RETRY_QUEUE_NAME,
     IP_INFO_DATA_EXCHANGE_NAME
 )
+from ..config import ENRICHMENT_JOBS_RETRY_DELAY, IPINFO_BATCH_MAX_LINGER
 
 
 LOGGER = logging.getLogger(__name__)
@@ -45,6 +48,7 @@ class AsyncChannel:
         close_connection: Callable,
         on_message: Optional[Callable] = None,
         get_message_to_publish: Optional[Callable] = None,
+        prefetch_count: Optional[int] = None,
         # on_start_consuming: Optional[Callable] = None
     ):
         # if on_start_consuming and not on_message:
@@ -60,6 +64,9 @@ class AsyncChannel:
         self.close_connection = close_connection
         # self.on_start_consuming = on_start_consuming
 
+        if prefetch_count:
+            self.PREFETCH_COUNT = prefetch_count
+
         self.channel: pika.channel.Channel = None
 
         self._processing = False
@@ -225,37 +232,62 @@ class AsyncChannel:
             #     self.on_start_consuming()
 
         if self.get_message_to_publish:
+            # Messages enqueued before the channel was ready.
+            self.publish_pending_messages()
+
             self.connection.ioloop.call_later(
                 self.PUBLISH_INTERVAL,
-                self._on_ready_to_publish_message
+                self._on_publish_timer
             )
 
         LOGGER.debug(f"{self.name} - _start_processing done")
 
     @log_exception
-    def _on_ready_to_publish_message(self):
+    def publish_pending_messages(self):
+        # Must be called from the connection's ioloop: other threads
+        # can use request_publish to get it scheduled there.
         if self.channel is None or not self.channel.is_open:
-            LOGGER.debug(f"{self.name} - _on_ready_to_publish_message aborted: channel is closed")
+            LOGGER.debug(f"{self.name} - publish_pending_messages aborted: channel is closed")
             return
 
-        msg = self.get_message_to_publish()
+        msg: Optional[EncodedMessage] = self.get_message_to_publish()
 
         while msg:
             LOGGER.debug(f"{self.name} - publishing message")
             self.channel.basic_publish(
                 exchange=self.EXCHANGE_NAME,
                 routing_key=self.QUEUE_NAME,
-                body=msg,
+                body=msg.body,
                 properties=pika.BasicProperties(
+                    content_type=msg.content_type,
+                    headers={VERSION_HEADER: msg.version},
                     expiration='120000',
                 )
             )
 
             msg = self.get_message_to_publish()
 
+    def request_publish(self):
+        # Thread-safe: the messages are published by the ioloop
+        # as soon as it processes the callback.
+        self.connection.ioloop.add_callback_threadsafe(
+            self.publish_pending_messages
+        )
+
+    @log_exception
+    def _on_publish_timer(self):
+        # Publishing is triggered by request_publish; this is
+        # only a fallback, and it makes messages that are not
+        # ready yet (e.g. batches) be published eventually.
+        if self.channel is None or not self.channel.is_open:
+            LOGGER.debug(f"{self.name} - _on_publish_timer aborted: channel is closed")
+            return
+
+        self.publish_pending_messages()
+
         self.connection.ioloop.call_later(
             self.PUBLISH_INTERVAL,
-            self._on_ready_to_publish_message
+            self._on_publish_timer
         )
 
     @log_exception
@@ -313,6 +345,38 @@ class EnrichmentJobsChannel(AsyncChannel):
 
     PREFETCH_COUNT = 1
 
+    # Jobs that can't be processed yet are published to the retry
+    # queue, which has no consumers: when they expire, they are
+    # dead-lettered back to the jobs queue.
+    RETRY_QUEUE_ATTRIBUTES = {
+        "passive": False,
+        "durable": False,
+        "exclusive": False,
+        "auto_delete": False,
+        "arguments": {
+            "x-message-ttl": ENRICHMENT_JOBS_RETRY_DELAY * 1000,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": ENRICHMENT_JOBS_QUEUE_NAME
+        }
+    }
+
+    def _setup_queue(self):
+        LOGGER.debug(f"{self.name} - Declaring queue '{ENRICHMENT_JOBS_RETRY_QUEUE_NAME}'")
+
+        self.channel.queue_declare(
+            queue=ENRICHMENT_JOBS_RETRY_QUEUE_NAME,
+            callback=self._on_retry_queue_declare_ok,
+            **self.RETRY_QUEUE_ATTRIBUTES,
+        )
+
+    @log_exception
+    def _on_retry_queue_declare_ok(self, _unused_frame):
+        LOGGER.debug(f"{self.name} - _on_retry_queue_declare_ok")
+
+        super()._setup_queue()
+
+        LOGGER.debug(f"{self.name} - _on_retry_queue_declare_ok done")
+
 
 class IPDBInfoChannel(AsyncChannel):
 
@@ -327,6 +391,9 @@ class IPDBInfoChannel(AsyncChannel):
 
     PREFETCH_COUNT = 10
 
+    # Batches that are not full are published by the timer.
+    PUBLISH_INTERVAL = IPINFO_BATCH_MAX_LINGER
+
 
 class TracerouteDispatcherChannel(AsyncChannel):
 
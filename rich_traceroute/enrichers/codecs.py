@@ -0,0 +1,253 @@
+"""Encoding of the messages exchanged over RabbitMQ.
+
+Each codec is identified by the content type of the messages it
+produces, and it has a version, sent in the 'version' header: the
+receiver picks the codec on the basis of them, so that workers
+that use different codecs (or versions) can talk to each other,
+for example during a rolling deploy.
+
+Messages without a content type are the ones sent by workers that
+predate codecs: they are JSON. Messages with a content type (or a
+version) that's not known are supposed to be sent by workers that
+are more recent than the receiver.
+"""
+from typing import Dict, List, NamedTuple, Optional, Union
+from abc import ABC, abstractmethod
+import ipaddress
+import json
+import struct
+
+import msgpack
+
+from ..errors import MessageDecodeError, UnsupportedMessageError, UnsupportedMessageVersionError
+from ..structures import EnricherJob, EnricherJob_Host, IPDBInfo, IXPNetwork
+
+
+VERSION_HEADER = "version"
+
+
+class EncodedMessage(NamedTuple):
+
+    body: bytes
+    content_type: str
+    version: int
+
+
+class Codec(ABC):
+
+    @property
+    @classmethod
+    @abstractmethod
+    def NAME(cls) -> str:
+        """Name used to select the codec in the configuration."""
+        ...
+
+    @property
+    @classmethod
+    @abstractmethod
+    def CONTENT_TYPE(cls) -> str:
+        """Content type of the messages encoded by the codec."""
+        ...
+
+    @property
+    @classmethod
+    @abstractmethod
+    def VERSION(cls) -> int:
+        """Version of the format, sent in the VERSION_HEADER header."""
+        ...
+
+    def message(self, body: bytes) -> EncodedMessage:
+        return EncodedMessage(body, self.CONTENT_TYPE, self.VERSION)
+
+    @abstractmethod
+    def encode_job(self, job: EnricherJob) -> bytes:
+        ...
+
+    @abstractmethod
+    def decode_job(self, body: bytes) -> EnricherJob:
+        ...
+
+    @abstractmethod
+    def encode_ip_info(self, ip_info: IPDBInfo) -> bytes:
+        """Encode one entry of a batch of IP info."""
+        ...
+
+    @abstractmethod
+    def join_ip_infos(self, entries: List[bytes]) -> bytes:
+        """Build the batch out of the entries from encode_ip_info."""
+        ...
+
+    @abstractmethod
+    def decode_ip_infos(self, body: bytes) -> List[IPDBInfo]:
+        ...
+
+
+class JSONCodec(Codec):
+
+    NAME = "json"
+    CONTENT_TYPE = "application/json"
+    VERSION = 1
+
+    def encode_job(self, job: EnricherJob) -> bytes:
+        return json.dumps(job.to_json_dict()).encode()
+
+    def decode_job(self, body: bytes) -> EnricherJob:
+        try:
+            return EnricherJob.from_dict(json.loads(body))
+        except (ValueError, TypeError, KeyError, AssertionError) as e:
+            raise MessageDecodeError(f"Invalid job: {e}") from e
+
+    def encode_ip_info(self, ip_info: IPDBInfo) -> bytes:
+        return json.dumps(
+            ip_info.to_compact_list(), separators=(",", ":")
+        ).encode()
+
+    def join_ip_infos(self, entries: List[bytes]) -> bytes:
+        return b"[" + b",".join(entries) + b"]"
+
+    def decode_ip_infos(self, body: bytes) -> List[IPDBInfo]:
+        try:
+            data = json.loads(body)
+
+            # Messages with a single entry in the dict format are
+            # sent by workers that predate batches.
+            if isinstance(data, dict):
+                return [IPDBInfo.from_dict(data)]
+
+            return [IPDBInfo.from_compact_list(entry) for entry in data]
+        except (ValueError, TypeError, KeyError, AssertionError) as e:
+            raise MessageDecodeError(f"Invalid IP info batch: {e}") from e
+
+
+def _id_to_wire(value: str) -> Union[str, bytes]:
+    # IDs are SHA1 hex digests: they are sent as raw bytes,
+    # half of the size.
+    if len(value) == 40:
+        try:
+            return bytes.fromhex(value)
+        except ValueError:
+            pass
+
+    return value
+
+
+def _id_from_wire(value: Union[str, bytes]) -> str:
+    if isinstance(value, bytes):
+        return value.hex()
+
+    return value
+
+
+def _msgpack_array_header(n: int) -> bytes:
+    if n < 16:
+        return struct.pack("!B", 0x90 | n)
+    if n < 2 ** 16:
+        return struct.pack("!BH", 0xdc, n)
+    return struct.pack("!BI", 0xdd, n)
+
+
+class MsgpackCodec(Codec):
+    """msgpack, with positional fields.
+
+    Job: [traceroute_id, [[hop_n, host_id, host], ...]]
+    IP info: [network address (packed), prefix length,
+              [[asn, holder], ...] or nil,
+              [lan_name, ix_name, ix_description] or nil]
+
+    Values are not validated when decoded, beyond what is
+    needed to build the objects.
+    """
+
+    NAME = "msgpack"
+    CONTENT_TYPE = "application/x-msgpack"
+    VERSION = 1
+
+    def encode_job(self, job: EnricherJob) -> bytes:
+        return msgpack.packb([
+            _id_to_wire(job.traceroute_id),
+            [
+                [host.hop_n, _id_to_wire(host.host_id), host.host]
+                for host in job.hosts
+            ]
+        ])
+
+    def decode_job(self, body: bytes) -> EnricherJob:
+        try:
+            traceroute_id, hosts = msgpack.unpackb(body)
+
+            return EnricherJob(
+                traceroute_id=_id_from_wire(traceroute_id),
+                hosts=[
+                    EnricherJob_Host(hop_n, _id_from_wire(host_id), host)
+                    for hop_n, host_id, host in hosts
+                ]
+            )
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise MessageDecodeError(f"Invalid job: {e}") from e
+
+    def encode_ip_info(self, ip_info: IPDBInfo) -> bytes:
+        return msgpack.packb([
+            ip_info.prefix.network_address.packed,
+            ip_info.prefix.prefixlen,
+            ip_info.origins or None,
+            list(ip_info.ixp_network) if ip_info.ixp_network else None
+        ])
+
+    def join_ip_infos(self, entries: List[bytes]) -> bytes:
+        # The entries are already encoded: the batch
+        # is just an array made of them.
+        return _msgpack_array_header(len(entries)) + b"".join(entries)
+
+    def decode_ip_infos(self, body: bytes) -> List[IPDBInfo]:
+        try:
+            return [
+                IPDBInfo(
+                    prefix=ipaddress.ip_network((address, prefixlen)),
+                    origins=[
+                        (asn, holder) for asn, holder in origins
+                    ] if origins else None,
+                    ixp_network=IXPNetwork(*ixp_network) if ixp_network else None
+                )
+                for address, prefixlen, origins, ixp_network in msgpack.unpackb(body)
+            ]
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise MessageDecodeError(f"Invalid IP info batch: {e}") from e
+
+
+CODECS: Dict[str, Codec] = {
+    JSONCodec.CONTENT_TYPE: JSONCodec(),
+    MsgpackCodec.CONTENT_TYPE: MsgpackCodec()
+}
+
+
+def get_codec(name: str) -> Codec:
+    for codec in CODECS.values():
+        if codec.NAME == name:
+            return codec
+
+    raise ValueError(f"Codec not available: {name}")
+
+
+def get_message_codec(properties) -> Codec:
+    """Return the codec of a message, on the basis of its properties."""
+
+    content_type: Optional[str] = getattr(properties, "content_type", None)
+
+    if not content_type:
+        return CODECS[JSONCodec.CONTENT_TYPE]
+
+    codec = CODECS.get(content_type)
+
+    if not codec:
+        raise UnsupportedMessageError(f"Unsupported content type: {content_type}")
+
+    headers = getattr(properties, "headers", None) or {}
+    version = headers.get(VERSION_HEADER, 1)
+
+    if version > codec.VERSION:
+        raise UnsupportedMessageVersionError(
+            f"Unsupported version of {content_type}: {version}, "
+            f"max supported is {codec.VERSION}"
+        )
+
+    return codec
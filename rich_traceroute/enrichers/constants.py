@@ -1,3 +1,5 @@
 ENRICHMENT_JOBS_QUEUE_NAME = "enrichers"
+ENRICHMENT_JOBS_RETRY_QUEUE_NAME = "enrichers_retry"
+ENRICHMENT_JOBS_RETRIES_HEADER = "retries"
 IP_INFO_DATA_EXCHANGE_NAME = "ip_info"
 IP_INFO_DATA_QUEUE_NAME = "ip_info"
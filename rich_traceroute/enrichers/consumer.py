@@ -1,18 +1,25 @@
 from __future__ import annotations
 from typing import List
-import json
 import threading
 import queue
 import logging
 import functools
 
+import markus
+import pika
 
 from .enricher import Enricher
+from .ip_info_store import ip_info_store, load_ip_info_store_snapshot
 from .async_connection import AsyncConnection, Reconnector
 from .async_channel import EnrichmentJobsChannel, IPDBInfoChannel
-from ..structures import IPDBInfo, EnricherJob
+from .codecs import get_message_codec
+from .constants import ENRICHMENT_JOBS_RETRIES_HEADER, ENRICHMENT_JOBS_RETRY_QUEUE_NAME
+from ..errors import MessageDecodeError, UnsupportedMessageError
+from ..config import ENRICHMENT_JOBS_MAX_RETRIES, get_ip_info_snapshot_path
+from ..metrics import get_tags
 
 LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics(__name__)
 
 
 def log_exception(function):
@@ -41,7 +48,10 @@ class ConsumerAsyncConnection(AsyncConnection):
             name="enrichment_jobs_channel",
             connection=self.connection,
             close_connection=self.close_connection,
-            on_message=self.consumer.receive_traceroute_enrichment_job
+            on_message=self.consumer.receive_traceroute_enrichment_job,
+            # One job for each enricher: the broker doesn't send
+            # more jobs than those the enrichers can process.
+            prefetch_count=len(self.consumer.enrichers)
         )
         self._channels.append(enrichment_jobs_channel)
 
@@ -94,38 +104,134 @@ class ConsumerThread(threading.Thread):
 
     @log_exception
     def receive_ip_info_data(self, ch, method, properties, body):
-        LOGGER.debug(f"Got IP DB info data: {body.decode()}")
-
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
-        data = json.loads(body)
+        try:
+            ip_infos = get_message_codec(properties).decode_ip_infos(body)
+        except MessageDecodeError:
+            LOGGER.exception("Can't decode the IP info batch, discarding it")
+            METRICS.incr("ip_info.decode_errors", tags=get_tags())
+            return
 
-        ip_info = IPDBInfo.from_dict(data)
+        LOGGER.debug(f"Got {len(ip_infos)} IP DB info entries")
 
-        for enricher in self.enrichers:
-            enricher.add_ip_info_to_local_cache(ip_info, False)
+        # The store is shared by all the enrichers of the process.
+        ip_info_store.add_many(ip_infos)
 
     @log_exception
     def receive_traceroute_enrichment_job(self, ch, method, properties, body):
-        if self.enrichment_jobs_queue.qsize() == 0:
-            LOGGER.debug(f"Got a job: {body.decode()}")
+        # The channel's prefetch count is equal to the n. of
+        # enrichers, and jobs are acked only once they are
+        # processed: a job is received only when an enricher
+        # is idle, and busy workers don't get any.
+        METRICS.incr("enrichment_jobs.received", tags=get_tags())
 
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+        # Jobs that were not acked by a worker that disconnected
+        # (or died) are sent again by the broker.
+        if method.redelivered:
+            METRICS.incr("enrichment_jobs.redelivered", tags=get_tags())
 
-            data = json.loads(body)
+        try:
+            job = get_message_codec(properties).decode_job(body)
+        except UnsupportedMessageError:
+            # Sent by a more recent version: it's left to the
+            # workers that can decode it, for example during a
+            # rolling deploy.
+            LOGGER.exception("Can't decode the job, retrying it later")
+            METRICS.incr("enrichment_jobs.decode_errors", tags=get_tags())
+            self._retry_job_later(ch, method, properties, body)
+            return
+        except MessageDecodeError:
+            # No worker will be able to decode it: requeuing it
+            # would only get it redelivered over and over.
+            LOGGER.exception("Can't decode the job, discarding it")
+            METRICS.incr("enrichment_jobs.decode_errors", tags=get_tags())
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
 
-            job = EnricherJob.from_dict(data)
+        LOGGER.debug(f"Got a job: {job}")
 
-            self.enrichment_jobs_queue.put(job)
+        self.enrichment_jobs_queue.put(
+            (job, functools.partial(self._ack_job, ch, method.delivery_tag))
+        )
 
+    @staticmethod
+    def _retry_job_later(ch, method, properties, body) -> None:
+        # Requeuing the job would get it redelivered immediately,
+        # maybe to this same worker: it's published to the retry
+        # queue instead, that sends it back to the jobs queue
+        # after ENRICHMENT_JOBS_RETRY_DELAY.
+        headers = dict(properties.headers or {})
+        retries = headers.get(ENRICHMENT_JOBS_RETRIES_HEADER, 0)
+
+        if retries >= ENRICHMENT_JOBS_MAX_RETRIES:
+            LOGGER.error(f"Job retried {retries} times, discarding it")
+            METRICS.incr("enrichment_jobs.retries_exhausted", tags=get_tags())
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
             return
 
-        LOGGER.debug(f"Job rejected: {body.decode()}")
+        headers[ENRICHMENT_JOBS_RETRIES_HEADER] = retries + 1
+
+        ch.basic_publish(
+            exchange="",
+            routing_key=ENRICHMENT_JOBS_RETRY_QUEUE_NAME,
+            body=body,
+            properties=pika.BasicProperties(
+                content_type=properties.content_type,
+                headers=headers
+            )
+        )
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        METRICS.incr("enrichment_jobs.retried", tags=get_tags())
+
+    @staticmethod
+    def _ack_job(ch, delivery_tag) -> None:
+        # Called by the enrichers: the ack is sent by
+        # the ioloop thread of the connection.
+        def _ack():
+            # Delivery tags are valid only within the channel
+            # they were received from; if it's closed, the job
+            # has been already sent again by the broker.
+            if ch.is_open:
+                ch.basic_ack(delivery_tag=delivery_tag)
+
+        try:
+            ch.connection.ioloop.add_callback_threadsafe(_ack)
+        except:  # noqa: E722
+            LOGGER.exception(f"Can't ack the job with delivery tag {delivery_tag}")
 
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+
+def _load_ip_info_store() -> None:
+    try:
+        ip_info_store.load_from_db()
+    except:  # noqa: E722
+        LOGGER.exception(
+            "Unhandled exception while loading the IP info entries from DB"
+        )
 
 
 def setup_consumers(consumers: int = 1, enrichers_per_consumer: int = 3) -> List[ConsumerThread]:
+    # The snapshot of the IP info store saved by the previous
+    # run is loaded before starting to consume jobs: it's
+    # way faster than loading the entries from the DB.
+    snapshot_path = get_ip_info_snapshot_path()
+    if snapshot_path:
+        load_ip_info_store_snapshot(snapshot_path)
+
+    # The loading of the existing IP info entries from the
+    # DB would block the enrichers, so let's do it in the
+    # background. Enrichers can work in the meantime, they
+    # will just fetch more info from the external sources.
+    # Entries loaded from the snapshot are replaced only by
+    # more recent DB entries.
+    loader_thread = threading.Thread(
+        target=_load_ip_info_store,
+        name="ip-info-store-loader",
+        daemon=True
+    )
+    loader_thread.start()
+
     threads = []
     for n in range(consumers):
         thread = ConsumerThread(f"consumer-{n}", enrichers_per_consumer)
@@ -1,16 +1,28 @@
 from __future__ import annotations
-from typing import Optional, Type
-import json
+from typing import Callable, Deque, Optional, Tuple, Type
+from collections import deque
 import threading
 import logging
 import queue
+import time
+
+import markus
 
 from .async_connection import AsyncConnection, Reconnector
 from .async_channel import AsyncChannel, TracerouteDispatcherChannel, IPDBInfoChannel
+from .codecs import Codec, EncodedMessage, get_codec
+from ..config import (
+    IPINFO_BATCH_MAX_ENTRIES,
+    IPINFO_BATCH_MAX_SIZE,
+    IPINFO_BATCH_MAX_LINGER,
+    get_wire_format
+)
+from ..metrics import get_tags
 from ..structures import EnricherJob, IPDBInfo
 
 
 LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics(__name__)
 
 
 enrichment_jobs_dispatcher: EnrichmentJobsDispatcher
@@ -19,12 +31,17 @@ ipinfo_dispatcher: IPInfoDispatcher
 
 class DispatcherAsyncConnection(AsyncConnection):
 
-    def __init__(self, channel_class: AsyncChannel, channel_name: str, queue: queue.Queue):
+    def __init__(
+        self,
+        channel_class: AsyncChannel,
+        channel_name: str,
+        get_message_to_publish: Callable[[], Optional[EncodedMessage]]
+    ):
         super().__init__()
 
         self.channel_class = channel_class
         self.channel_name = channel_name
-        self.queue = queue
+        self.get_message_to_publish = get_message_to_publish
 
         self.channel: AsyncChannel
 
@@ -37,13 +54,120 @@ class DispatcherAsyncConnection(AsyncConnection):
         )
         self._channels.append(self.channel)
 
-    def get_message_to_publish(self) -> Optional[str]:
+    def request_publish(self) -> None:
+        # Called by other threads. If the channel is not ready
+        # yet, messages are published as soon as it is.
+        if self._closing or not self.connection or not self.connection.is_open:
+            return
+
+        channel = getattr(self, "channel", None)
+        if not channel:
+            return
+
         try:
-            job = self.queue.get(block=False)
-        except queue.Empty:
+            channel.request_publish()
+        except:  # noqa: E722
+            LOGGER.exception(f"{self.channel_name} - Can't request to publish messages")
+
+
+class IPInfoBatcher:
+    """Group the IP info waiting to be dispatched into batches.
+
+    'queue' holds (time.monotonic() when enqueued, IPDBInfo)
+    tuples. Entries are encoded by 'codec' as soon as they are
+    taken from the queue; a batch is made of them.
+
+    A batch is returned only when it's full (n. of entries or
+    size) or when its oldest entry has been waiting for
+    'max_linger' seconds; otherwise, entries are kept for the
+    next call. Entries are kept also across reconnections.
+    """
+
+    # Upper bound of the bytes added by the codecs to
+    # the entries when they are joined (list delimiters
+    # and headers), besides 1 byte per entry.
+    BATCH_OVERHEAD = 5
+
+    def __init__(
+        self,
+        queue: queue.Queue,
+        codec: Codec,
+        max_entries: int = IPINFO_BATCH_MAX_ENTRIES,
+        max_size: int = IPINFO_BATCH_MAX_SIZE,
+        max_linger: float = IPINFO_BATCH_MAX_LINGER
+    ):
+        self.queue = queue
+        self.codec = codec
+
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.max_linger = max_linger
+
+        self.pending: Deque[Tuple[float, bytes]] = deque()
+
+    def _fetch_from_queue(self) -> None:
+        while True:
+            try:
+                enqueued_at, ip_info = self.queue.get(block=False)
+            except queue.Empty:
+                return
+
+            self.pending.append((
+                enqueued_at,
+                self.codec.encode_ip_info(ip_info)
+            ))
+
+    def get_batch(
+        self,
+        on_publish: Optional[Callable[[float], None]] = None
+    ) -> Optional[EncodedMessage]:
+        """Return the next batch, if it's ready.
+
+        'on_publish' is called with the time when the oldest entry
+        of the batch was enqueued.
+        """
+        self._fetch_from_queue()
+
+        if not self.pending:
             return None
 
-        return json.dumps(job.to_json_dict())
+        entries = []
+        size = self.BATCH_OVERHEAD
+
+        for _, entry in self.pending:
+            if len(entries) == self.max_entries:
+                break
+
+            # A single entry that is bigger than max_size
+            # is sent on its own.
+            if entries and size + len(entry) + 1 > self.max_size:
+                break
+
+            entries.append(entry)
+            size += len(entry) + 1
+
+        is_full = len(entries) < len(self.pending) or \
+            len(entries) == self.max_entries
+
+        if not is_full and \
+                time.monotonic() - self.pending[0][0] < self.max_linger:
+            return None
+
+        oldest = self.pending[0][0]
+
+        for _ in entries:
+            self.pending.popleft()
+
+        if on_publish:
+            on_publish(oldest)
+
+        body = self.codec.join_ip_infos(entries)
+
+        METRICS.incr("ipinfo_batch.published", tags=get_tags())
+        METRICS.histogram("ipinfo_batch.entries", len(entries), tags=get_tags())
+        METRICS.histogram("ipinfo_batch.size", len(body), tags=get_tags())
+
+        return self.codec.message(body)
 
 
 class DispatcherThread(threading.Thread):
@@ -56,13 +180,47 @@ class DispatcherThread(threading.Thread):
 
         self.daemon = True
 
+        # Items are (time.monotonic() when enqueued, object to publish).
         self.queue = queue.Queue()
 
+        # Set when the ioloop has been asked to publish the
+        # messages, cleared as soon as it starts doing it: the
+        # enqueued items don't trigger one callback each.
+        self.publish_requested = threading.Event()
+
+        self.codec = get_codec(get_wire_format())
+
         self.reconnector = Reconnector(
             DispatcherAsyncConnection,
-            self.CHANNEL_CLASS, self.CHANNEL_NAME, self.queue
+            self.CHANNEL_CLASS, self.CHANNEL_NAME, self.get_message_to_publish
+        )
+
+    def dispatch(self, obj) -> None:
+        self.queue.put((time.monotonic(), obj))
+
+        if not self.publish_requested.is_set():
+            self.publish_requested.set()
+            self.reconnector.async_connection.request_publish()
+
+    def _track_dispatch_to_publish(self, enqueued_at: float) -> None:
+        METRICS.timing(
+            f"{self.CHANNEL_NAME}.dispatch_to_publish",
+            (time.monotonic() - enqueued_at) * 1000,
+            tags=get_tags()
         )
 
+    def get_message_to_publish(self) -> Optional[EncodedMessage]:
+        self.publish_requested.clear()
+
+        try:
+            enqueued_at, job = self.queue.get(block=False)
+        except queue.Empty:
+            return None
+
+        self._track_dispatch_to_publish(enqueued_at)
+
+        return self.codec.message(self.codec.encode_job(job))
+
     def run(self):
         LOGGER.debug("Starting DispatcherThread")
         self.reconnector.run()
@@ -83,6 +241,16 @@ class IPInfoDispatcher(DispatcherThread):
     CHANNEL_CLASS = IPDBInfoChannel
     CHANNEL_NAME = "ipinfo_dispatcher"
 
+    def __init__(self):
+        super().__init__()
+
+        self.batcher = IPInfoBatcher(self.queue, self.codec)
+
+    def get_message_to_publish(self) -> Optional[EncodedMessage]:
+        self.publish_requested.clear()
+
+        return self.batcher.get_batch(on_publish=self._track_dispatch_to_publish)
+
 
 def setup_enrichment_jobs_dispatcher() -> EnrichmentJobsDispatcher:
     global enrichment_jobs_dispatcher
@@ -103,8 +271,8 @@ def setup_ipinfo_dispatcher() -> IPInfoDispatcher:
 
 
 def dispatch_traceroute_enrichment_job(job: EnricherJob) -> None:
-    enrichment_jobs_dispatcher.queue.put(job)
+    enrichment_jobs_dispatcher.dispatch(job)
 
 
 def dispatch_ipinfo(ip_info: IPDBInfo) -> None:
-    ipinfo_dispatcher.queue.put(ip_info)
+    ipinfo_dispatcher.dispatch(ip_info)
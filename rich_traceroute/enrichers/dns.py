@@ -1,11 +1,37 @@
-from threading import Lock
+from __future__ import annotations
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import Future
+from threading import Lock, Thread
+import ipaddress
+import logging
+import queue
+import random
+import select
+import socket
+import time
 
+import dns.exception
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
 import dns.resolver
 import dns.reversename
 
-from cachetools import cached, TTLCache
+from cachetools import TTLCache
+import markus
 
-from ..config import DNS_QUERY_TIMEOUT, DNS_CACHE_TTL
+from ..config import (
+    DNS_QUERY_TIMEOUT,
+    DNS_QUERY_RETRY_INTERVAL,
+    DNS_CACHE_TTL,
+    DNS_NEGATIVE_CACHE_TTL
+)
+from ..metrics import get_tags
+
+
+LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics(__name__)
 
 
 name_to_ip_cache: TTLCache = TTLCache(maxsize=1024, ttl=DNS_CACHE_TTL)
@@ -13,42 +39,345 @@ name_to_ip_cache_lock = Lock()
 ip_to_name_cache: TTLCache = TTLCache(maxsize=1024, ttl=DNS_CACHE_TTL)
 ip_to_name_cache_lock = Lock()
 
+# Failed lookups (NXDOMAIN, no answer, timeouts, ...) are
+# cached too, but for a shorter time.
+name_to_ip_negative_cache: TTLCache = TTLCache(maxsize=1024, ttl=DNS_NEGATIVE_CACHE_TTL)
+ip_to_name_negative_cache: TTLCache = TTLCache(maxsize=1024, ttl=DNS_NEGATIVE_CACHE_TTL)
 
-@cached(cache=name_to_ip_cache, lock=name_to_ip_cache_lock)
-def name_to_ip(name: str) -> str:
-    try:
-        answer = dns.resolver.query(
-            name,
-            tcp=False,
-            lifetime=DNS_QUERY_TIMEOUT
-        )
+resolver: Optional[DNSResolver] = None
+resolver_lock = Lock()
+
+
+class _PendingQuery:
+
+    def __init__(
+        self,
+        key: Tuple[dns.name.Name, int],
+        message: dns.message.Message,
+        future: Future,
+        deadline: float
+    ):
+        self.key = key
+        self.message = message
+        self.future = future
+        self.deadline = deadline
+        self.next_retry = 0.0
+        self.attempt = 0
+
+
+class DNSResolver(Thread):
+    """Stub resolver that runs in its own thread.
+
+    All the queries are sent over the same UDP socket, without
+    waiting for the previous ones to be answered: the responses
+    are matched to the queries using their ID.
+
+    Lookups for the same name/type that are already in progress
+    are not sent again: the callers share the same Future.
+    """
+
+    def __init__(
+        self,
+        nameservers: List[str],
+        port: int = 53,
+        timeout: float = DNS_QUERY_TIMEOUT,
+        retry_interval: float = DNS_QUERY_RETRY_INTERVAL
+    ):
+        super().__init__(name="DNSResolver")
+
+        self.daemon = True
+
+        if not nameservers:
+            raise ValueError("No nameservers configured")
+
+        # Only the nameservers of the same address family
+        # of the first one are used, since all the queries
+        # go through the same socket.
+        version = ipaddress.ip_address(nameservers[0]).version
+        family = socket.AF_INET6 if version == 6 else socket.AF_INET
+
+        self.nameservers = [
+            ns for ns in nameservers
+            if ipaddress.ip_address(ns).version == version
+        ]
+        self.port = port
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+        # Used to wake up the thread when new queries are
+        # submitted or when it must be stopped.
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+
+        self.new_queries: queue.Queue = queue.Queue()
+
+        self.in_flight: Dict[Tuple[dns.name.Name, int], Future] = {}
+        self.in_flight_lock = Lock()
+
+        # Used by the resolver thread only.
+        self.pending: Dict[int, _PendingQuery] = {}
+
+        self.stop_requested = False
+
+    def query(self, qname: dns.name.Name, rdtype: int) -> Future:
+        """Return a Future whose result is the response message."""
+
+        key = (qname, rdtype)
+
+        with self.in_flight_lock:
+            future = self.in_flight.get(key)
+
+            if future:
+                METRICS.incr("coalesced", tags=get_tags())
+                return future
+
+            future = Future()
+            self.in_flight[key] = future
+
+        self.new_queries.put((key, future))
+        self._wakeup()
+
+        return future
+
+    def resolve(self, qname: dns.name.Name, rdtype: int) -> dns.message.Message:
+        # The deadline is enforced by the resolver thread; the
+        # timeout here is only a safety net.
+        return self.query(qname, rdtype).result(timeout=self.timeout + 1)
+
+    def stop(self) -> None:
+        self.stop_requested = True
+        self._wakeup()
+
+    def _wakeup(self) -> None:
+        try:
+            self.wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _complete(self, pending: _PendingQuery, response=None, exc=None) -> None:
+        with self.in_flight_lock:
+            self.in_flight.pop(pending.key, None)
+
+        if exc:
+            pending.future.set_exception(exc)
+        else:
+            pending.future.set_result(response)
+
+    def _send(self, pending: _PendingQuery) -> None:
+        nameserver = self.nameservers[pending.attempt % len(self.nameservers)]
+
+        pending.attempt += 1
+        pending.next_retry = time.monotonic() + self.retry_interval
+
+        try:
+            self.sock.sendto(pending.message.to_wire(), (nameserver, self.port))
+        except OSError:
+            LOGGER.exception(f"Error while sending DNS query to {nameserver}")
+
+    def _process_new_queries(self) -> None:
+        while True:
+            try:
+                key, future = self.new_queries.get(block=False)
+            except queue.Empty:
+                return
+
+            qname, rdtype = key
+
+            message = dns.message.make_query(qname, rdtype)
+
+            # The ID is used to match the response to the query.
+            while message.id in self.pending:
+                message.id = random.randint(0, 65535)
+
+            pending = _PendingQuery(
+                key, message, future,
+                time.monotonic() + self.timeout
+            )
+            self.pending[message.id] = pending
+
+            self._send(pending)
+
+    def _process_responses(self) -> None:
+        while True:
+            try:
+                wire, _ = self.sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                LOGGER.exception("Error while receiving DNS responses")
+                return
 
-        for rr in answer:
+            try:
+                response = dns.message.from_wire(wire)
+            except:  # noqa: E722
+                continue
+
+            pending = self.pending.get(response.id)
+
+            if not pending or not pending.message.is_response(response):
+                continue
+
+            del self.pending[response.id]
+
+            self._complete(pending, response=response)
+
+    def _process_timeouts(self) -> None:
+        now = time.monotonic()
+
+        for msg_id, pending in list(self.pending.items()):
+            if now >= pending.deadline:
+                del self.pending[msg_id]
+                self._complete(pending, exc=dns.exception.Timeout())
+
+            elif now >= pending.next_retry:
+                self._send(pending)
+
+    def run(self):
+        LOGGER.debug("Starting DNSResolver")
+
+        while not self.stop_requested:
+            timeout = None
+            if self.pending:
+                timeout = max(
+                    0,
+                    min(
+                        min(p.next_retry, p.deadline)
+                        for p in self.pending.values()
+                    ) - time.monotonic()
+                )
+
+            readable, _, _ = select.select(
+                [self.sock, self.wakeup_r], [], [], timeout
+            )
+
+            if self.wakeup_r in readable:
+                try:
+                    while self.wakeup_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+            try:
+                if self.sock in readable:
+                    self._process_responses()
+
+                self._process_new_queries()
+                self._process_timeouts()
+            except:  # noqa: E722
+                LOGGER.exception("Unhandled exception in the DNS resolver")
+
+        for pending in self.pending.values():
+            self._complete(pending, exc=dns.exception.Timeout())
+        self.pending.clear()
+
+        self.sock.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+        LOGGER.debug("DNSResolver completed")
+
+
+def _start_resolver(nameservers: Optional[List[str]], port: int) -> DNSResolver:
+    global resolver
+
+    if resolver:
+        resolver.stop()
+
+    resolver = DNSResolver(
+        nameservers or dns.resolver.get_default_resolver().nameservers,
+        port=port
+    )
+    resolver.start()
+
+    return resolver
+
+
+def setup_resolver(
+    nameservers: Optional[List[str]] = None,
+    port: int = 53
+) -> DNSResolver:
+    with resolver_lock:
+        return _start_resolver(nameservers, port)
+
+
+def get_resolver() -> DNSResolver:
+    with resolver_lock:
+        if resolver:
+            return resolver
+
+        # Lazily started the first time it's needed.
+        return _start_resolver(None, 53)
+
+
+def _get_answer(response: dns.message.Message, rdtype: int) -> Optional[str]:
+    if response.rcode() != dns.rcode.NOERROR:
+        return None
+
+    # CNAMEs are followed by the recursive resolver, and
+    # included in the answer section too.
+    for rrset in response.answer:
+        if rrset.rdtype != rdtype:
+            continue
+
+        for rr in rrset:
             return str(rr)
+
+    return None
+
+
+def _lookup(
+    qname_func,
+    value: str,
+    rdtype: int,
+    cache: TTLCache,
+    cache_lock: Lock,
+    negative_cache: TTLCache
+) -> Optional[str]:
+
+    with cache_lock:
+        if value in cache:
+            return cache[value]
+
+        if value in negative_cache:
+            METRICS.incr("negative_cache_hits", tags=get_tags())
+            return None
+
+    res = None
+
+    try:
+        response = get_resolver().resolve(qname_func(value), rdtype)
+        res = _get_answer(response, rdtype)
     except:  # noqa: E722
         pass
 
-    return ""
+    with cache_lock:
+        if res:
+            cache[value] = res
+        else:
+            negative_cache[value] = True
 
+    return res
 
-@cached(cache=ip_to_name_cache, lock=ip_to_name_cache_lock)
-def ip_to_name(ip: str) -> str:
-    try:
-        qname = dns.reversename.from_address(ip)
-        answer = dns.resolver.query(
-            qname, "PTR",
-            tcp=False,
-            lifetime=DNS_QUERY_TIMEOUT
-        )
 
-        for rr in answer:
-            res = str(rr)
+def name_to_ip(name: str) -> str:
+    return _lookup(
+        dns.name.from_text, name, dns.rdatatype.A,
+        name_to_ip_cache, name_to_ip_cache_lock,
+        name_to_ip_negative_cache
+    ) or ""
 
-            if res.endswith("."):
-                res = res[:-1]
 
-            return res
-    except:  # noqa: E722
-        return ""
+def ip_to_name(ip: str) -> str:
+    res = _lookup(
+        dns.reversename.from_address, ip, dns.rdatatype.PTR,
+        ip_to_name_cache, ip_to_name_cache_lock,
+        ip_to_name_negative_cache
+    ) or ""
+
+    if res.endswith("."):
+        res = res[:-1]
 
-    return ""
+    return res
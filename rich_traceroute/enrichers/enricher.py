@@ -1,35 +1,59 @@
-from typing import Union, Optional, Tuple
+from typing import Union, Optional, Tuple, Dict, List
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import ipaddress
 import threading
 import queue
 import logging
-import requests
 import datetime
-import random
+import time
 
-import radix
 import markus
-from flask_socketio import SocketIO
-
+import requests
 
 from .dns import name_to_ip, ip_to_name
 from .dispatcher import dispatch_ipinfo
-from ..traceroute import Host, HostOrigins, HostIXPNetwork, Traceroute
-from ..ip_info_db import IPInfo_Prefix
+from .ip_info_backfiller import ip_info_backfiller
+from .ip_info_refresher import ip_info_refresher
+from .ip_info_store import ip_info_store
+from .ripestat import (
+    get_ripestat_client,
+    get_ripestat_executor,
+    is_ripestat_failure,
+    ripestat_circuit_breaker
+)
+from .socketio_emitter import get_socketio_emitter
+from ..traceroute import Host, Traceroute, load_traceroute
+from ..db import db
+from ..errors import ExternalSourceTransientError, ExternalSourceUnavailableError
+from ..ip_info_db import bulk_upsert
 from ..structures import IPDBInfo, EnricherJob, EnricherJob_Host
 from ..metrics import get_tags, log_execution_time
 from ..config import (
-    IP_INFO_EXPIRY,
-    SOCKET_IO_DATA_EVENT,
+    MAX_ENRICHMENT_TIME,
     SOCKET_IO_ERROR_EVENT,
-    SOCKET_IO_ENRICHMENT_COMPLETED_EVENT,
-    get_rabbitmq_url
+    get_host_concurrency
 )
 
 
 LOGGER = logging.getLogger(__name__)
 METRICS = markus.get_metrics(__name__)
 
+# The prefix of an IP is not known until its info are fetched:
+# IPs that fall within the same network of these lengths are
+# assumed to be likely covered by the same prefix. While the
+# info of one of them are being fetched, the lookups for the
+# others wait for that fetch to complete, then look in the
+# cache again before querying external sources themselves.
+IPS_GROUP_PREFIXLEN = {
+    4: 16,
+    6: 32
+}
+
+# IP info being fetched from external sources by the enrichers
+# of the process: IPs group (see IPS_GROUP_PREFIXLEN) => Future.
+ip_info_fetches: Dict[Union[ipaddress.IPv4Network, ipaddress.IPv6Network], Future] = {}
+ip_info_fetches_lock = threading.Lock()
+
 
 class Enricher(threading.Thread):
 
@@ -40,48 +64,42 @@ class Enricher(threading.Thread):
 
         self.queue = queue
 
-        # IP Info DB
+        # SocketIO
         # -------------------------------------
 
-        self.ip_info_db = radix.Radix()
-        self.ip_info_db_lock = threading.Lock()
+        # Shared by all the enrichers of the process.
+        self.socketio = get_socketio_emitter()
 
-        # SocketIO
+        # RIPEstat
         # -------------------------------------
 
-        self.socketio = SocketIO(
-            message_queue=get_rabbitmq_url()
-        )
+        # Shared by all the enrichers of the process.
+        self.ripestat_executor = get_ripestat_executor()
 
-        # Requests
+        # Hosts of the same traceroute
         # -------------------------------------
 
-        self.request_session = requests.Session()
+        self.hosts_executor = ThreadPoolExecutor(
+            max_workers=get_host_concurrency(),
+            thread_name_prefix=f"{name}-hosts"
+        )
 
-    def _add_ip_info_to_db(self, ip_info: IPDBInfo) -> None:
+    def _add_ip_info_to_db(self, ip_infos: List[IPDBInfo]) -> None:
         try:
-            IPInfo_Prefix.create_from_ipdbinfo(ip_info)
+            bulk_upsert(ip_infos)
         except:  # noqa: E722
             LOGGER.exception(
                 "Unhandled exception while creating the ip_info "
-                f"DB record for {ip_info.prefix}"
+                "DB records for " + ", ".join(str(ip_info.prefix) for ip_info in ip_infos)
             )
 
     def add_ip_info_to_local_cache(
         self,
         ip_info: IPDBInfo,
         dispatch_to_others: bool,
-        last_updated: datetime.datetime = datetime.datetime.utcnow()
+        last_updated: Optional[datetime.datetime] = None
     ) -> None:
-        # This function is called from other threads too,
-        # so make sure that it runs fast and it takes care
-        # of locking the resources that it updates (the
-        # ip_info_db specifically).
-
-        with self.ip_info_db_lock:
-            node = self.ip_info_db.add(str(ip_info.prefix))
-            node.data["ip_db_info"] = ip_info
-            node.data["last_updated"] = last_updated
+        ip_info_store.add(ip_info, last_updated)
 
         if dispatch_to_others:
             LOGGER.debug(
@@ -90,22 +108,19 @@ class Enricher(threading.Thread):
 
             dispatch_ipinfo(ip_info)
 
+    def _schedule_ip_info_refresh(self, ip_info: IPDBInfo) -> None:
+        ip_info_refresher.schedule(
+            ip_info, self._get_ip_info_from_external_sources
+        )
+
     def _get_ip_info_from_db(self, ip: Union[ipaddress.IPv4Address, ipaddress.IPv6Address]) -> Optional[IPDBInfo]:
         try:
-            with self.ip_info_db_lock:
-                node = self.ip_info_db.search_best(str(ip))
+            # Expired entries are still used while they
+            # are refreshed in background.
+            return ip_info_store.lookup(ip, refresh=self._schedule_ip_info_refresh)
         except:  # noqa: E722
             LOGGER.exception(f"Lookup of {ip} failed")
 
-        if node:
-            # If the cached entry is expired, let's remove it.
-            if node.data["last_updated"] < datetime.datetime.utcnow() - IP_INFO_EXPIRY:
-                with self.ip_info_db_lock:
-                    self.ip_info_db.delete(node.prefix)
-                return None
-
-            return node.data["ip_db_info"]
-
         return None
 
     @staticmethod
@@ -135,21 +150,43 @@ class Enricher(threading.Thread):
         except:  # noqa E722
             return None
 
-    def _ripe_stat_query(self, url):
-        return self.request_session.get(url)
+    def _ripe_stat_query(self, url: str, deadline: Optional[float] = None):
+        return get_ripestat_client().get(url, deadline)
 
     def _get_ip_info_from_external_sources(
         self,
-        ip: Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+        ip: Union[ipaddress.IPv4Network, ipaddress.IPv6Network],
+        deadline: Optional[float] = None
     ) -> Optional[IPDBInfo]:
 
+        # While RIPEstat keeps failing, it's not queried at all:
+        # ExternalSourceUnavailableError is raised, so that the
+        # caller can go on without waiting for it.
+        if not ripestat_circuit_breaker.allow_request():
+            METRICS.incr("ripestat.circuit_open", tags=get_tags())
+            raise ExternalSourceUnavailableError(
+                f"RIPEstat not queried for {ip}: circuit breaker open"
+            )
+
         METRICS.incr("ip_info_from_external_sources", tags=get_tags())
 
         with log_execution_time(METRICS, LOGGER, "ripestat.query_time", str(ip)):
             try:
                 ripe_stat_response = self._ripe_stat_query(
-                    f"https://stat.ripe.net/data/prefix-overview/data.json?resource={ip}"
+                    f"https://stat.ripe.net/data/prefix-overview/data.json?resource={ip}",
+                    deadline
+                )
+            except ExternalSourceUnavailableError:
+                raise
+            except (requests.ConnectionError, requests.Timeout) as e:
+                LOGGER.exception(
+                    f"RIPEstat query for {ip} failed."
                 )
+                METRICS.incr("ripestat.http_errors", tags=get_tags())
+                ripestat_circuit_breaker.record_failure()
+                raise ExternalSourceTransientError(
+                    f"RIPEstat query for {ip} failed: {e}"
+                ) from e
             except:  # noqa: E722
                 LOGGER.exception(
                     f"RIPEstat query for {ip} failed."
@@ -157,6 +194,24 @@ class Enricher(threading.Thread):
                 METRICS.incr("ripestat.http_errors", tags=get_tags())
                 return None
 
+        # Only the failures that mean that RIPEstat is not working
+        # are counted by the circuit breaker; they are raised as
+        # ExternalSourceTransientError, so that the IP info can be
+        # fetched again later.
+        if is_ripestat_failure(ripe_stat_response.status_code):
+            LOGGER.error(
+                f"RIPEstat query for {ip} failed: "
+                f"HTTP status {ripe_stat_response.status_code}."
+            )
+            METRICS.incr("ripestat.http_errors", tags=get_tags())
+            ripestat_circuit_breaker.record_failure()
+            raise ExternalSourceTransientError(
+                f"RIPEstat query for {ip} failed: "
+                f"HTTP status {ripe_stat_response.status_code}"
+            )
+
+        ripestat_circuit_breaker.record_success()
+
         try:
             ripe_stat_response.raise_for_status()
         except:  # noqa: E722
@@ -191,14 +246,7 @@ class Enricher(threading.Thread):
         host: Host
     ) -> None:
 
-        self.socketio.emit(
-            SOCKET_IO_DATA_EVENT,
-            {
-                "traceroute_id": traceroute_id,
-                **host.to_dict()
-            },
-            namespace=f"/t/{traceroute_id}"
-        )
+        self.socketio.emit_host(traceroute_id, host.to_dict())
 
     def emit_host_enrichment_error_event(
         self,
@@ -222,20 +270,76 @@ class Enricher(threading.Thread):
         self,
         traceroute: Traceroute
     ) -> None:
-        self.socketio.emit(
-            SOCKET_IO_ENRICHMENT_COMPLETED_EVENT,
-            {
-                "traceroute_id": traceroute.id,
-                "traceroute": traceroute.to_dict(),
-                "text": traceroute.to_text()
-            },
-            namespace=f"/t/{traceroute.id}"
+        self.socketio.emit_enrichment_completed(traceroute)
+
+    def _get_ip_info_for_ip(
+        self,
+        ip: Union[ipaddress.IPv4Address, ipaddress.IPv6Address],
+        deadline: Optional[float] = None
+    ) -> Tuple[Optional[IPDBInfo], bool]:
+        # Executed by the workers of the RIPEstat pool.
+        # Returns the info of the IP, and whether they were
+        # fetched from external sources by this call.
+        # ExternalSourceUnavailableError is raised when external
+        # sources are unavailable.
+
+        group = ipaddress.ip_network(
+            f"{ip}/{IPS_GROUP_PREFIXLEN[ip.version]}", strict=False
         )
 
-    def _enrich_host(self, traceroute_id: str, host: EnricherJob_Host) -> Tuple[Host, Optional[IPDBInfo]]:
+        while True:
+            # The lookup is performed here, and not when the task
+            # is submitted, so the prefixes fetched in the meantime
+            # for other IPs are reused if they cover this one.
+            ip_info = self._get_ip_info_from_db(ip)
+
+            if ip_info:
+                LOGGER.debug(f"IP info for {ip} found in the cache")
+                return ip_info, False
+
+            with ip_info_fetches_lock:
+                fetch = ip_info_fetches.get(group)
+
+                if not fetch:
+                    fetch = Future()
+                    ip_info_fetches[group] = fetch
+                    break
+
+            LOGGER.debug(f"IP info for {group} already being gathered; waiting")
+            METRICS.incr("ip_info_fetch.coalesced", tags=get_tags())
+
+            # Whatever the outcome, the cache is checked again: if
+            # the prefix that was fetched doesn't cover this IP, or
+            # if the fetch failed, this one is tried.
+            wait([fetch])
+
+        try:
+            LOGGER.debug(f"IP info for {ip} not found; gathering them")
+
+            ip_info = self._get_ip_info_from_external_sources(ip, deadline)
+
+            # Added to the cache before the waiting lookups
+            # are released, so the ones for the other IPs
+            # of the prefix find them there.
+            if ip_info:
+                self.add_ip_info_to_local_cache(ip_info, False)
+
+            fetch.set_result(ip_info)
+        except BaseException as e:
+            fetch.set_exception(e)
+            raise
+        finally:
+            with ip_info_fetches_lock:
+                ip_info_fetches.pop(group, None)
+
+        return ip_info, True
+
+    def _resolve_host(
+        self,
+        host: EnricherJob_Host
+    ) -> Tuple[Optional[Union[ipaddress.IPv4Address, ipaddress.IPv6Address]], Optional[str]]:
         host_ip = None
         host_name = None
-        ip_info = None
 
         try:
             host_ip = ipaddress.ip_address(host.host)
@@ -249,88 +353,205 @@ class Enricher(threading.Thread):
             if host_name:
                 host_ip = self._get_ip_from_hostname(host_name)
 
-        if host_ip and host_ip.is_global:
-            ip_info = self._get_ip_info_from_db(host_ip)
+        return host_ip, host_name
+
+    def _enrich_host(
+        self,
+        host: EnricherJob_Host,
+        host_ip: Optional[Union[ipaddress.IPv4Address, ipaddress.IPv6Address]],
+        host_name: Optional[str],
+        ip_info: Optional[IPDBInfo]
+    ) -> Host:
+
+        LOGGER.debug(f"Host Data: {host_ip} / {host_name} / {ip_info}")
+
+        # The host, its origins and its IXP network are written
+        # at once: if the job is processed again (for example
+        # because the worker died), the host is either enriched
+        # or not, and rows are never duplicated.
+        with db.atomic():
+            db_host = Host.get(
+                Host.id == host.host_id
+            )
+            db_host.ip = host_ip
+            db_host.name = host_name
+            db_host.enriched = True
+            db_host.save()
 
-            if not ip_info:
-                LOGGER.debug(f"IP info for {host_ip} not found; gathering them")
+            db_host.set_ip_info(ip_info)
 
-                ip_info = self._get_ip_info_from_external_sources(host_ip)
+        return db_host
 
-                if ip_info:
-                    self.add_ip_info_to_local_cache(ip_info, True)
-                    self._add_ip_info_to_db(ip_info)
-            else:
-                LOGGER.debug(f"IP info for {host_ip} found in the cache")
+    def _handle_enrich_host_exception(self, job: EnricherJob, host: EnricherJob_Host) -> None:
+        LOGGER.exception(
+            "Unhandled exception while enriching host ID "
+            f"{host.host_id} for hop n. {host.hop_n} of "
+            f"traceroute {job.traceroute_id}"
+        )
 
-            LOGGER.debug(f"Host Data: {host_ip} / {host_name} / {ip_info}")
+        METRICS.incr("enrich_host.exceptions", tags=get_tags())
 
-        db_host = Host.get(
-            Host.id == host.host_id
+        self.emit_host_enrichment_error_event(
+            job.traceroute_id,
+            host.hop_n,
+            host.host_id,
+            "An error occurred while enriching "
+            "the information for this host."
         )
-        db_host.ip = host_ip
-        db_host.name = host_name
-        db_host.enriched = True
-        db_host.save()
-
-        if ip_info:
-            for asn, holder in ip_info.origins or []:
-                HostOrigins.create(
-                    host_id=host.host_id,
-                    asn=asn,
-                    holder=holder
-                )
 
-            if ip_info.ixp_network:
-                HostIXPNetwork.create(
-                    host_id=host.host_id,
-                    lan_name=ip_info.ixp_network.lan_name,
-                    ix_name=ip_info.ixp_network.ix_name,
-                    ix_description=ip_info.ixp_network.ix_description
-                )
+    def _resolve_host_timed(
+        self,
+        host: EnricherJob_Host
+    ) -> Tuple[Optional[Union[ipaddress.IPv4Address, ipaddress.IPv6Address]], Optional[str]]:
+        # Executed by the workers of the hosts pool.
+        with log_execution_time(METRICS, LOGGER, "_resolve_host", host.host):
+            return self._resolve_host(host)
 
-        return db_host, ip_info
+    def _complete_host_enrichment(
+        self,
+        job: EnricherJob,
+        host: EnricherJob_Host,
+        host_ip: Optional[Union[ipaddress.IPv4Address, ipaddress.IPv6Address]],
+        host_name: Optional[str],
+        ip_info: Optional[IPDBInfo]
+    ) -> None:
+        try:
+            with log_execution_time(METRICS, LOGGER, "_enrich_host", host.host):
+                db_host = self._enrich_host(host, host_ip, host_name, ip_info)
+        except:  # noqa: E722
+            self._handle_enrich_host_exception(job, host)
+            return
+
+        try:
+            self.emit_host_enriched_event(
+                job.traceroute_id,
+                db_host
+            )
+        except:  # noqa: E722
+            LOGGER.exception(
+                "Unhandled exception while emitting SocketIO "
+                f"event for traceroute {job.traceroute_id}, hop n. "
+                f"{host.hop_n}, host_id {host.host_id}"
+            )
 
     def process_traceroute_enrichment_job(self, job: EnricherJob) -> Traceroute:
         traceroute = Traceroute.get(Traceroute.id == job.traceroute_id)
-        traceroute.enrichment_started = datetime.datetime.utcnow()
-        traceroute.save()
-
-        for host in job.hosts:
-            try:
-                with log_execution_time(METRICS, LOGGER, "_enrich_host", host.host):
-                    db_host, ip_info = self._enrich_host(job.traceroute_id, host)
-            except:  # noqa: E722
-                LOGGER.exception(
-                    "Unhandled exception while enriching host ID "
-                    f"{host.host_id} for hop n. {host.hop_n} of "
-                    f"traceroute {job.traceroute_id}"
-                )
+        if not traceroute.enrichment_started:
+            traceroute.enrichment_started = datetime.datetime.utcnow()
+            traceroute.save()
+
+        # Queries to external sources must fit in the time left
+        # before the traceroute is considered timed out.
+        budget = traceroute.created + MAX_ENRICHMENT_TIME - datetime.datetime.utcnow()
+        deadline = time.monotonic() + budget.total_seconds()
+
+        # If the job was already processed in part (the
+        # worker that was processing it died and the job was
+        # sent again), the hosts that were enriched are skipped.
+        enriched_host_ids = {
+            host_id for host_id, in Host.select(Host.id).where(
+                Host.id.in_([host.host_id for host in job.hosts]),
+                Host.enriched == True  # noqa: E712
+            ).tuples()
+        }
+
+        if enriched_host_ids:
+            LOGGER.info(
+                f"Resuming the enrichment of traceroute {job.traceroute_id}: "
+                f"{len(enriched_host_ids)} hosts already enriched"
+            )
+            METRICS.incr("enrich_host.skipped", len(enriched_host_ids), tags=get_tags())
 
-                METRICS.incr("enrich_host.exceptions", tags=get_tags())
+        hosts = [
+            host for host in job.hosts
+            if host.host_id not in enriched_host_ids
+        ]
 
-                self.emit_host_enrichment_error_event(
-                    job.traceroute_id,
-                    host.hop_n,
-                    host.host_id,
-                    "An error occurred while enriching "
-                    "the information for this host."
+        # IPs and names of the hosts are resolved in parallel,
+        # so that a slow DNS lookup doesn't stall the others.
+        # As soon as a host is resolved, if its IP info are not
+        # in the cache, they are fetched by the RIPEstat pool;
+        # otherwise, the host is stored and its event is emitted.
+        # DB writes are performed by this thread only.
+        resolve_futures = {
+            self.hosts_executor.submit(self._resolve_host_timed, host): host
+            for host in hosts
+        }
+
+        ip_info_futures: Dict[
+            Future,
+            Tuple[
+                EnricherJob_Host,
+                Union[ipaddress.IPv4Address, ipaddress.IPv6Address],
+                Optional[str]
+            ]
+        ] = {}
+
+        fetched_prefixes: Dict[
+            Union[ipaddress.IPv4Network, ipaddress.IPv6Network],
+            IPDBInfo
+        ] = {}
+
+        not_done = set(resolve_futures)
+
+        while not_done:
+            done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future in resolve_futures:
+                    host = resolve_futures[future]
+
+                    try:
+                        host_ip, host_name = future.result()
+                    except:  # noqa: E722
+                        self._handle_enrich_host_exception(job, host)
+                        continue
+
+                    ip_info = None
+
+                    if host_ip and host_ip.is_global:
+                        # The IP is looked up in the cache only by the task.
+                        ip_info_future = self.ripestat_executor.submit(
+                            self._get_ip_info_for_ip, host_ip, deadline
+                        )
+                        ip_info_futures[ip_info_future] = (host, host_ip, host_name)
+                        not_done.add(ip_info_future)
+                        continue
+                else:
+                    host, host_ip, host_name = ip_info_futures[future]
+
+                    try:
+                        ip_info, fetched = future.result()
+                    except ExternalSourceUnavailableError:
+                        # The job is completed with what's known so
+                        # far; the host will be updated later.
+                        ip_info_backfiller.add(
+                            host_ip, job.traceroute_id, host.host_id,
+                            self._get_ip_info_from_external_sources
+                        )
+                        ip_info = None
+                    except:  # noqa: E722
+                        LOGGER.exception(
+                            f"Unhandled exception while gathering IP info for {host_ip} "
+                            f"for traceroute {job.traceroute_id}"
+                        )
+                        ip_info = None
+                    else:
+                        if fetched and ip_info:
+                            fetched_prefixes[ip_info.prefix] = ip_info
+
+                self._complete_host_enrichment(
+                    job, host, host_ip, host_name, ip_info
                 )
-                continue
 
-            try:
-                self.emit_host_enriched_event(
-                    job.traceroute_id,
-                    db_host
-                )
-            except:  # noqa: E722
-                LOGGER.exception(
-                    "Unhandled exception while emitting SocketIO "
-                    f"event for traceroute {job.traceroute_id}, hop n. "
-                    f"{host.hop_n}, host_id {host.host_id}"
-                )
+        for ip_info in fetched_prefixes.values():
+            dispatch_ipinfo(ip_info)
 
-        traceroute = Traceroute.get(Traceroute.id == job.traceroute_id)
+        if fetched_prefixes:
+            self._add_ip_info_to_db(list(fetched_prefixes.values()))
+
+        # All the hosts are done at this point.
+        traceroute = load_traceroute(job.traceroute_id)
         traceroute.enriched = True
         traceroute.enrichment_completed = datetime.datetime.utcnow()
         traceroute.save()
@@ -339,42 +560,26 @@ class Enricher(threading.Thread):
 
         return traceroute
 
-    def _load_ip_info_entries_from_db(self):
-        # Load entries from the DB
-        LOGGER.info("Loading IP info entries from DB...")
-
-        with log_execution_time(METRICS, LOGGER, "load_ip_info_entries_from_db"):
-            for db_prefix in IPInfo_Prefix.select():
-                self.add_ip_info_to_local_cache(
-                    db_prefix.to_ipdbinfo(),
-                    last_updated=db_prefix.last_updated,
-                    dispatch_to_others=False
-                )
-
-        LOGGER.info("IP info entries loaded")
-
     def run(self):
-        # Run the function that loads the existing IPInfo
-        # entries from the DB in the next couple of minutes.
-        # The loading of those entries would block the
-        # thread, so let's do it asynchronously.
-        delay = random.randrange(1, 120)
-        thread = threading.Timer(delay, self._load_ip_info_entries_from_db)
-        thread.name = self.name + "-load-entries-from-db"
-        thread.start()
-
         LOGGER.info("Enricher ready to process jobs")
         while True:
-            job = self.queue.get(block=True)
+            item = self.queue.get(block=True)
 
-            if job is None:
+            if item is None:
+                self.hosts_executor.shutdown(wait=False)
                 return
 
+            # The callback is used to let the consumer know
+            # that the job is done.
+            job, on_completed = item
+
             try:
                 self.process_traceroute_enrichment_job(job)
             except:  # noqa: E722
                 LOGGER.exception("Unhandled exception while processing the job "
                                  f"{job.to_json_dict()}")
+            finally:
+                on_completed()
 
     def stop(self):
         self.queue.put(None)
@@ -0,0 +1,232 @@
+from typing import Callable, Dict, Optional, Set, Tuple, Union
+import ipaddress
+import logging
+import threading
+
+import markus
+
+from .dispatcher import dispatch_ipinfo
+from .ip_info_store import ip_info_store
+from .socketio_emitter import get_socketio_emitter
+from ..config import (
+    IP_INFO_BACKFILL_INTERVAL,
+    IP_INFO_BACKFILL_MAX_ATTEMPTS,
+    IP_INFO_BACKFILL_MAX_PENDING
+)
+from ..db import db
+from ..errors import ExternalSourceTransientError, ExternalSourceUnavailableError
+from ..ip_info_db import bulk_upsert
+from ..metrics import log_execution_time, get_tags
+from ..structures import IPDBInfo
+from ..traceroute import Host, Traceroute, load_traceroute
+
+
+LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics(__name__)
+
+backfiller_thread = None
+
+
+IP = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+FetchFunc = Callable[[IP], Optional[IPDBInfo]]
+
+
+class IPInfoBackfiller:
+    """Complete the hosts enriched without querying external sources.
+
+    While external sources are unavailable (see the RIPEstat circuit
+    breaker), traceroutes are enriched using only the IP info that
+    are already known. The IPs whose info couldn't be fetched are
+    kept here, with the hosts they belong to, and a background pass
+    fetches them later and updates those hosts. The completed event
+    of the updated traceroutes is then sent again, so that the
+    pages that are showing them are refreshed.
+
+    Pending IPs are only kept in memory, up to
+    IP_INFO_BACKFILL_MAX_PENDING. When their info can't be fetched
+    because of transient failures they are attempted again by the
+    next passes, up to IP_INFO_BACKFILL_MAX_ATTEMPTS times.
+    """
+
+    def __init__(
+        self,
+        max_pending: int = IP_INFO_BACKFILL_MAX_PENDING,
+        max_attempts: int = IP_INFO_BACKFILL_MAX_ATTEMPTS
+    ):
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+
+        # IP => {(traceroute_id, host_id)}
+        self.pending: Dict[IP, Set[Tuple[str, str]]] = {}
+        # IP => n. of attempts that failed
+        self.failed_attempts: Dict[IP, int] = {}
+        self.fetch: Optional[FetchFunc] = None
+        self.lock = threading.Lock()
+
+    def add(self, ip: IP, traceroute_id: str, host_id: str, fetch: FetchFunc) -> None:
+        with self.lock:
+            if ip not in self.pending and len(self.pending) >= self.max_pending:
+                METRICS.incr("dropped", tags=get_tags())
+                return
+
+            self.pending.setdefault(ip, set()).add((traceroute_id, host_id))
+            self.fetch = fetch
+
+        METRICS.incr("added", tags=get_tags())
+
+    def _get_ip_info(self, ip: IP) -> Optional[IPDBInfo]:
+        # Other jobs may have fetched it in the meantime.
+        ip_info = ip_info_store.lookup(ip)
+        if ip_info:
+            return ip_info
+
+        ip_info = self.fetch(ip)
+
+        if ip_info:
+            ip_info_store.add(ip_info)
+            bulk_upsert([ip_info])
+            dispatch_ipinfo(ip_info)
+
+        return ip_info
+
+    @staticmethod
+    def _update_hosts(hosts: Set[Tuple[str, str]], ip_info: IPDBInfo) -> Set[str]:
+        # Returns the IDs of the traceroutes that were updated.
+        updated: Set[str] = set()
+
+        for traceroute_id, host_id in hosts:
+            with db.atomic():
+                host = Host.get_or_none(Host.id == host_id)
+
+                # The traceroute may be gone in the meantime.
+                if not host:
+                    continue
+
+                host.set_ip_info(ip_info)
+
+            METRICS.incr("hosts_updated", tags=get_tags())
+
+            updated.add(traceroute_id)
+
+        return updated
+
+    @staticmethod
+    def _emit_updated_traceroutes(traceroute_ids: Set[str]) -> None:
+        socketio = get_socketio_emitter()
+
+        for traceroute_id in traceroute_ids:
+            try:
+                traceroute = load_traceroute(traceroute_id)
+            except Traceroute.DoesNotExist:
+                continue
+
+            try:
+                socketio.emit_enrichment_completed(traceroute)
+            except:  # noqa: E722
+                LOGGER.exception(
+                    "Unhandled exception while emitting SocketIO "
+                    f"event for traceroute {traceroute_id}"
+                )
+
+    def _record_failed_attempt(self, ip: IP) -> None:
+        # The IP is kept for the next passes, unless it
+        # already failed too many times.
+        with self.lock:
+            failed_attempts = self.failed_attempts.get(ip, 0) + 1
+
+            if failed_attempts < self.max_attempts:
+                self.failed_attempts[ip] = failed_attempts
+                give_up = False
+            else:
+                self.pending.pop(ip, None)
+                self.failed_attempts.pop(ip, None)
+                give_up = True
+
+        if give_up:
+            METRICS.incr("given_up", tags=get_tags())
+        else:
+            METRICS.incr("failed_attempts", tags=get_tags())
+
+    def run(self) -> int:
+        """Backfill the pending IPs; return the n. of traceroutes updated.
+
+        The pass stops as soon as external sources are
+        unavailable again: the IPs left are processed by
+        the next one.
+        """
+        with self.lock:
+            ips = list(self.pending.keys())
+
+        updated: Set[str] = set()
+
+        for ip in ips:
+            try:
+                ip_info = self._get_ip_info(ip)
+            except ExternalSourceTransientError:
+                self._record_failed_attempt(ip)
+                continue
+            except ExternalSourceUnavailableError:
+                break
+            except:  # noqa: E722
+                LOGGER.exception(f"Unhandled exception while backfilling the IP info for {ip}")
+                self._record_failed_attempt(ip)
+                continue
+
+            with self.lock:
+                hosts = self.pending.pop(ip, set())
+                self.failed_attempts.pop(ip, None)
+
+            if not ip_info:
+                METRICS.incr("not_found", tags=get_tags())
+                continue
+
+            updated |= self._update_hosts(hosts, ip_info)
+
+        self._emit_updated_traceroutes(updated)
+
+        return len(updated)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.pending = {}
+            self.failed_attempts = {}
+            self.fetch = None
+
+
+ip_info_backfiller = IPInfoBackfiller()
+
+
+def backfill_ip_info() -> None:
+    if not ip_info_backfiller.pending:
+        return
+
+    try:
+        with log_execution_time(METRICS, LOGGER, "backfill"):
+            updated = ip_info_backfiller.run()
+    except:  # noqa: E722
+        LOGGER.exception("Unhandled exception while backfilling IP info")
+        return
+
+    METRICS.gauge("pending", len(ip_info_backfiller.pending), tags=get_tags())
+
+    LOGGER.info(
+        f"IP info backfilled for {updated} traceroutes, "
+        f"{len(ip_info_backfiller.pending)} IPs still pending"
+    )
+
+
+def setup_ip_info_backfiller() -> None:
+
+    def _setup_thread(interval: int):
+        global backfiller_thread
+        backfiller_thread = threading.Timer(interval, _run_backfiller)
+        backfiller_thread.name = "IPInfoBackfiller"
+        backfiller_thread.daemon = True
+        backfiller_thread.start()
+
+    def _run_backfiller():
+        backfill_ip_info()
+
+        _setup_thread(IP_INFO_BACKFILL_INTERVAL)
+
+    _setup_thread(IP_INFO_BACKFILL_INTERVAL)
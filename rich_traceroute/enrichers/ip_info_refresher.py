@@ -0,0 +1,117 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, Set, Union
+import ipaddress
+import logging
+import threading
+
+from cachetools import TTLCache
+import markus
+
+from .dispatcher import dispatch_ipinfo
+from .ip_info_store import ip_info_store
+from ..config import (
+    IP_INFO_REFRESH_MAX_CONCURRENT,
+    IP_INFO_REFRESH_RETRY_INTERVAL
+)
+from ..errors import ExternalSourceUnavailableError
+from ..ip_info_db import bulk_upsert
+from ..metrics import log_execution_time, get_tags
+from ..structures import IPDBInfo
+
+
+LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics(__name__)
+
+
+FetchFunc = Callable[
+    [Union[ipaddress.IPv4Address, ipaddress.IPv6Address]],
+    Optional[IPDBInfo]
+]
+
+
+class IPInfoRefresher:
+    """Refresh the IP info of the store in background.
+
+    There's one refresher per process: if more enrichers
+    ask for the same prefix to be refreshed, only one query
+    is performed. Prefixes whose refresh failed are not
+    retried for IP_INFO_REFRESH_RETRY_INTERVAL seconds.
+
+    Refreshed IP info are written to the store, dispatched
+    to the other processes and saved to the DB, like those
+    fetched by the enrichers.
+    """
+
+    def __init__(self, max_workers: int = IP_INFO_REFRESH_MAX_CONCURRENT):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="IPInfoRefresher"
+        )
+
+        self.in_progress: Set[str] = set()
+        self.recently_failed: TTLCache = TTLCache(
+            maxsize=1024, ttl=IP_INFO_REFRESH_RETRY_INTERVAL
+        )
+        self.lock = threading.Lock()
+
+    def schedule(self, ip_info: IPDBInfo, fetch: FetchFunc) -> Optional[Future]:
+        # IXP networks are kept up to date by the
+        # IXPNetworksUpdater.
+        if ip_info.ixp_network:
+            return None
+
+        prefix = str(ip_info.prefix)
+
+        with self.lock:
+            if prefix in self.in_progress:
+                METRICS.incr("coalesced", tags=get_tags())
+                return None
+
+            if prefix in self.recently_failed:
+                return None
+
+            self.in_progress.add(prefix)
+
+        METRICS.incr("scheduled", tags=get_tags())
+
+        return self.executor.submit(self._refresh, ip_info, fetch)
+
+    def _refresh(self, ip_info: IPDBInfo, fetch: FetchFunc) -> Optional[IPDBInfo]:
+        prefix = str(ip_info.prefix)
+
+        new_ip_info = None
+
+        try:
+            with log_execution_time(METRICS, LOGGER, "refresh", prefix):
+                new_ip_info = fetch(ip_info.prefix.network_address)
+
+            if new_ip_info:
+                # If the prefix changed, the old one is not used
+                # anymore: IPs it covers will get their info
+                # from the new one or from external sources.
+                if new_ip_info.prefix != ip_info.prefix:
+                    ip_info_store.delete(prefix)
+
+                ip_info_store.add(new_ip_info)
+                bulk_upsert([new_ip_info])
+                dispatch_ipinfo(new_ip_info)
+        except ExternalSourceUnavailableError:
+            # The expired entry is used until the next attempt.
+            new_ip_info = None
+        except:  # noqa: E722
+            LOGGER.exception(
+                f"Unhandled exception while refreshing the IP info for {prefix}"
+            )
+            new_ip_info = None
+
+        with self.lock:
+            self.in_progress.discard(prefix)
+
+            if not new_ip_info:
+                METRICS.incr("failed", tags=get_tags())
+                self.recently_failed[prefix] = True
+
+        return new_ip_info
+
+
+ip_info_refresher = IPInfoRefresher()
@@ -0,0 +1,487 @@
+from typing import Callable, List, Optional, Tuple, Union
+import atexit
+import datetime
+import heapq
+import ipaddress
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+import radix
+import markus
+
+from ..config import (
+    IP_INFO_EXPIRY,
+    IP_INFO_LOAD_BATCH_SIZE,
+    IP_INFO_MAX_STALENESS,
+    IP_INFO_REFRESH_AHEAD,
+    IP_INFO_REFRESH_AHEAD_MIN_HITS,
+    IP_INFO_SNAPSHOT_INTERVAL,
+    IP_INFO_SWEEP_INTERVAL,
+    IP_INFO_SWEEP_BATCH_SIZE
+)
+from ..ip_info_db import iter_ip_info_entries
+from ..metrics import log_execution_time, get_tags
+from ..structures import IPDBInfo, IXPNetwork
+
+
+LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics(__name__)
+
+# Snapshot file format: header (magic, version, n. of entries)
+# followed by the zlib-compressed JSON list of the entries.
+# Files whose version doesn't match are ignored.
+SNAPSHOT_MAGIC = b"RTIPINFO"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("!8sHI")
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+snapshot_thread: Optional[threading.Timer] = None
+sweeper_thread: Optional[threading.Timer] = None
+
+
+class IPInfoStore:
+    """Process-wide store of the IP info, shared by all the enrichers.
+
+    Lookups don't acquire any lock: each py-radix call runs
+    entirely while holding the GIL, so a lookup never sees a
+    tree that is being modified. Writers are serialized by
+    'write_lock'.
+
+    Entries are also indexed by their 'last_updated' in a
+    min-heap, used by 'sweep' to find the expired ones without
+    walking the whole tree. The heap is not updated when an
+    entry is replaced or deleted: its items are checked against
+    the tree when they are popped.
+    """
+
+    def __init__(self):
+        self.radix = radix.Radix()
+        self.write_lock = threading.Lock()
+
+        self.expiry_index: List[Tuple[datetime.datetime, str]] = []
+
+        self.load_lock = threading.Lock()
+        self.loaded = False
+
+    def add(
+        self,
+        ip_info: IPDBInfo,
+        last_updated: Optional[datetime.datetime] = None
+    ) -> None:
+        with self.write_lock:
+            self._add(ip_info, last_updated or datetime.datetime.utcnow())
+
+    def add_many(
+        self,
+        ip_infos: List[IPDBInfo],
+        last_updated: Optional[datetime.datetime] = None
+    ) -> None:
+        # The lock is acquired once for all the entries.
+        last_updated = last_updated or datetime.datetime.utcnow()
+
+        with self.write_lock:
+            for ip_info in ip_infos:
+                self._add(ip_info, last_updated)
+
+    def _add(self, ip_info: IPDBInfo, last_updated: datetime.datetime) -> None:
+        # The caller must hold 'write_lock'.
+        node = self.radix.add(str(ip_info.prefix))
+        node.data["ip_db_info"] = ip_info
+        node.data["last_updated"] = last_updated
+        node.data["hits"] = 0
+
+        heapq.heappush(self.expiry_index, (last_updated, node.prefix))
+
+    def _delete(self, node) -> None:
+        # The caller must hold 'write_lock'.
+        # py-radix doesn't touch the data of deleted nodes: they
+        # are cleared here, so that lookups that found the node
+        # before it was deleted don't use them.
+        node.data.clear()
+        self.radix.delete(node.prefix)
+
+    def delete(self, prefix: str) -> None:
+        with self.write_lock:
+            node = self.radix.search_exact(prefix)
+            if node:
+                self._delete(node)
+
+    def lookup(
+        self,
+        ip: Union[ipaddress.IPv4Address, ipaddress.IPv6Address],
+        refresh: Optional[Callable[[IPDBInfo], None]] = None
+    ) -> Optional[IPDBInfo]:
+        """Return the IP info of the prefix that covers 'ip'.
+
+        If 'refresh' is given, expired entries are still returned
+        for IP_INFO_MAX_STALENESS, and 'refresh' is called to get
+        them updated; it's called also for entries that are about
+        to expire and that are used frequently.
+        """
+        node = self.radix.search_best(str(ip))
+
+        if not node:
+            return None
+
+        # The node's data are cleared when it's deleted (see
+        # _delete), which may happen in the meantime.
+        ip_db_info = node.data.get("ip_db_info")
+        last_updated = node.data.get("last_updated")
+
+        if not ip_db_info or not last_updated:
+            return None
+
+        age = datetime.datetime.utcnow() - last_updated
+
+        if age > IP_INFO_EXPIRY:
+            if refresh and age <= IP_INFO_EXPIRY + IP_INFO_MAX_STALENESS:
+                METRICS.incr("stale_hits", tags=get_tags())
+                refresh(ip_db_info)
+                return ip_db_info
+
+            # If the entry is expired, let's remove it.
+            with self.write_lock:
+                if self.radix.search_exact(node.prefix) is node:
+                    self._delete(node)
+            return None
+
+        if refresh and age > IP_INFO_EXPIRY - IP_INFO_REFRESH_AHEAD:
+            # Not atomic, but an approximate count is enough.
+            hits = node.data.get("hits", 0) + 1
+            node.data["hits"] = hits
+
+            if hits >= IP_INFO_REFRESH_AHEAD_MIN_HITS:
+                METRICS.incr("refresh_ahead", tags=get_tags())
+                node.data["hits"] = 0
+                refresh(ip_db_info)
+
+        return ip_db_info
+
+    def _sweep_batch(
+        self,
+        min_last_updated: datetime.datetime,
+        batch_size: int
+    ) -> Tuple[int, bool]:
+        # Returns the n. of evicted entries and whether
+        # there may be more of them.
+        evicted = 0
+
+        with self.write_lock:
+            for _ in range(batch_size):
+                if not self.expiry_index or \
+                        self.expiry_index[0][0] >= min_last_updated:
+                    return evicted, False
+
+                last_updated, prefix = heapq.heappop(self.expiry_index)
+
+                node = self.radix.search_exact(prefix)
+
+                # The entry has been updated or deleted
+                # after this item was added to the heap.
+                if not node or node.data.get("last_updated") != last_updated:
+                    continue
+
+                self._delete(node)
+                evicted += 1
+
+        return evicted, True
+
+    def _compact_expiry_index(self) -> None:
+        # Items of replaced entries pile up in the heap:
+        # when they are too many, it's rebuilt.
+        with self.write_lock:
+            nodes = self.radix.nodes()
+
+            if len(self.expiry_index) <= 2 * len(nodes):
+                return
+
+            self.expiry_index = [
+                (node.data["last_updated"], node.prefix)
+                for node in nodes
+                if node.data.get("last_updated")
+            ]
+            heapq.heapify(self.expiry_index)
+
+    def sweep(self, batch_size: int = IP_INFO_SWEEP_BATCH_SIZE) -> int:
+        """Remove the entries that can't be used anymore.
+
+        Entries are removed in batches of 'batch_size': the
+        write lock is released between them, so writers are
+        not blocked for long (lookups are never blocked).
+
+        Returns the n. of entries that have been removed.
+        """
+        # Expired entries are still used while they are
+        # refreshed, see 'lookup'.
+        min_last_updated = datetime.datetime.utcnow() - \
+            IP_INFO_EXPIRY - IP_INFO_MAX_STALENESS
+
+        res = 0
+
+        while True:
+            evicted, more = self._sweep_batch(min_last_updated, batch_size)
+            res += evicted
+
+            if not more:
+                break
+
+        self._compact_expiry_index()
+
+        return res
+
+    def _add_many_if_newer(self, entries: List[Tuple[IPDBInfo, datetime.datetime]]) -> None:
+        # The lock is acquired once for all the entries, and it's
+        # held between the check and the update, so that entries
+        # added by the enrichers in the meantime, which are more
+        # recent than the DB ones, are never replaced.
+        with self.write_lock:
+            for ip_info, last_updated in entries:
+                node = self.radix.search_exact(str(ip_info.prefix))
+                if node and node.data.get("last_updated") and \
+                        node.data["last_updated"] >= last_updated:
+                    continue
+
+                self._add(ip_info, last_updated)
+
+    def load_from_db(self, batch_size: int = IP_INFO_LOAD_BATCH_SIZE) -> None:
+        # Entries are loaded only once, no matter how
+        # many enrichers are running in the process.
+        with self.load_lock:
+            if self.loaded:
+                return
+
+            LOGGER.info("Loading IP info entries from DB...")
+
+            cnt = 0
+
+            with log_execution_time(METRICS, LOGGER, "load_ip_info_entries_from_db") as timing:
+                batch: List[Tuple[IPDBInfo, datetime.datetime]] = []
+
+                for entry in iter_ip_info_entries():
+                    cnt += 1
+
+                    batch.append(entry)
+
+                    if len(batch) >= batch_size:
+                        self._add_many_if_newer(batch)
+                        batch = []
+
+                if batch:
+                    self._add_many_if_newer(batch)
+
+            self.loaded = True
+
+            duration = timing.stop - timing.start
+            rate = round(cnt / duration) if duration else cnt
+
+            METRICS.gauge("load_ip_info_entries_from_db.entries", cnt, tags=get_tags())
+            METRICS.gauge("load_ip_info_entries_from_db.rate", rate, tags=get_tags())
+
+            LOGGER.info(
+                f"{cnt} IP info entries loaded ({rate} entries/s)"
+            )
+
+    def write_snapshot(self, path: str) -> int:
+        """Save all the non-expired entries to 'path'.
+
+        Returns the n. of entries that have been saved.
+        """
+        min_last_updated = datetime.datetime.utcnow() - IP_INFO_EXPIRY
+
+        entries = []
+
+        for node in self.radix.nodes():
+            ip_db_info = node.data.get("ip_db_info")
+            last_updated = node.data.get("last_updated")
+
+            if not ip_db_info or not last_updated:
+                continue
+
+            if last_updated < min_last_updated:
+                continue
+
+            ixp_network = ip_db_info.ixp_network
+
+            entries.append([
+                node.prefix,
+                (last_updated - EPOCH).total_seconds(),
+                ip_db_info.origins,
+                list(ixp_network) if ixp_network else None
+            ])
+
+        data = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(entries)
+        ) + zlib.compress(
+            json.dumps(entries, separators=(",", ":")).encode()
+        )
+
+        # Readers never see a partially written file. The temporary
+        # file is unique, since the periodic writer and the one
+        # that runs at exit may be writing at the same time.
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=f"{os.path.basename(path)}.",
+            suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except:  # noqa: E722
+            os.unlink(tmp_path)
+            raise
+
+        return len(entries)
+
+    def load_snapshot(self, path: str) -> int:
+        """Add to the store the entries saved to 'path'.
+
+        Returns the n. of entries that have been loaded.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("Snapshot file is too short")
+
+        magic, version, cnt = SNAPSHOT_HEADER.unpack_from(data)
+
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a snapshot file")
+
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(
+                f"Unsupported snapshot version {version}, "
+                f"expected {SNAPSHOT_VERSION}"
+            )
+
+        entries = json.loads(
+            zlib.decompress(data[SNAPSHOT_HEADER.size:])
+        )
+
+        if len(entries) != cnt:
+            raise ValueError(
+                f"Snapshot is corrupted: {len(entries)} entries "
+                f"found, {cnt} expected"
+            )
+
+        min_last_updated = datetime.datetime.utcnow() - IP_INFO_EXPIRY
+
+        res = 0
+
+        for prefix, last_updated_ts, origins, ixp_network in entries:
+            last_updated = EPOCH + datetime.timedelta(seconds=last_updated_ts)
+
+            if last_updated < min_last_updated:
+                continue
+
+            self.add(
+                IPDBInfo(
+                    prefix=ipaddress.ip_network(prefix),
+                    origins=[
+                        (int(asn), holder) for asn, holder in origins
+                    ] if origins is not None else None,
+                    ixp_network=IXPNetwork(*ixp_network) if ixp_network else None
+                ),
+                last_updated=last_updated
+            )
+            res += 1
+
+        return res
+
+    def reset(self) -> None:
+        with self.load_lock, self.write_lock:
+            self.radix = radix.Radix()
+            self.expiry_index = []
+            self.loaded = False
+
+
+ip_info_store = IPInfoStore()
+
+
+def load_ip_info_store_snapshot(path: str) -> None:
+    if not os.path.exists(path):
+        LOGGER.info(f"IP info snapshot not found at {path}")
+        return
+
+    try:
+        with log_execution_time(METRICS, LOGGER, "load_ip_info_store_snapshot"):
+            cnt = ip_info_store.load_snapshot(path)
+    except:  # noqa: E722
+        LOGGER.exception(
+            f"Unhandled exception while loading the IP info snapshot from {path}"
+        )
+        return
+
+    LOGGER.info(f"{cnt} IP info entries loaded from the snapshot {path}")
+
+
+def write_ip_info_store_snapshot(path: str) -> None:
+    try:
+        with log_execution_time(METRICS, LOGGER, "write_ip_info_store_snapshot"):
+            cnt = ip_info_store.write_snapshot(path)
+    except:  # noqa: E722
+        LOGGER.exception(
+            f"Unhandled exception while writing the IP info snapshot to {path}"
+        )
+        return
+
+    LOGGER.info(f"{cnt} IP info entries saved to the snapshot {path}")
+
+
+def setup_ip_info_store_snapshots(path: str) -> None:
+
+    def _setup_thread(interval: int):
+        global snapshot_thread
+        snapshot_thread = threading.Timer(interval, _run_writer)
+        snapshot_thread.name = "IPInfoSnapshotWriter"
+        snapshot_thread.daemon = True
+        snapshot_thread.start()
+
+    def _run_writer():
+        write_ip_info_store_snapshot(path)
+
+        _setup_thread(IP_INFO_SNAPSHOT_INTERVAL)
+
+    _setup_thread(IP_INFO_SNAPSHOT_INTERVAL)
+
+    # Save the most recent entries when the worker stops.
+    atexit.register(write_ip_info_store_snapshot, path)
+
+
+def sweep_ip_info_store() -> None:
+    try:
+        with log_execution_time(METRICS, LOGGER, "sweep"):
+            evicted = ip_info_store.sweep()
+    except:  # noqa: E722
+        LOGGER.exception("Unhandled exception while sweeping the IP info store")
+        return
+
+    METRICS.incr("sweep.evicted", evicted, tags=get_tags())
+    METRICS.gauge("size", len(ip_info_store.radix.nodes()), tags=get_tags())
+    METRICS.gauge("expiry_index_size", len(ip_info_store.expiry_index), tags=get_tags())
+
+    LOGGER.info(f"{evicted} expired IP info entries removed from the store")
+
+
+def setup_ip_info_store_sweeper() -> None:
+
+    def _setup_thread(interval: int):
+        global sweeper_thread
+        sweeper_thread = threading.Timer(interval, _run_sweeper)
+        sweeper_thread.name = "IPInfoStoreSweeper"
+        sweeper_thread.daemon = True
+        sweeper_thread.start()
+
+    def _run_sweeper():
+        sweep_ip_info_store()
+
+        _setup_thread(IP_INFO_SWEEP_INTERVAL)
+
+    _setup_thread(IP_INFO_SWEEP_INTERVAL)
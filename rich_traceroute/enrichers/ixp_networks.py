@@ -1,7 +1,8 @@
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 import ipaddress
 import logging
 import threading
+import time
 
 import requests
 import markus
@@ -9,10 +10,13 @@ from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
 
 
-from .consumer import ConsumerThread
-from ..config import IXP_NETWORKS_UPDATE_INTERVAL
+from .ip_info_store import ip_info_store
+from ..config import (
+    IXP_NETWORKS_UPDATE_INTERVAL,
+    IXP_NETWORKS_FULL_SYNC_INTERVAL
+)
 from ..structures import IPDBInfo, IXPNetwork
-from ..ip_info_db import IPInfo_Prefix
+from ..ip_info_db import bulk_delete, bulk_upsert
 from ..metrics import log_execution_time, get_tags
 
 
@@ -48,7 +52,8 @@ class PeeringDB:
             timeout=30
         )
 
-    def query(self, url: str) -> List[dict]:
+    def query(self, url: str) -> Optional[List[dict]]:
+        """Return the 'data' list of the response, or None on errors."""
         try:
             response = self._get(url)
         except:  # noqa: E722
@@ -56,7 +61,7 @@ class PeeringDB:
                 f"PeeringDB query for {url} failed."
             )
             METRICS.incr("peeringdb.http_errors", tags=get_tags())
-            return []
+            return None
 
         try:
             response.raise_for_status()
@@ -65,70 +70,77 @@ class PeeringDB:
                 f"PeeringDB query for {url} failed."
             )
             METRICS.incr("peeringdb.http_errors", tags=get_tags())
-            return []
+            return None
 
         return response.json()["data"]
 
 
 class IXPNetworksUpdater:
+    """Keep the IXP networks in sync with PeeringDB.
 
-    def __init__(self, consumers: List[ConsumerThread] = []):
-        self.consumers = consumers
+    The first run (and then one every IXP_NETWORKS_FULL_SYNC_INTERVAL
+    seconds) downloads all the PeeringDB objects and writes all the
+    IXP prefixes. The other runs only ask PeeringDB for the objects
+    changed since the last successful sync, and only the prefixes
+    whose IXP network is different (or that are gone) are written
+    to the DB and to the IP info store.
+    """
 
-    @staticmethod
-    def _lookup_ix_lans(ixlan_data: List[dict], ix_id: int) -> List[dict]:
-        res = []
+    def __init__(self):
+        # PeeringDB objects known after the last sync, by ID.
+        # Changes are applied to them, so that the IXP networks
+        # can be rebuilt also when only some of the objects
+        # they are made of changed.
+        self.pdb_ix: Dict[int, dict] = {}
+        self.pdb_ixlan: Dict[int, dict] = {}
+        self.pdb_ixpfx: Dict[int, dict] = {}
 
-        for lan in ixlan_data:
-            if lan["ix_id"] == ix_id:
-                res.append(lan)
+        # The IP info built from the objects above, by prefix.
+        self.ip_infos: Dict[str, IPDBInfo] = {}
 
-        return res
+        # Unix timestamps of the last successful syncs.
+        self.last_sync: Optional[int] = None
+        self.last_full_sync: Optional[int] = None
 
     @staticmethod
-    def _lookup_ix_lan_prefixes(ix_prefixes_data: List[dict], ix_lan_id: int) -> List[dict]:
-        res = []
-
-        for prefix in ix_prefixes_data:
-            if prefix["ixlan_id"] == ix_lan_id:
-                res.append(prefix)
+    def _merge_changes(
+        current: Dict[int, dict],
+        changes: List[dict]
+    ) -> Dict[int, dict]:
+        res = dict(current)
+
+        for item in changes:
+            # When 'since' is used, PeeringDB returns the
+            # deleted objects too.
+            if item.get("status", "ok") == "ok":
+                res[int(item["id"])] = item
+            else:
+                res.pop(int(item["id"]), None)
 
         return res
 
-    def update_ixp_networks(self) -> None:
-        with log_execution_time(METRICS, LOGGER, "_build_ixp_networks"):
-            self._build_ixp_networks()
-
-    def _dispatch_ip_info(self, ip_info: IPDBInfo) -> None:
-        for consumer in self.consumers:
-            for enricher in consumer.enrichers:
-                enricher.add_ip_info_to_local_cache(ip_info, False)
-
-    def _save_ip_info_to_db(self, ip_info: IPDBInfo) -> None:
-        try:
-            IPInfo_Prefix.create_from_ipdbinfo(ip_info)
-        except:  # noqa: E722
-            LOGGER.exception(
-                "Unhandled exception while creating the ip_info "
-                f"DB record for {ip_info.prefix}"
-            )
-
     @staticmethod
-    def _peeringdb_query(http_session, url) -> List[dict]:
-        return http_session.get(url, timeout=30).json()["data"]
+    def _index_by(data: List[dict], key: str) -> Dict[int, List[dict]]:
+        res: Dict[int, List[dict]] = {}
 
-    def _build_ixp_networks(self):
+        for item in data:
+            res.setdefault(int(item[key]), []).append(item)
 
-        pdb = PeeringDB()
+        return res
 
-        with log_execution_time(METRICS, LOGGER, "peeringdb.pdb_ix_data"):
-            pdb_ix_data: List[dict] = pdb.query(PEERINGDB_API_IX)
+    def _get_ip_infos(
+        self,
+        pdb_ix_data: List[dict],
+        pdb_ixlan_data: List[dict],
+        pdb_ix_prefixes: List[dict]
+    ) -> List[IPDBInfo]:
 
-        with log_execution_time(METRICS, LOGGER, "peeringdb.pdb_ixlan_data"):
-            pdb_ixlan_data: List[dict] = pdb.query(PEERINGDB_API_IXLAN)
+        # Indexes used to look up the LANs of each IX and
+        # the prefixes of each LAN, built in one pass.
+        ix_lans_by_ix_id = self._index_by(pdb_ixlan_data, "ix_id")
+        ix_prefixes_by_ix_lan_id = self._index_by(pdb_ix_prefixes, "ixlan_id")
 
-        with log_execution_time(METRICS, LOGGER, "peeringdb.pdb_ix_prefixes"):
-            pdb_ix_prefixes: List[dict] = pdb.query(PEERINGDB_API_IXPFX)
+        res: List[IPDBInfo] = []
 
         ix_lan_cnt = 0
 
@@ -137,48 +149,212 @@ class IXPNetworksUpdater:
             ix_name: Optional[str] = ix["name"] or None
             ix_description: Optional[str] = ix["name_long"] or None
 
-            ix_lans = self._lookup_ix_lans(pdb_ixlan_data, ix_id)
-
-            for ix_lan in ix_lans:
+            for ix_lan in ix_lans_by_ix_id.get(ix_id, []):
                 ix_lan_cnt += 1
 
                 ix_lan_id: int = int(ix_lan["id"])
                 ix_lan_name: Optional[str] = ix_lan["name"] or None
 
-                ix_lan_prefixes = self._lookup_ix_lan_prefixes(pdb_ix_prefixes, ix_lan_id)
-
-                for ix_prefix in ix_lan_prefixes:
-                    prefix = ipaddress.ip_network(ix_prefix["prefix"])
-
-                    ip_info = IPDBInfo(
-                        prefix=prefix,
-                        origins=None,
-                        ixp_network=IXPNetwork(
-                            lan_name=ix_lan_name,
-                            ix_name=ix_name,
-                            ix_description=ix_description
+                ixp_network = IXPNetwork(
+                    lan_name=ix_lan_name,
+                    ix_name=ix_name,
+                    ix_description=ix_description
+                )
+
+                for ix_prefix in ix_prefixes_by_ix_lan_id.get(ix_lan_id, []):
+                    res.append(
+                        IPDBInfo(
+                            prefix=ipaddress.ip_network(ix_prefix["prefix"]),
+                            origins=None,
+                            ixp_network=ixp_network
                         )
                     )
 
-                    self._save_ip_info_to_db(ip_info)
+        LOGGER.info(f"{ix_lan_cnt} IXP networks processed")
 
-                    try:
-                        self._dispatch_ip_info(ip_info)
-                    except:  # noqa: E722
-                        LOGGER.exception(
-                            "Unhandled exception while dispatching the ip_info "
-                            f"record for {ip_info.prefix}. Aborting the execution "
-                            "of IXPNetworksUpdater"
-                        )
-                        return
+        return res
 
-                if ix_lan_cnt % 100 == 0:
-                    LOGGER.info(f"{ix_lan_cnt} IXP networks processed")
+    def update_ixp_networks(self) -> None:
+        if self.last_full_sync is None or \
+                time.time() - self.last_full_sync >= IXP_NETWORKS_FULL_SYNC_INTERVAL:
+            with log_execution_time(METRICS, LOGGER, "_build_ixp_networks"):
+                self._build_ixp_networks()
+        else:
+            with log_execution_time(METRICS, LOGGER, "_update_ixp_networks"):
+                self._update_ixp_networks()
 
-        LOGGER.info(f"{ix_lan_cnt} IXP networks processed")
+    def _dispatch_ip_info(self, ip_info: IPDBInfo) -> None:
+        # The store is shared by all the enrichers of the process.
+        ip_info_store.add(ip_info)
 
+    def _remove_ip_info(self, prefix: str) -> None:
+        ip_info_store.delete(prefix)
 
-def setup_ixp_networks_updater(consumers: List[ConsumerThread]):
+    def _save_ip_info_to_db(self, ip_infos: List[IPDBInfo]) -> bool:
+        try:
+            with log_execution_time(METRICS, LOGGER, "save_ip_info_to_db",
+                                    f"{len(ip_infos)} prefixes"):
+                bulk_upsert(ip_infos)
+        except:  # noqa: E722
+            LOGGER.exception(
+                "Unhandled exception while creating the ip_info "
+                f"DB records for {len(ip_infos)} IXP prefixes"
+            )
+            return False
+
+        return True
+
+    def _delete_ip_info_from_db(self, prefixes: List[str]) -> bool:
+        try:
+            with log_execution_time(METRICS, LOGGER, "delete_ip_info_from_db",
+                                    f"{len(prefixes)} prefixes"):
+                bulk_delete(prefixes)
+        except:  # noqa: E722
+            LOGGER.exception(
+                "Unhandled exception while deleting the ip_info "
+                f"DB records for {len(prefixes)} IXP prefixes"
+            )
+            return False
+
+        return True
+
+    @staticmethod
+    def _peeringdb_query(http_session, url) -> List[dict]:
+        return http_session.get(url, timeout=30).json()["data"]
+
+    def _fetch_peeringdb_data(
+        self,
+        since: Optional[int] = None
+    ) -> Optional[Tuple[List[dict], List[dict], List[dict]]]:
+
+        pdb = PeeringDB()
+
+        res = []
+
+        for name, url in (
+            ("pdb_ix_data", PEERINGDB_API_IX),
+            ("pdb_ixlan_data", PEERINGDB_API_IXLAN),
+            ("pdb_ix_prefixes", PEERINGDB_API_IXPFX),
+        ):
+            if since is not None:
+                url = f"{url}?since={since}"
+
+            with log_execution_time(METRICS, LOGGER, f"peeringdb.{name}"):
+                data = pdb.query(url)
+
+            # Partial data can't be used: they would make
+            # the prefixes of the missing objects look deleted.
+            if data is None:
+                return None
+
+            res.append(data)
+
+        return res[0], res[1], res[2]
+
+    def _apply_changes(
+        self,
+        ip_infos: List[IPDBInfo],
+        removed_prefixes: List[str]
+    ) -> bool:
+
+        for n, ip_info in enumerate(ip_infos):
+            try:
+                self._dispatch_ip_info(ip_info)
+            except:  # noqa: E722
+                LOGGER.exception(
+                    "Unhandled exception while dispatching the ip_info "
+                    f"record for {ip_info.prefix}. Aborting the execution "
+                    "of IXPNetworksUpdater"
+                )
+                self._save_ip_info_to_db(ip_infos[:n])
+                return False
+
+        # All the records are written to the DB at once.
+        if ip_infos and not self._save_ip_info_to_db(ip_infos):
+            return False
+
+        if removed_prefixes:
+            for prefix in removed_prefixes:
+                self._remove_ip_info(prefix)
+
+            if not self._delete_ip_info_from_db(removed_prefixes):
+                return False
+
+        return True
+
+    def _sync(self, since: Optional[int]) -> None:
+        sync_started = int(time.time())
+
+        data = self._fetch_peeringdb_data(since)
+
+        if data is None:
+            LOGGER.error(
+                "Can't retrieve the PeeringDB data, "
+                "IXP networks not updated"
+            )
+            return
+
+        pdb_ix = self._merge_changes(self.pdb_ix, data[0])
+        pdb_ixlan = self._merge_changes(self.pdb_ixlan, data[1])
+        pdb_ixpfx = self._merge_changes(self.pdb_ixpfx, data[2])
+
+        with log_execution_time(METRICS, LOGGER, "_get_ip_infos", record_memory=True):
+            ip_infos = {
+                str(ip_info.prefix): ip_info
+                for ip_info in self._get_ip_infos(
+                    list(pdb_ix.values()),
+                    list(pdb_ixlan.values()),
+                    list(pdb_ixpfx.values())
+                )
+            }
+
+        if since is None:
+            # Unchanged prefixes are written too, so
+            # that they don't expire.
+            changed = list(ip_infos.values())
+        else:
+            changed = [
+                ip_info
+                for prefix, ip_info in ip_infos.items()
+                if self.ip_infos.get(prefix) != ip_info
+            ]
+
+        removed = [
+            prefix for prefix in self.ip_infos
+            if prefix not in ip_infos
+        ]
+
+        sync_type = "full_sync" if since is None else "delta_sync"
+
+        METRICS.gauge(f"{sync_type}.changed", len(changed), tags=get_tags())
+        METRICS.gauge(f"{sync_type}.removed", len(removed), tags=get_tags())
+
+        LOGGER.info(
+            f"IXP networks {sync_type.replace('_', ' ')}: "
+            f"{len(changed)} prefixes changed, {len(removed)} removed"
+        )
+
+        if not self._apply_changes(changed, removed):
+            # The next run will retry from the previous sync.
+            return
+
+        self.pdb_ix = pdb_ix
+        self.pdb_ixlan = pdb_ixlan
+        self.pdb_ixpfx = pdb_ixpfx
+        self.ip_infos = ip_infos
+
+        self.last_sync = sync_started
+        if since is None:
+            self.last_full_sync = sync_started
+
+    def _build_ixp_networks(self):
+        self._sync(since=None)
+
+    def _update_ixp_networks(self):
+        self._sync(since=self.last_sync)
+
+
+def setup_ixp_networks_updater():
 
     def _setup_thread(interval: int):
         global thread
@@ -186,10 +362,13 @@ def setup_ixp_networks_updater(consumers: List[ConsumerThread]):
         thread.name = "IXPNetworksUpdater"
         thread.start()
 
+    # The same updater is used by all the runs, since it
+    # keeps track of the last sync.
+    updater = IXPNetworksUpdater()
+
     def _run_updater():
         try:
             LOGGER.info("Running the IXP networks updater")
-            updater = IXPNetworksUpdater(consumers)
             updater.update_ixp_networks()
             LOGGER.info("IXP networks updater completed")
         except:  # noqa: E722
@@ -0,0 +1,245 @@
+from __future__ import annotations
+from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+import requests
+import markus
+from requests.adapters import HTTPAdapter
+
+from .throttling import CircuitBreaker, TokenBucket
+from ..config import (
+    IP_INFO_REFRESH_MAX_CONCURRENT,
+    RIPESTAT_CIRCUIT_BREAKER_RESET_TIMEOUT,
+    RIPESTAT_CIRCUIT_BREAKER_THRESHOLD,
+    RIPESTAT_CONNECT_TIMEOUT,
+    RIPESTAT_MAX_CONCURRENT_QUERIES,
+    RIPESTAT_MAX_RETRIES,
+    RIPESTAT_MIN_TIMEOUT,
+    RIPESTAT_RATE_LIMIT,
+    RIPESTAT_RATE_LIMIT_BURST,
+    RIPESTAT_RATE_LIMIT_MIN,
+    RIPESTAT_READ_TIMEOUT,
+    RIPESTAT_RETRY_BACKOFF,
+    get_total_enrichers
+)
+from ..errors import ExternalSourceUnavailableError
+from ..metrics import get_tags
+
+
+LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics(__name__)
+
+# Responses with these status codes are retried.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+ripestat_client: Optional[RIPEstatClient] = None
+ripestat_client_lock = threading.Lock()
+
+ripestat_executor: Optional[ThreadPoolExecutor] = None
+ripestat_executor_lock = threading.Lock()
+
+# Shared by all the enrichers of the process; see
+# Enricher._get_ip_info_from_external_sources.
+ripestat_circuit_breaker = CircuitBreaker(
+    "ripestat",
+    failure_threshold=RIPESTAT_CIRCUIT_BREAKER_THRESHOLD,
+    reset_timeout=RIPESTAT_CIRCUIT_BREAKER_RESET_TIMEOUT
+)
+
+
+class RIPEstatClient:
+    """HTTP client used by all the enrichers to query RIPEstat.
+
+    One pool of keep-alive connections is shared by the whole
+    process; its size should match the max n. of concurrent
+    queries, so that connections are reused. When more queries
+    than that are in flight, the extra connections are closed
+    after use: this is reported by the 'pool.saturated' metric.
+
+    When a deadline is given (time.monotonic() based), timeouts
+    are reduced to fit in the time that's left, and no retries
+    are attempted once it's expired. Anyway, at least one attempt
+    with RIPESTAT_MIN_TIMEOUT is always made.
+
+    If a rate limiter is given, a token is needed for every
+    attempt; when no tokens are available before the deadline,
+    ExternalSourceUnavailableError is raised. The rate is lowered
+    when RIPEstat responds with HTTP 429.
+    """
+
+    def __init__(
+        self,
+        pool_size: int,
+        connect_timeout: float = RIPESTAT_CONNECT_TIMEOUT,
+        read_timeout: float = RIPESTAT_READ_TIMEOUT,
+        max_retries: int = RIPESTAT_MAX_RETRIES,
+        retry_backoff: float = RIPESTAT_RETRY_BACKOFF,
+        rate_limiter: Optional[TokenBucket] = None
+    ):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.rate_limiter = rate_limiter
+
+        # Retries are handled here, to take the deadline into account.
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=0
+        )
+
+        self.http_session = requests.Session()
+        self.http_session.mount("https://", adapter)
+        self.http_session.mount("http://", adapter)
+
+        self.in_use = 0
+        self.in_use_lock = threading.Lock()
+
+    def _get_timeouts(self, deadline: Optional[float]) -> Tuple[float, float]:
+        if deadline is None:
+            return self.connect_timeout, self.read_timeout
+
+        remaining = deadline - time.monotonic()
+
+        return (
+            max(RIPESTAT_MIN_TIMEOUT, min(self.connect_timeout, remaining)),
+            max(RIPESTAT_MIN_TIMEOUT, min(self.read_timeout, remaining))
+        )
+
+    def _can_retry(self, attempt: int, backoff: float, deadline: Optional[float]) -> bool:
+        if attempt >= self.max_retries:
+            return False
+
+        if deadline is None:
+            return True
+
+        return time.monotonic() + backoff + RIPESTAT_MIN_TIMEOUT < deadline
+
+    def _acquire_token(self, url: str, deadline: Optional[float]) -> None:
+        if not self.rate_limiter:
+            return
+
+        timeout = None
+        if deadline is not None:
+            timeout = max(RIPESTAT_MIN_TIMEOUT, deadline - time.monotonic())
+
+        if not self.rate_limiter.acquire(timeout):
+            raise ExternalSourceUnavailableError(
+                f"RIPEstat query {url} not sent: rate limit exceeded"
+            )
+
+    def _get_once(self, url: str, deadline: Optional[float]) -> requests.Response:
+        self._acquire_token(url, deadline)
+
+        with self.in_use_lock:
+            self.in_use += 1
+            in_use = self.in_use
+
+        METRICS.gauge("pool.in_use", in_use, tags=get_tags())
+
+        if in_use > self.pool_size:
+            METRICS.incr("pool.saturated", tags=get_tags())
+
+        start = time.perf_counter()
+
+        try:
+            return self.http_session.get(url, timeout=self._get_timeouts(deadline))
+        finally:
+            METRICS.histogram(
+                "latency", 1000 * (time.perf_counter() - start), tags=get_tags()
+            )
+
+            with self.in_use_lock:
+                self.in_use -= 1
+
+    def get(self, url: str, deadline: Optional[float] = None) -> requests.Response:
+        attempt = 0
+
+        while True:
+            backoff = self.retry_backoff * 2 ** attempt
+
+            try:
+                response = self._get_once(url, deadline)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if isinstance(e, requests.Timeout):
+                    METRICS.incr("timeouts", tags=get_tags())
+
+                if not self._can_retry(attempt, backoff, deadline):
+                    raise
+            else:
+                if self.rate_limiter:
+                    if response.status_code == 429:
+                        self.rate_limiter.decrease()
+                    elif response.ok:
+                        self.rate_limiter.increase()
+
+                if response.status_code not in RETRY_STATUS_CODES or \
+                        not self._can_retry(attempt, backoff, deadline):
+                    return response
+
+                response.close()
+
+            LOGGER.debug(f"Retrying RIPEstat query {url} in {backoff} seconds")
+            METRICS.incr("retries", tags=get_tags())
+
+            time.sleep(backoff)
+            attempt += 1
+
+
+def get_ripestat_client() -> RIPEstatClient:
+    global ripestat_client
+
+    with ripestat_client_lock:
+        if not ripestat_client:
+            # Queries are run by the shared executor (see
+            # get_ripestat_executor) and by the IP info refresher.
+            ripestat_client = RIPEstatClient(
+                pool_size=get_ripestat_max_concurrent_queries() +
+                IP_INFO_REFRESH_MAX_CONCURRENT,
+                rate_limiter=TokenBucket(
+                    "ripestat",
+                    rate=RIPESTAT_RATE_LIMIT,
+                    burst=RIPESTAT_RATE_LIMIT_BURST,
+                    min_rate=RIPESTAT_RATE_LIMIT_MIN
+                )
+            )
+
+        return ripestat_client
+
+
+def get_ripestat_max_concurrent_queries() -> int:
+    return get_total_enrichers() * RIPESTAT_MAX_CONCURRENT_QUERIES
+
+
+def get_ripestat_executor() -> ThreadPoolExecutor:
+    """Return the pool that runs the RIPEstat queries of the enrichers.
+
+    It's shared by all the enrichers of the process, so a job
+    with many IP info to fetch can use the workers left idle by
+    the others.
+    """
+    global ripestat_executor
+
+    with ripestat_executor_lock:
+        if not ripestat_executor:
+            ripestat_executor = ThreadPoolExecutor(
+                max_workers=get_ripestat_max_concurrent_queries(),
+                thread_name_prefix="ripestat"
+            )
+
+        return ripestat_executor
+
+
+def is_ripestat_failure(status_code: int) -> bool:
+    """Tell whether a response means that RIPEstat is not working.
+
+    Only these responses (and timeouts or connection errors) are
+    counted as failures by the circuit breaker: other errors, like
+    HTTP 4xx, are about the query itself.
+    """
+    return status_code == 429 or 500 <= status_code <= 599
@@ -0,0 +1,218 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Tuple
+import threading
+import logging
+import queue
+import time
+
+import markus
+from flask_socketio import SocketIO
+
+from ..config import (
+    SOCKET_IO_DATA_BATCH_EVENT,
+    SOCKET_IO_ENRICHMENT_COMPLETED_EVENT,
+    SOCKET_IO_EMITTER_QUEUE_SIZE,
+    SOCKET_IO_HOST_EVENTS_MAX_BATCH,
+    SOCKET_IO_HOST_EVENTS_MAX_LINGER,
+    get_rabbitmq_url
+)
+from ..metrics import get_tags
+from ..traceroute import Traceroute
+from ..traceroute.cache import RenderedTraceroute
+
+
+LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics(__name__)
+
+
+socketio_emitter: Optional[SocketIOEmitter] = None
+socketio_emitter_lock = threading.Lock()
+
+
+class _HostsBatch:
+
+    def __init__(self, traceroute_id: str, deadline: float):
+        self.traceroute_id = traceroute_id
+        self.deadline = deadline
+        self.hosts: List[dict] = []
+
+
+class SocketIOEmitter(threading.Thread):
+    """Emit the SocketIO events of all the enrichers of the process.
+
+    Only one connection to the message queue is used, by a
+    dedicated thread, so the enrichers don't wait for the
+    events to be published.
+
+    The host events of the same traceroute that are emitted
+    within SOCKET_IO_HOST_EVENTS_MAX_LINGER seconds are sent
+    as a single SOCKET_IO_DATA_BATCH_EVENT. Any other event
+    sent to the same namespace flushes the pending batch first,
+    so the order of the events is preserved.
+
+    The queue is bounded: when it's full, host events are
+    dropped (the page receives the whole traceroute at the
+    end of the enrichment anyway), while the other events
+    wait for some room to be available.
+    """
+
+    def __init__(
+        self,
+        socketio: Optional[SocketIO] = None,
+        max_linger: float = SOCKET_IO_HOST_EVENTS_MAX_LINGER,
+        max_batch: int = SOCKET_IO_HOST_EVENTS_MAX_BATCH,
+        queue_size: int = SOCKET_IO_EMITTER_QUEUE_SIZE
+    ):
+        super().__init__(name="SocketIOEmitter")
+
+        self.daemon = True
+
+        self.socketio = socketio or SocketIO(
+            message_queue=get_rabbitmq_url()
+        )
+
+        self.max_linger = max_linger
+        self.max_batch = max_batch
+
+        # Items are (event, data, namespace); data is the
+        # host dict for SOCKET_IO_DATA_BATCH_EVENT.
+        # None is used to stop the thread.
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+
+        # Used by the emitter thread only.
+        self.pending: Dict[str, _HostsBatch] = {}
+
+    def emit_host(self, traceroute_id: str, host: dict) -> None:
+        try:
+            self.queue.put_nowait(
+                (SOCKET_IO_DATA_BATCH_EVENT, (traceroute_id, host), f"/t/{traceroute_id}")
+            )
+        except queue.Full:
+            METRICS.incr("dropped", tags=get_tags())
+
+    def emit(self, event: str, data: dict, namespace: str) -> None:
+        self.queue.put((event, data, namespace))
+
+    def emit_enrichment_completed(self, traceroute: Traceroute) -> None:
+        # The web handlers cache their own rendered version
+        # (see render_traceroute), this one is only sent to
+        # the clients.
+        rendered = RenderedTraceroute.from_traceroute(traceroute)
+
+        self.emit(
+            SOCKET_IO_ENRICHMENT_COMPLETED_EVENT,
+            {
+                "traceroute_id": traceroute.id,
+                "traceroute": rendered.data,
+                "text": rendered.text
+            },
+            namespace=f"/t/{traceroute.id}"
+        )
+
+    def stop(self) -> None:
+        self.queue.put(None)
+
+    def _emit(self, event: str, data: dict, namespace: str) -> None:
+        try:
+            self.socketio.emit(event, data, namespace=namespace)
+        except:  # noqa: E722
+            LOGGER.exception(
+                f"Unhandled exception while emitting SocketIO event {event} "
+                f"to {namespace}"
+            )
+
+    def _flush(self, namespace: str) -> None:
+        batch = self.pending.pop(namespace, None)
+
+        if not batch:
+            return
+
+        METRICS.histogram("batch_size", len(batch.hosts), tags=get_tags())
+
+        self._emit(
+            SOCKET_IO_DATA_BATCH_EVENT,
+            {
+                "traceroute_id": batch.traceroute_id,
+                "hosts": batch.hosts
+            },
+            namespace
+        )
+
+    def _flush_expired(self) -> None:
+        now = time.monotonic()
+
+        for namespace, batch in list(self.pending.items()):
+            if now >= batch.deadline:
+                self._flush(namespace)
+
+    def _flush_all(self) -> None:
+        for namespace in list(self.pending.keys()):
+            self._flush(namespace)
+
+    def _process(self, item: Tuple[str, dict, str]) -> None:
+        event, data, namespace = item
+
+        if event != SOCKET_IO_DATA_BATCH_EVENT:
+            self._flush(namespace)
+            self._emit(event, data, namespace)
+            return
+
+        traceroute_id, host = data
+
+        batch = self.pending.get(namespace)
+        if not batch:
+            batch = _HostsBatch(
+                traceroute_id, time.monotonic() + self.max_linger
+            )
+            self.pending[namespace] = batch
+
+        batch.hosts.append(host)
+
+        if len(batch.hosts) >= self.max_batch:
+            self._flush(namespace)
+
+    def run(self):
+        LOGGER.debug("Starting SocketIOEmitter")
+
+        while True:
+            timeout = None
+            if self.pending:
+                timeout = max(
+                    0,
+                    min(
+                        batch.deadline for batch in self.pending.values()
+                    ) - time.monotonic()
+                )
+
+            try:
+                item = self.queue.get(block=True, timeout=timeout)
+            except queue.Empty:
+                item = ()
+
+            if item is None:
+                break
+
+            try:
+                if item:
+                    self._process(item)
+
+                # Batches whose linger time expired.
+                self._flush_expired()
+            except:  # noqa: E722
+                LOGGER.exception("Unhandled exception in the SocketIO emitter")
+
+        self._flush_all()
+
+        LOGGER.debug("SocketIOEmitter completed")
+
+
+def get_socketio_emitter() -> SocketIOEmitter:
+    global socketio_emitter
+
+    with socketio_emitter_lock:
+        if not socketio_emitter:
+            # Lazily started the first time it's needed.
+            socketio_emitter = SocketIOEmitter()
+            socketio_emitter.start()
+
+        return socketio_emitter
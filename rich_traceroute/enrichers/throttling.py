@@ -0,0 +1,198 @@
+from typing import Optional
+import logging
+import threading
+import time
+
+import markus
+
+from ..metrics import get_tags
+
+
+LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics(__name__)
+
+
+class TokenBucket:
+    """Adaptive token bucket rate limiter.
+
+    Tokens are added at 'rate' per second, up to 'burst'.
+    The rate is halved every time the remote side asks to slow
+    down (decrease), and it's slowly increased again, up to
+    'max_rate', when requests succeed (increase).
+    """
+
+    DECREASE_FACTOR = 0.5
+
+    # Min n. of seconds between two decreases, so that
+    # throttled requests that were already in flight don't
+    # bring the rate down to the minimum at once.
+    DECREASE_COOLDOWN = 1
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        min_rate: float,
+        increase_step: float = 0.1
+    ):
+        self.name = name
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.increase_step = increase_step
+
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0.0
+
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Wait for a token; False if it's not available within 'timeout'."""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                self._refill(now)
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+
+                wait = (1 - self.tokens) / self.rate
+
+            if deadline is not None and now + wait > deadline:
+                METRICS.incr(f"{self.name}.rate_limited", tags=get_tags())
+                return False
+
+            time.sleep(wait)
+
+    def decrease(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+
+            if now - self.last_decrease < self.DECREASE_COOLDOWN:
+                return
+
+            self._refill(now)
+            self.last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.DECREASE_FACTOR)
+            rate = self.rate
+
+        LOGGER.warning(f"Rate of {self.name} requests lowered to {rate:.2f}/s")
+        METRICS.gauge(f"{self.name}.rate", rate, tags=get_tags())
+
+    def increase(self) -> None:
+        with self.lock:
+            if self.rate >= self.max_rate:
+                return
+
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+            rate = self.rate
+
+        METRICS.gauge(f"{self.name}.rate", rate, tags=get_tags())
+
+
+class CircuitBreaker:
+    """Stop sending requests to a failing service for a while.
+
+    After 'failure_threshold' consecutive failures the circuit
+    opens, and requests are not allowed for 'reset_timeout'
+    seconds. Then, one trial request is allowed (half-open):
+    if it succeeds the circuit is closed, otherwise it's opened
+    again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        reset_timeout: float
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+
+        # When the circuit was opened, or when the last
+        # trial request was allowed.
+        self.changed = 0.0
+
+        self.lock = threading.Lock()
+
+    @property
+    def is_closed(self) -> bool:
+        return self.state == self.CLOSED
+
+    def allow_request(self) -> bool:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            # If the outcome of the trial request is never
+            # recorded, another one is allowed after a while.
+            if time.monotonic() - self.changed < self.reset_timeout:
+                return False
+
+            self.state = self.HALF_OPEN
+            self.changed = time.monotonic()
+
+        LOGGER.info(f"Circuit breaker for {self.name} half-open: trying a request")
+
+        return True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+
+            if self.state == self.CLOSED:
+                return
+
+            self.state = self.CLOSED
+
+        LOGGER.info(f"Circuit breaker for {self.name} closed")
+        METRICS.incr(f"{self.name}.circuit_closed", tags=get_tags())
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+
+            if self.state == self.OPEN:
+                return
+
+            if self.state == self.CLOSED and self.failures < self.failure_threshold:
+                return
+
+            self.state = self.OPEN
+            self.changed = time.monotonic()
+
+        LOGGER.warning(
+            f"Circuit breaker for {self.name} open: no requests "
+            f"for {self.reset_timeout} seconds"
+        )
+        METRICS.incr(f"{self.name}.circuit_opened", tags=get_tags())
+
+    def reset(self) -> None:
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.changed = 0.0
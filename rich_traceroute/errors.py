@@ -11,3 +11,28 @@ class ParserError(RichTracerouteError):
 class ConfigError(RichTracerouteError):
 
     pass
+
+
+class MessageDecodeError(RichTracerouteError):
+
+    pass
+
+
+class UnsupportedMessageError(MessageDecodeError):
+
+    pass
+
+
+class UnsupportedMessageVersionError(UnsupportedMessageError):
+
+    pass
+
+
+class ExternalSourceUnavailableError(RichTracerouteError):
+
+    pass
+
+
+class ExternalSourceTransientError(ExternalSourceUnavailableError):
+
+    pass
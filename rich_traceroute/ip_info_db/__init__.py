@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Optional, List, Tuple
+from typing import Dict, Iterable, Iterator, Optional, List, Tuple
 import datetime
 import ipaddress
 
@@ -7,13 +7,26 @@ from peewee import (
     BigIntegerField,
     DateTimeField,
     CharField,
-    ForeignKeyField
+    ForeignKeyField,
+    MySQLDatabase,
+    JOIN,
+    chunked
 )
 
-from ..db import BaseModel
+from ..db import BaseModel, db
 from ..structures import IPDBInfo, IXPNetwork
 from ..config import IP_INFO_EXPIRY
 
+# N. of prefixes retrieved by each query of iter_ip_info_entries.
+# It's used in a 'WHERE prefix IN (...)' clause too, so it can't
+# be too high (SQLite limits the n. of variables).
+LOAD_CHUNK_SIZE = 500
+
+# N. of prefixes written by each transaction of bulk_upsert.
+# Rows are inserted using multi-row INSERT statements, so
+# this can't be too high (SQLite limits the n. of variables).
+UPSERT_BATCH_SIZE = 100
+
 
 class IPPrefix(CharField):
 
@@ -129,7 +142,192 @@ class IPInfo_IXPNetwork(BaseModel):
     ix_description = CharField(null=True)
 
 
+def bulk_upsert(
+    ip_infos: Iterable[IPDBInfo],
+    batch_size: int = UPSERT_BATCH_SIZE
+) -> int:
+    """Create or update the DB records of the given IP info.
+
+    Same as calling IPInfo_Prefix.create_from_ipdbinfo for each
+    of them, but prefixes are written in chunks, each one in its
+    own transaction, using multi-row INSERT statements.
+
+    Returns the n. of prefixes that have been written.
+    """
+
+    # MySQL uses 'ON DUPLICATE KEY UPDATE', that doesn't
+    # accept a conflict target.
+    conflict_target = None
+    if not isinstance(db.obj, MySQLDatabase):
+        conflict_target = [IPInfo_Prefix.prefix]
+
+    res = 0
+
+    for batch in chunked(ip_infos, batch_size):
+        # If the same prefix is found more than once,
+        # the last entry wins.
+        entries = {
+            str(ip_info.prefix): ip_info
+            for ip_info in batch
+        }
+
+        prefixes = list(entries.keys())
+
+        now = datetime.datetime.utcnow()
+
+        with db.atomic():
+            IPInfo_Prefix.insert_many(
+                [
+                    {"prefix": prefix, "last_updated": now}
+                    for prefix in prefixes
+                ]
+            ).on_conflict(
+                conflict_target=conflict_target,
+                preserve=[IPInfo_Prefix.last_updated]
+            ).execute()
+
+            IPInfo_Origin.delete().where(
+                IPInfo_Origin.prefix.in_(prefixes)
+            ).execute()
+
+            IPInfo_IXPNetwork.delete().where(
+                IPInfo_IXPNetwork.prefix.in_(prefixes)
+            ).execute()
+
+            origins_rows = [
+                {"prefix": prefix, "asn": asn, "holder": holder}
+                for prefix, ip_info in entries.items()
+                for asn, holder in ip_info.origins or []
+            ]
+
+            for rows in chunked(origins_rows, batch_size):
+                IPInfo_Origin.insert_many(rows).execute()
+
+            ixp_networks_rows = [
+                {"prefix": prefix, **ip_info.ixp_network._asdict()}
+                for prefix, ip_info in entries.items()
+                if ip_info.ixp_network
+            ]
+
+            for rows in chunked(ixp_networks_rows, batch_size):
+                IPInfo_IXPNetwork.insert_many(rows).execute()
+
+        res += len(prefixes)
+
+    return res
+
+
+def bulk_delete(
+    prefixes: Iterable[str],
+    batch_size: int = LOAD_CHUNK_SIZE
+) -> None:
+    """Delete the DB records of the given prefixes.
+
+    Origins and IXP networks are removed in cascade.
+    """
+
+    with db.atomic():
+        for batch in chunked(prefixes, batch_size):
+            IPInfo_Prefix.delete().where(
+                IPInfo_Prefix.prefix.in_(batch)
+            ).execute()
+
+
 def remove_old_entries(expiry: datetime.timedelta = IP_INFO_EXPIRY) -> None:
     IPInfo_Prefix.delete().where(
         IPInfo_Prefix.last_updated <= datetime.datetime.utcnow() - expiry
     ).execute()
+
+
+def iter_ip_info_entries(
+    chunk_size: int = LOAD_CHUNK_SIZE
+) -> Iterator[Tuple[IPDBInfo, datetime.datetime]]:
+    """Return all the IP info entries stored in the DB.
+
+    Prefixes are read in chunks (keyset pagination on the
+    prefix itself) and, for each chunk, origins and IXP
+    networks are retrieved using a single joined query, so
+    that only 2 queries per chunk are needed and memory usage
+    doesn't depend on the size of the table.
+    Rows are read straight from the DB cursor, without
+    building model instances.
+    """
+
+    last_prefix: Optional[str] = None
+
+    while True:
+        query = IPInfo_Prefix.select(
+            IPInfo_Prefix.prefix
+        ).order_by(
+            IPInfo_Prefix.prefix
+        ).limit(chunk_size)
+
+        if last_prefix is not None:
+            query = query.where(IPInfo_Prefix.prefix > last_prefix)
+
+        prefixes = [row[0] for row in db.execute(query)]
+
+        if not prefixes:
+            return
+
+        last_prefix = prefixes[-1]
+
+        query = IPInfo_Prefix.select(
+            IPInfo_Prefix.prefix,
+            IPInfo_Prefix.last_updated,
+            IPInfo_IXPNetwork.prefix,
+            IPInfo_IXPNetwork.lan_name,
+            IPInfo_IXPNetwork.ix_name,
+            IPInfo_IXPNetwork.ix_description,
+            IPInfo_Origin.asn,
+            IPInfo_Origin.holder
+        ).join(
+            IPInfo_IXPNetwork, JOIN.LEFT_OUTER,
+            on=(IPInfo_IXPNetwork.prefix == IPInfo_Prefix.prefix)
+        ).switch(
+            IPInfo_Prefix
+        ).join(
+            IPInfo_Origin, JOIN.LEFT_OUTER,
+            on=(IPInfo_Origin.prefix == IPInfo_Prefix.prefix)
+        ).where(
+            IPInfo_Prefix.prefix.in_(prefixes)
+        ).order_by(
+            IPInfo_Prefix.prefix,
+            IPInfo_Origin.id
+        )
+
+        # There's one row for each origin of the prefix
+        # (or just one if the prefix has no origins).
+        entries: Dict[str, list] = {}
+
+        for (prefix, last_updated, ixp_prefix, lan_name, ix_name,
+             ix_description, asn, holder) in db.execute(query):
+
+            entry = entries.get(prefix)
+
+            if entry is None:
+                ixp_network = None
+                if ixp_prefix is not None:
+                    ixp_network = IXPNetwork(
+                        lan_name=lan_name,
+                        ix_name=ix_name,
+                        ix_description=ix_description
+                    )
+
+                entry = [prefix, last_updated, ixp_network, None]
+                entries[prefix] = entry
+
+            if asn is not None:
+                if entry[3] is None:
+                    entry[3] = []
+                entry[3].append((int(asn), str(holder)))
+
+        for prefix, last_updated, ixp_network, origins in entries.values():
+            yield (
+                IPDBInfo(
+                    prefix=ipaddress.ip_network(prefix),
+                    origins=origins,
+                    ixp_network=ixp_network
+                ),
+                IPInfo_Prefix.last_updated.python_value(last_updated)
+            )
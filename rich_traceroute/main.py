@@ -10,8 +10,14 @@ from rich_traceroute.enrichers.dispatcher import (
     setup_ipinfo_dispatcher
 )
 from rich_traceroute.enrichers.ixp_networks import setup_ixp_networks_updater
+from rich_traceroute.enrichers.ip_info_backfiller import setup_ip_info_backfiller
+from rich_traceroute.enrichers.ip_info_store import (
+    setup_ip_info_store_snapshots,
+    setup_ip_info_store_sweeper
+)
 from rich_traceroute.housekeeping import setup_housekeeper
-from rich_traceroute.config import load_config, ConfigMode
+from rich_traceroute.traceroute.last_seen import setup_last_seen_flusher
+from rich_traceroute.config import load_config, get_ip_info_snapshot_path, ConfigMode
 from rich_traceroute.logging_config import configure_logging
 from rich_traceroute.metrics import configure_metrics
 
@@ -35,6 +41,10 @@ def setup_environment(mode: ConfigMode) -> List[Thread]:
     LOGGER.info("Spinning up the workers [job dispatcher]...")
     res.append(setup_enrichment_jobs_dispatcher())
 
+    if mode == ConfigMode.WEB:
+        LOGGER.info("Spinning up the last_seen flusher...")
+        res.append(setup_last_seen_flusher())
+
     if mode == ConfigMode.WORKER or os.environ.get("FLASK_DEBUG", 0) == "1":
         LOGGER.info("Spinning up the workers [consumers]...")
         consumers = setup_consumers(
@@ -43,12 +53,23 @@ def setup_environment(mode: ConfigMode) -> List[Thread]:
         )
         res.extend(consumers)
 
+        snapshot_path = get_ip_info_snapshot_path()
+        if snapshot_path:
+            LOGGER.info("Spinning up the IP info snapshot writer...")
+            setup_ip_info_store_snapshots(snapshot_path)
+
+        LOGGER.info("Spinning up the IP info store sweeper...")
+        setup_ip_info_store_sweeper()
+
+        LOGGER.info("Spinning up the IP info backfiller...")
+        setup_ip_info_backfiller()
+
         LOGGER.info("Spinning up the workers [IP info dispatcher]...")
         res.append(setup_ipinfo_dispatcher())
 
         if os.environ.get("FLASK_DEBUG", 0) != "1":
             LOGGER.info("Spinning up the IXP Networks updater...")
-            res.append(setup_ixp_networks_updater(consumers))
+            res.append(setup_ixp_networks_updater())
 
         LOGGER.info("Spinning up the house keeper...")
         res.append(setup_housekeeper())
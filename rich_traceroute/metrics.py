@@ -5,6 +5,7 @@ import socket
 import logging
 from contextlib import ContextDecorator
 import time
+import tracemalloc
 
 import markus
 from markus.utils import generate_tag
@@ -34,20 +35,51 @@ class log_execution_time(ContextDecorator):
         markus_metrics: markus.main.MetricsInterface,
         logger: logging.Logger,
         metric: str,
-        descr: Optional[str] = None
+        descr: Optional[str] = None,
+        record_memory: bool = False
     ):
         self.markus_metrics = markus_metrics
         self.logger = logger
         self.metric = metric
         self.descr = descr
 
+        # When set, the memory allocated by the block at its peak
+        # is recorded too, as the '<metric>.peak_memory' gauge
+        # (bytes). It's traced using tracemalloc, which slows the
+        # block down noticeably: use it only for blocks that are
+        # rarely executed. Memory allocated meanwhile by other
+        # threads is counted as well.
+        self.record_memory = record_memory
+        self.peak_memory: Optional[int] = None
+
+        self._tracemalloc_started = False
+        self._traced_memory_at_start = 0
+
     def __enter__(self):
+        if self.record_memory:
+            # If tracing is already in progress the peak can't
+            # be reset, so it may be the one of a previous block.
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracemalloc_started = True
+
+            self._traced_memory_at_start = tracemalloc.get_traced_memory()[0]
+
         self.start = time.perf_counter()
         return self
 
     def __exit__(self, type, value, traceback):
         self.stop = time.perf_counter()
 
+        if self.record_memory:
+            peak_traced_memory = tracemalloc.get_traced_memory()[1]
+
+            if self._tracemalloc_started:
+                tracemalloc.stop()
+                self._tracemalloc_started = False
+
+            self.peak_memory = max(0, peak_traced_memory - self._traced_memory_at_start)
+
         duration = round(1000 * (self.stop - self.start))
 
         log_msg = f"Timing of {self.metric}"
@@ -57,6 +89,14 @@ class log_execution_time(ContextDecorator):
 
         log_msg += f" - {duration} ms"
 
+        if self.record_memory:
+            log_msg += f", peak memory {self.peak_memory} bytes"
+
         self.logger.debug(log_msg)
 
         self.markus_metrics.timing(self.metric, duration, get_tags())
+
+        if self.record_memory:
+            self.markus_metrics.gauge(
+                f"{self.metric}.peak_memory", self.peak_memory, get_tags()
+            )
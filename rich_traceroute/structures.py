@@ -29,6 +29,30 @@ class IPDBInfo(NamedTuple):
             "ixp_network": ixp_network_dict
         }
 
+    def to_compact_list(self) -> list:
+        # Same as to_json_dict, but without keys: used
+        # when many entries are sent at once.
+        return [
+            str(self.prefix),
+            self.origins or None,
+            list(self.ixp_network) if self.ixp_network else None
+        ]
+
+    @staticmethod
+    def from_compact_list(lst: list) -> IPDBInfo:
+        assert len(lst) == 3
+
+        prefix, origins, ixp_network = lst
+
+        return IPDBInfo(
+            prefix=ipaddress.ip_network(prefix),
+            origins=[
+                (int(origin[0]), str(origin[1]))
+                for origin in origins
+            ] if origins else None,
+            ixp_network=IXPNetwork(*ixp_network) if ixp_network else None
+        )
+
     @staticmethod
     def from_dict(dic: dict) -> IPDBInfo:
         assert "prefix" in dic
@@ -143,3 +167,24 @@ def test_ipdbinfo_from_json_dict():
     assert ipdbinfo.ixp_network.lan_name == "test LAN name"
     assert ipdbinfo.ixp_network.ix_name == "test name"
     assert ipdbinfo.ixp_network.ix_description == "test description"
+
+
+def test_ipdbinfo_from_to_compact_list():
+    ipdbinfo = IPDBInfo(
+        prefix=ipaddress.IPv4Network("192.0.2.0/24"),
+        origins=[(65500, "test 1")],
+        ixp_network=None
+    )
+
+    raw = ipdbinfo.to_compact_list()
+
+    assert raw == ["192.0.2.0/24", [(65500, "test 1")], None]
+    assert IPDBInfo.from_compact_list(raw) == ipdbinfo
+
+    ipdbinfo = IPDBInfo(
+        prefix=ipaddress.IPv6Network("2001:db8::/64"),
+        origins=None,
+        ixp_network=IXPNetwork("test LAN name", "test name", None)
+    )
+
+    assert IPDBInfo.from_compact_list(ipdbinfo.to_compact_list()) == ipdbinfo
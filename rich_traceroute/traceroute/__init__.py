@@ -1,4 +1,5 @@
 from __future__ import annotations
+from typing import List, Optional
 import logging
 import datetime
 import uuid
@@ -14,17 +15,24 @@ from peewee import (
     BooleanField,
     ForeignKeyField,
     IntegerField,
-    DecimalField
+    DecimalField,
+    chunked,
+    prefetch
 )
 
-from ..db import BaseModel
+from ..db import BaseModel, db
 from ..enrichers.dispatcher import dispatch_traceroute_enrichment_job
-from ..structures import EnricherJob, EnricherJob_Host
+from ..structures import EnricherJob, EnricherJob_Host, IPDBInfo
 from ..config import MAX_ENRICHMENT_TIME
 from .parsers import parse_raw_traceroute
 
 logger = logging.getLogger(__name__)
 
+# Max n. of rows inserted using a single INSERT statement.
+# SQLite limits the n. of variables that can be used in a
+# statement, so this can't be too high.
+INSERT_BATCH_SIZE = 100
+
 
 def record_uid() -> str:
     buff = str(uuid.uuid4())
@@ -53,33 +61,68 @@ class Traceroute(BaseModel):
         if not parser:
             return
 
-        for hop_n, hosts in parser.hops.items():
-            hop = Hop(traceroute=self, hop_number=hop_n)
-            hop.save()
-
-            for host in hosts:
-                Host.create(
-                    hop=hop,
-                    original_host=host.host,
-                    avg_rtt=host.avg_rtt,
-                    min_rtt=host.min_rtt,
-                    max_rtt=host.max_rtt,
-                    loss=host.loss
+        # Host IDs are generated here, so that the enrichment
+        # job can be built without reading hops and hosts back
+        # from the DB.
+        hosts_rows = []
+        job_hosts = []
+
+        with db.atomic():
+            hops_rows = [
+                {"traceroute": self.id, "hop_number": hop_n}
+                for hop_n in parser.hops
+            ]
+
+            for batch in chunked(hops_rows, INSERT_BATCH_SIZE):
+                Hop.insert_many(batch).execute()
+
+            hop_ids = {
+                hop.hop_number: hop.id
+                for hop in Hop.select(
+                    Hop.id, Hop.hop_number
+                ).where(
+                    Hop.traceroute == self.id
                 )
+            }
 
-        self.parsed = True
-        self.save()
-        self.dispatch_to_enrichers()
-
-    def dispatch_to_enrichers(self):
-        hosts = []
-        for hop in self.hops:  # pylint: disable=no-member
-            for host in hop.hosts:
-                hosts.append(EnricherJob_Host(
-                    hop.hop_number,
-                    host.id,
-                    host.original_host
-                ))
+            for hop_n, hosts in parser.hops.items():
+                for host in hosts:
+                    host_id = record_uid()
+
+                    hosts_rows.append({
+                        "id": host_id,
+                        "hop": hop_ids[hop_n],
+                        "original_host": host.host,
+                        "avg_rtt": host.avg_rtt,
+                        "min_rtt": host.min_rtt,
+                        "max_rtt": host.max_rtt,
+                        "loss": host.loss
+                    })
+
+                    job_hosts.append(EnricherJob_Host(
+                        hop_n,
+                        host_id,
+                        host.host
+                    ))
+
+            for batch in chunked(hosts_rows, INSERT_BATCH_SIZE):
+                Host.insert_many(batch).execute()
+
+            self.parsed = True
+            self.save()
+
+        self.dispatch_to_enrichers(job_hosts)
+
+    def dispatch_to_enrichers(self, hosts: Optional[List[EnricherJob_Host]] = None):
+        if hosts is None:
+            hosts = []
+            for hop in self.hops:  # pylint: disable=no-member
+                for host in hop.hosts:
+                    hosts.append(EnricherJob_Host(
+                        hop.hop_number,
+                        host.id,
+                        host.original_host
+                    ))
 
         job = EnricherJob(traceroute_id=self.id, hosts=hosts)
 
@@ -288,6 +331,38 @@ class Host(BaseModel):
         else:
             return False
 
+    def set_ip_info(self, ip_info: Optional[IPDBInfo]) -> None:
+        """Replace the origins and the IXP network of the host.
+
+        Must be called within a transaction, together with
+        the update of the host itself.
+        """
+        HostOrigins.delete().where(
+            HostOrigins.host_id == self.id
+        ).execute()
+
+        HostIXPNetwork.delete().where(
+            HostIXPNetwork.host_id == self.id
+        ).execute()
+
+        if not ip_info:
+            return
+
+        for asn, holder in ip_info.origins or []:
+            HostOrigins.create(
+                host_id=self.id,
+                asn=asn,
+                holder=holder
+            )
+
+        if ip_info.ixp_network:
+            HostIXPNetwork.create(
+                host_id=self.id,
+                lan_name=ip_info.ixp_network.lan_name,
+                ix_name=ip_info.ixp_network.ix_name,
+                ix_description=ip_info.ixp_network.ix_description
+            )
+
     def to_json(self):
         return json.dumps(self.to_dict())
 
@@ -298,6 +373,12 @@ class Host(BaseModel):
                 return None
             return float(v)
 
+        # Both of them are backrefs, so every access would
+        # trigger a query unless they were prefetched
+        # (see load_traceroute).
+        ixp_network = self.ixp_network
+        origins = self.origins  # pylint: disable=no-member
+
         return {
             "id": self.id,
             "hop_number": self.hop.hop_number,
@@ -311,14 +392,14 @@ class Host(BaseModel):
             "name": self.name if self.name else None,
             "enriched": self.enriched,
             "ixp_network": {
-                "lan_name": self.ixp_network.lan_name,
-                "ix_name": self.ixp_network.ix_name,
-                "ix_description": self.ixp_network.ix_description,
-            } if self.ixp_network else None,
+                "lan_name": ixp_network.lan_name,
+                "ix_name": ixp_network.ix_name,
+                "ix_description": ixp_network.ix_description,
+            } if ixp_network else None,
             "origins": [
                 (origin.asn, origin.holder)
-                for origin in self.origins  # pylint: disable=no-member
-            ] if self.origins else None  # pylint: disable=no-member
+                for origin in origins
+            ] if origins else None
         }
 
 
@@ -343,3 +424,31 @@ def create_traceroute(raw_data) -> Traceroute:
     t = Traceroute.create(raw=raw_data)
     t.parse()
     return t
+
+
+def load_traceroute(traceroute_id: str) -> Traceroute:
+    """Load a traceroute together with its hops, hosts, origins and IXP networks.
+
+    The whole graph is fetched using a constant number of queries
+    (one for each model), so that rendering the traceroute via
+    to_dict() or to_text() doesn't trigger any further query.
+
+    Hops are sorted by their number.
+
+    Raises Traceroute.DoesNotExist if the traceroute is not found.
+    """
+
+    res = prefetch(
+        Traceroute.select().where(Traceroute.id == traceroute_id),
+        Hop.select().order_by(Hop.hop_number),
+        Host.select(),
+        HostOrigins.select().order_by(HostOrigins.id),
+        HostIXPNetwork.select()
+    )
+
+    if not res:
+        raise Traceroute.DoesNotExist(
+            f"Traceroute {traceroute_id} not found"
+        )
+
+    return res[0]
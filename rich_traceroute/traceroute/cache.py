@@ -0,0 +1,127 @@
+from __future__ import annotations
+from typing import NamedTuple, Optional
+from threading import Lock
+import json
+
+import markus
+from cachetools import TTLCache
+
+from . import Traceroute, load_traceroute
+from ..config import (
+    RENDERED_TRACEROUTES_CACHE_SIZE,
+    RENDERED_TRACEROUTES_CACHE_TTL,
+    RENDERED_TRACEROUTES_PENDING_CACHE_TTL
+)
+from ..metrics import get_tags
+
+
+METRICS = markus.get_metrics(__name__)
+
+
+class RenderedTraceroute(NamedTuple):
+
+    traceroute_id: str
+    data: dict
+    json: str
+    text: str
+
+    @staticmethod
+    def from_traceroute(traceroute: Traceroute) -> RenderedTraceroute:
+        data = traceroute.to_dict()
+
+        return RenderedTraceroute(
+            traceroute_id=traceroute.id,
+            data=data,
+            json=json.dumps(data),
+            text=traceroute.to_text() if traceroute.enriched else ""
+        )
+
+
+class RenderedTraceroutesCache(TTLCache):
+
+    def popitem(self):
+        # Only invoked by cachetools when the cache is full
+        # and the least recently used item must be evicted.
+        res = super().popitem()
+
+        METRICS.incr("rendered_traceroutes_cache.evictions", tags=get_tags())
+
+        return res
+
+
+# Only enriched traceroutes are cached here. Their content can
+# still change afterwards, when the IP info that couldn't be
+# fetched during the enrichment are backfilled by the workers
+# (see enrichers/ip_info_backfiller.py): traceroutes that may be
+# waiting for them are cached in the 'pending' cache, whose TTL
+# is shorter, so that the updates are shown soon.
+rendered_traceroutes_cache = RenderedTraceroutesCache(
+    maxsize=RENDERED_TRACEROUTES_CACHE_SIZE,
+    ttl=RENDERED_TRACEROUTES_CACHE_TTL
+)
+pending_rendered_traceroutes_cache = RenderedTraceroutesCache(
+    maxsize=RENDERED_TRACEROUTES_CACHE_SIZE,
+    ttl=RENDERED_TRACEROUTES_PENDING_CACHE_TTL
+)
+rendered_traceroutes_cache_lock = Lock()
+
+
+def cache_rendered_traceroute(rendered: RenderedTraceroute, pending: bool = False) -> None:
+    with rendered_traceroutes_cache_lock:
+        if pending:
+            pending_rendered_traceroutes_cache[rendered.traceroute_id] = rendered
+        else:
+            rendered_traceroutes_cache[rendered.traceroute_id] = rendered
+
+
+def get_cached_rendered_traceroute(traceroute_id: str) -> Optional[RenderedTraceroute]:
+    with rendered_traceroutes_cache_lock:
+        rendered = (
+            rendered_traceroutes_cache.get(traceroute_id, None)
+            or pending_rendered_traceroutes_cache.get(traceroute_id, None)
+        )
+
+    if rendered:
+        METRICS.incr("rendered_traceroutes_cache.hits", tags=get_tags())
+    else:
+        METRICS.incr("rendered_traceroutes_cache.misses", tags=get_tags())
+
+    return rendered
+
+
+def _may_be_backfilled(rendered: RenderedTraceroute) -> bool:
+    # Hosts whose IP info will be backfilled have a global IP
+    # and no IP info. Which ones are actually waiting for them
+    # is known only to the workers, so all the hosts without
+    # info are considered.
+    return any(
+        host["is_global"] and not host["origins"] and not host["ixp_network"]
+        for hosts in rendered.data["hops"].values()
+        for host in hosts
+    )
+
+
+def render_traceroute(traceroute_id: str) -> RenderedTraceroute:
+    """Return the rendered version of a traceroute, from the cache if possible.
+
+    On cache misses, the traceroute is loaded from the DB and, if
+    it's enriched, the rendered version is added to the cache; if
+    some hosts may be updated later by the IP info backfiller, it's
+    cached only for a short time.
+
+    Raises Traceroute.DoesNotExist if the traceroute is not found.
+    """
+
+    rendered = get_cached_rendered_traceroute(traceroute_id)
+
+    if rendered:
+        return rendered
+
+    traceroute = load_traceroute(traceroute_id)
+
+    rendered = RenderedTraceroute.from_traceroute(traceroute)
+
+    if traceroute.enriched:
+        cache_rendered_traceroute(rendered, pending=_may_be_backfilled(rendered))
+
+    return rendered
@@ -0,0 +1,149 @@
+from __future__ import annotations
+from typing import Optional, Set
+import atexit
+import datetime
+import logging
+import threading
+
+import markus
+from peewee import chunked
+
+from ..config import LAST_SEEN_FLUSH_INTERVAL, LAST_SEEN_BUFFER_SIZE
+from ..db import db
+from ..metrics import get_tags
+from . import Traceroute
+
+LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics(__name__)
+
+# Max n. of IDs used in the 'WHERE id IN (...)' clause of
+# a single UPDATE statement. SQLite limits the n. of
+# variables that can be used in a statement.
+UPDATE_BATCH_SIZE = 500
+
+
+last_seen_flusher: Optional[LastSeenFlusher] = None
+
+
+class LastSeenFlusher(threading.Thread):
+    """Buffer the IDs of the traceroutes that have been viewed,
+    and periodically update their last_seen column in bulk.
+
+    Page views only add the ID of the traceroute to an in-memory
+    set; the thread then flushes it to the DB every 'interval'
+    seconds (or as soon as the buffer is full), using one
+    UPDATE ... WHERE id IN (...) that touches only last_seen.
+
+    If the DB is slower than the rate at which traceroutes
+    are viewed, the buffer doesn't grow indefinitely: once
+    'max_size' IDs are waiting to be flushed, new ones are
+    discarded.
+    """
+
+    def __init__(
+        self,
+        interval: int = LAST_SEEN_FLUSH_INTERVAL,
+        max_size: int = LAST_SEEN_BUFFER_SIZE
+    ):
+        super().__init__(name="LastSeenFlusher")
+
+        self.daemon = True
+
+        self.interval = interval
+        self.max_size = max_size
+
+        self.buffer: Set[str] = set()
+        self.buffer_lock = threading.Lock()
+
+        self.flush_requested = threading.Event()
+        self.stop_requested = threading.Event()
+
+    def track(self, traceroute_id: str) -> None:
+        with self.buffer_lock:
+            if traceroute_id not in self.buffer:
+                if len(self.buffer) >= self.max_size:
+                    METRICS.incr("dropped", tags=get_tags())
+                    self.flush_requested.set()
+                    return
+
+                self.buffer.add(traceroute_id)
+
+            if len(self.buffer) >= self.max_size:
+                self.flush_requested.set()
+
+    def flush(self) -> None:
+        with self.buffer_lock:
+            traceroute_ids = list(self.buffer)
+            self.buffer.clear()
+            self.flush_requested.clear()
+
+        if not traceroute_ids:
+            return
+
+        last_seen = datetime.datetime.utcnow()
+
+        try:
+            with db.atomic():
+                for batch in chunked(traceroute_ids, UPDATE_BATCH_SIZE):
+                    Traceroute.update(
+                        last_seen=last_seen
+                    ).where(
+                        Traceroute.id.in_(batch)
+                    ).execute()
+        except:  # noqa: E722
+            LOGGER.exception(
+                "Unhandled exception while flushing the last_seen "
+                f"of {len(traceroute_ids)} traceroutes"
+            )
+            return
+
+        METRICS.incr("flushed", len(traceroute_ids), tags=get_tags())
+
+    def run(self):
+        LOGGER.debug("Starting LastSeenFlusher")
+
+        while not self.stop_requested.is_set():
+            self.flush_requested.wait(self.interval)
+            self.flush()
+
+        # Anything that was tracked while stopping.
+        self.flush()
+
+        LOGGER.debug("LastSeenFlusher completed")
+
+    def stop(self):
+        self.stop_requested.set()
+        self.flush_requested.set()
+
+
+def _stop_last_seen_flusher():
+    if last_seen_flusher and last_seen_flusher.is_alive():
+        last_seen_flusher.stop()
+        last_seen_flusher.join()
+
+
+def setup_last_seen_flusher() -> LastSeenFlusher:
+    global last_seen_flusher
+
+    last_seen_flusher = LastSeenFlusher()
+    last_seen_flusher.start()
+
+    # Daemon threads are killed abruptly when the
+    # interpreter exits: the buffer is flushed here.
+    atexit.register(_stop_last_seen_flusher)
+
+    return last_seen_flusher
+
+
+def track_last_seen(traceroute_id: str) -> None:
+    if last_seen_flusher:
+        last_seen_flusher.track(traceroute_id)
+        return
+
+    # No flusher running (scripts, tests): the DB is
+    # updated immediately.
+    Traceroute.update(
+        last_seen=datetime.datetime.utcnow()
+    ).where(
+        Traceroute.id == traceroute_id
+    ).execute()
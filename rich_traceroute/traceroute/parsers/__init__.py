@@ -1,4 +1,4 @@
-from typing import Optional, Type
+from typing import List, Optional, Type
 import logging
 
 from .base import BaseParser
@@ -29,12 +29,51 @@ parsers = [
 ]
 
 
-def parse_raw_traceroute(raw: str) -> Optional[Type[BaseParser]]:
+# Number of lines, from the top of the input text, against
+# which the signatures of the parsers are matched.
+SIGNATURES_LOOKUP_LINES = 20
+
+
+def _get_signatures_lines(raw: str) -> List[str]:
+    return raw.split("\n", SIGNATURES_LOOKUP_LINES)[:SIGNATURES_LOOKUP_LINES]
+
+
+def sniff_raw_traceroute(raw: str) -> List[Type[BaseParser]]:
+    """Return the parsers that are more likely to understand the input text.
+
+    The first SIGNATURES_LOOKUP_LINES lines of the text are matched
+    against the SIGNATURES of every parser; the parsers having the
+    highest number of matching signatures are returned, in the same
+    order in which they are listed in 'parsers'.
+
+    If no signatures are found at all, an empty list is returned.
+    """
+
+    lines = _get_signatures_lines(raw)
+
+    scores = {
+        parser_class: parser_class.get_signatures_score(lines)
+        for parser_class in parsers
+    }
+
+    best_score = max(scores.values())
+
+    if not best_score:
+        return []
+
+    return [
+        parser_class
+        for parser_class in parsers
+        if scores[parser_class] == best_score
+    ]
+
+
+def _run_parsers(raw: str, parser_classes: List[Type[BaseParser]]) -> List[BaseParser]:
     # List of all the parsers that are able to process this
     # traceroute.
     possible_parsers = []
 
-    for parser_class in parsers:
+    for parser_class in parser_classes:
         parser = parser_class(raw)
 
         try:
@@ -48,6 +87,33 @@ def parse_raw_traceroute(raw: str) -> Optional[Type[BaseParser]]:
 
         possible_parsers.append(parser)
 
+    return possible_parsers
+
+
+def parse_raw_traceroute(raw: str, sniff: bool = True) -> Optional[Type[BaseParser]]:
+    possible_parsers = []
+
+    if sniff:
+        # Only the parsers whose signatures are found in the
+        # input text are used at first...
+        candidates = sniff_raw_traceroute(raw)
+
+        possible_parsers = _run_parsers(raw, candidates)
+
+        # ... then, if none of them worked, all the other
+        # ones are tried.
+        if not possible_parsers:
+            possible_parsers = _run_parsers(
+                raw,
+                [
+                    parser_class
+                    for parser_class in parsers
+                    if parser_class not in candidates
+                ]
+            )
+    else:
+        possible_parsers = _run_parsers(raw, parsers)
+
     if not possible_parsers:
         return None
 
@@ -59,12 +125,17 @@ def parse_raw_traceroute(raw: str) -> Optional[Type[BaseParser]]:
 
         return res
 
+    lines = _get_signatures_lines(raw)
+
     # Return the "best" parser for the input provided
     # in 'raw', where the definition of "best" is based
     # on the number of hops that every parser was able
     # to extract. The more hops and hosts a parser was
-    # able to parse, the better.
+    # able to parse, the better. Among those that parsed
+    # the same n. of hosts, the one with more signatures
+    # found in the input is preferred, so that the result
+    # is the same whether sniffing is used or not.
     return sorted(
         possible_parsers,
-        key=lambda p: -get_number_of_hosts(p)
+        key=lambda p: (-get_number_of_hosts(p), -p.get_signatures_score(lines))
     )[0]
@@ -1,4 +1,4 @@
-from typing import Dict, List, NamedTuple, Optional
+from typing import Dict, List, NamedTuple, Optional, Pattern
 from abc import ABC, abstractmethod
 import re
 
@@ -43,6 +43,16 @@ class BaseParser(ABC):
         """List of files containing example texts that this parser can understand."""
         ...
 
+    # List of regular expressions that identify the format
+    # understood by the parser. They are matched against the
+    # first lines of the input text (see sniff_raw_traceroute
+    # in __init__.py) to quickly determine which parsers are
+    # worth a full parse() of the text. Parsers whose format
+    # can't be recognised by some specific markers can leave
+    # this empty: they will be used only when none of the
+    # other parsers is able to process the input.
+    SIGNATURES: List[Pattern] = []
+
     @classmethod
     def get_examples(cls) -> List[str]:
         res = []
@@ -54,6 +64,16 @@ class BaseParser(ABC):
 
         return res
 
+    @classmethod
+    def get_signatures_score(cls, lines: List[str]) -> int:
+        """Return the n. of signatures of the parser found in the given lines."""
+
+        return sum(
+            1
+            for signature in cls.SIGNATURES
+            if any(signature.search(line) for line in lines)
+        )
+
     def __init__(self, raw_data: str):
         self.raw_data = raw_data
 
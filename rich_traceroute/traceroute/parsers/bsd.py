@@ -1,5 +1,6 @@
 from typing import List
 import ipaddress
+import re
 
 from .line_by_line import LineByLineParser, IPAddress
 from ...errors import ParserError
@@ -13,6 +14,17 @@ class BSDParser(LineByLineParser):
         "tests/data/traceroute/bsd_4.txt"
     ]
 
+    SIGNATURES = [
+        re.compile(r"^traceroute to "),
+        # Default max TTL of BSD traceroute.
+        re.compile(r", 64 hops max\b"),
+        # Replies from different hosts on their own lines,
+        # without the hop number.
+        re.compile(r"^\s+[^\s\d*]\S* \(\S+\)\s+[\d.]+ ms"),
+        # RTTs without decimals, from older versions.
+        re.compile(r"\(\S+\)\s+\d+ ms\b")
+    ]
+
     def _build_internal_repr(self):
         lines = self.raw_data.splitlines()
 
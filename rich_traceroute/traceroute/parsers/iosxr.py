@@ -11,6 +11,11 @@ class IOSXRParser(BSDParser):
         "tests/data/traceroute/iosxr_2.txt"
     ]
 
+    SIGNATURES = [
+        re.compile(r"^\s*Tracing the route to "),
+        re.compile(r"\d msec\b")
+    ]
+
     def _build_internal_repr(self):
         # This is to remove "extra string" like the
         # MPLS labels before processing the traceroute
@@ -1,4 +1,5 @@
 from typing import Tuple
+import re
 
 from .mtr import MTRParser
 from ...errors import ParserError
@@ -12,6 +13,12 @@ class JunosParser(MTRParser):
         "tests/data/traceroute/junos_1.txt"
     ]
 
+    SIGNATURES = [
+        re.compile(r"^\s*HOST:"),
+        # Hops without the '|--' of the MTR report format.
+        re.compile(r"^\s*\d+\.\s")
+    ]
+
     @staticmethod
     def _get_hop_n(line: str) -> Tuple[int, str]:
         first_part = line.split()[0]
@@ -1,5 +1,6 @@
 from typing import List
 import ipaddress
+import re
 
 from .line_by_line import LineByLineParser, IPAddress
 from ...errors import ParserError
@@ -13,6 +14,16 @@ class LinuxParser(LineByLineParser):
         "tests/data/traceroute/linux_1.txt"
     ]
 
+    SIGNATURES = [
+        re.compile(r"^traceroute6? to "),
+        # Default max TTL of Linux traceroute.
+        re.compile(r", 30 hops max, "),
+        # Replies from different hosts on the same line.
+        re.compile(r"\d ms\s+[\w:]\S*\s+(\(\S+\)\s+)?[\d.]+ ms"),
+        # No space between RTT and unit.
+        re.compile(r"\d\.\d+ms\b")
+    ]
+
     def _build_internal_repr(self):
         lines = self.raw_data.splitlines()
 
@@ -1,4 +1,5 @@
 from typing import Union, Tuple
+import re
 
 from .base import BaseParser, HopHost
 from ...errors import ParserError
@@ -12,6 +13,11 @@ class MTRParser(BaseParser):
         "tests/data/traceroute/mtr_2.txt"
     ]
 
+    SIGNATURES = [
+        re.compile(r"^\s*HOST:"),
+        re.compile(r"^\s*\d+\.\|--")
+    ]
+
     def _add_hop_host(self, hop_n: int, host: Union[str, None], **host_attrs) -> None:
         if hop_n not in self.hops:
             self.hops[hop_n] = []
@@ -184,6 +190,13 @@ class MTRParserInteractive(MTRParser):
         "tests/data/traceroute/mtr_interactive_2.txt"
     ]
 
+    SIGNATURES = [
+        re.compile(r"^\s*Host\s+Loss%"),
+        re.compile(r"My traceroute"),
+        re.compile(r"^\s*Keys:\s+Help"),
+        re.compile(r"^\s*\d+\.\s")
+    ]
+
     @staticmethod
     def _get_hop_n(line: str) -> Tuple[int, str]:
 
@@ -1,4 +1,5 @@
 import json
+import re
 
 from .base import BaseParser, HopHost
 from ...errors import ParserError
@@ -13,6 +14,10 @@ class MTRJSONParser(BaseParser):
         "tests/data/traceroute/mtr_json_3.json",
     ]
 
+    SIGNATURES = [
+        re.compile(r"^\s*\{")
+    ]
+
     def _parse(self):
         try:
             data = json.loads(self.raw_data)
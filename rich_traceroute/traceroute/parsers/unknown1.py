@@ -1,4 +1,5 @@
 import ipaddress
+import re
 
 from .line_by_line import LineByLineParser
 from .base import OTHER_UNKNOWN_TRACEROUTE_FORMAT
@@ -13,6 +14,11 @@ class UnknownFormat1Parser(LineByLineParser):
         "tests/data/traceroute/unknown1_1.txt"
     ]
 
+    SIGNATURES = [
+        re.compile(r"^\s*1\?:"),
+        re.compile(r"\bpmtu \d+")
+    ]
+
     def _build_internal_repr(self):
         lines = self.raw_data.splitlines()
 
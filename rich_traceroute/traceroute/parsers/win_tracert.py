@@ -1,5 +1,6 @@
 from typing import List
 import ipaddress
+import re
 
 from .line_by_line import LineByLineParser
 from ...errors import ParserError
@@ -13,6 +14,12 @@ class WindowsTracertParser(LineByLineParser):
         "tests/data/traceroute/win_tracert_1.txt"
     ]
 
+    SIGNATURES = [
+        re.compile(r"^\s*Tracing route to "),
+        re.compile(r"over a maximum of \d+ hops"),
+        re.compile(r"\btracert ")
+    ]
+
     def _build_internal_repr(self):
         lines = self.raw_data.splitlines()
 
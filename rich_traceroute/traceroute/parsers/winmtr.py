@@ -1,4 +1,5 @@
 import ipaddress
+import re
 from typing import Union
 
 from .base import BaseParser, HopHost
@@ -13,6 +14,10 @@ class WinMTRParser(BaseParser):
         "tests/data/traceroute/winmtr_1.txt"
     ]
 
+    SIGNATURES = [
+        re.compile(r"WinMTR statistics")
+    ]
+
     def _add_hop_host(self, host: Union[str, None], **host_attrs) -> None:
         new_hop_n = len(self.hops.keys()) + 1
         self.hops[new_hop_n] = []
@@ -3,6 +3,7 @@ import logging
 from rich_traceroute.config import (
     get_flask_secret_key,
     SOCKET_IO_DATA_EVENT,
+    SOCKET_IO_DATA_BATCH_EVENT,
     SOCKET_IO_ERROR_EVENT,
     SOCKET_IO_ENRICHMENT_COMPLETED_EVENT,
 )
@@ -53,6 +54,7 @@ def inject_global_variables():
     cfg = load_config()
     return dict(
         SOCKET_IO_DATA_EVENT=SOCKET_IO_DATA_EVENT,
+        SOCKET_IO_DATA_BATCH_EVENT=SOCKET_IO_DATA_BATCH_EVENT,
         SOCKET_IO_ERROR_EVENT=SOCKET_IO_ERROR_EVENT,
         SOCKET_IO_ENRICHMENT_COMPLETED_EVENT=SOCKET_IO_ENRICHMENT_COMPLETED_EVENT,
         PUBLIC_SITE=cfg["web"].get("public_site", True),
@@ -1,5 +1,3 @@
-import datetime
-
 from flask import Blueprint
 from flask import redirect
 from flask import render_template
@@ -12,6 +10,11 @@ from rich_traceroute.traceroute import (
     Traceroute,
     create_traceroute
 )
+from rich_traceroute.traceroute.cache import (
+    get_cached_rendered_traceroute,
+    render_traceroute
+)
+from rich_traceroute.traceroute.last_seen import track_last_seen
 from .recaptcha import ReCaptcha
 
 
@@ -21,6 +24,11 @@ bp = Blueprint("traceroute", __name__, url_prefix="")
 @bp.route("/status", methods=["GET"])
 def status():
     traceroute_id = request.args.get("id")
+
+    rendered = get_cached_rendered_traceroute(traceroute_id)
+    if rendered:
+        return jsonify({"status": rendered.data["status"]})
+
     try:
         traceroute = Traceroute.get(Traceroute.id == traceroute_id)
     except DoesNotExist:
@@ -32,19 +40,20 @@ def status():
 @bp.route("/t/<traceroute_id>", methods=["GET"])
 def t(traceroute_id):
     try:
-        traceroute = Traceroute.get(Traceroute.id == traceroute_id)
+        rendered = render_traceroute(traceroute_id)
     except DoesNotExist:
         return render_template(
             "traceroute.html",
             err_code=1
         )
 
-    traceroute.last_seen = datetime.datetime.utcnow()
-    traceroute.save()
+    track_last_seen(traceroute_id)
 
     return render_template(
         "traceroute.html",
-        t=traceroute
+        t=rendered.data,
+        t_json=rendered.json,
+        t_text=rendered.text
     )
 
 
@@ -18,7 +18,10 @@ from rich_traceroute.enrichers.dispatcher import (
     setup_enrichment_jobs_dispatcher,
     setup_ipinfo_dispatcher
 )
+from rich_traceroute.enrichers.ip_info_backfiller import ip_info_backfiller
+from rich_traceroute.enrichers.ip_info_store import ip_info_store
 from rich_traceroute.enrichers.ixp_networks import IXPNetworksUpdater
+from rich_traceroute.enrichers.ripestat import ripestat_circuit_breaker
 from rich_traceroute.logging_config import configure_logging
 from rich_traceroute.config import load_config
 from rich_traceroute.metrics import configure_metrics
@@ -117,6 +120,30 @@ def db(tmpdir, mocker):
     disconnect_from_the_db()
 
 
+@pytest.fixture(autouse=True)
+def reset_ip_info_store():
+    # The IP info store is shared by all the enrichers
+    # of the process, so it must be cleaned up between
+    # the tests.
+    ip_info_store.reset()
+
+    yield
+
+    ip_info_store.reset()
+
+
+@pytest.fixture(autouse=True)
+def reset_external_sources_state():
+    # Shared by all the enrichers of the process too.
+    ripestat_circuit_breaker.reset()
+    ip_info_backfiller.reset()
+
+    yield
+
+    ripestat_circuit_breaker.reset()
+    ip_info_backfiller.reset()
+
+
 @pytest.fixture()
 def rabbitmq():
     RABBIT_MQ_CONTAINER.ensure_is_up()
@@ -170,7 +197,7 @@ def metrics_setup():
 
 @pytest.fixture()
 def ixp_networks(db, rabbitmq):
-    updater = IXPNetworksUpdater(CONSUMER_THREADS)
+    updater = IXPNetworksUpdater()
     updater.update_ixp_networks()
 
     yield
@@ -247,6 +274,8 @@ def external_resources(mocker):
 
     class FakeRequestResponse:
 
+        status_code = 200
+
         def __init__(self, url: str):
             m = hashlib.sha1()
             m.update(url.encode())
@@ -278,7 +307,7 @@ def external_resources(mocker):
     def fake_requests_get(url) -> FakeRequestResponse:
         return FakeRequestResponse(url)
 
-    def fake_ripe_stat_query(self, url) -> FakeRequestResponse:
+    def fake_ripe_stat_query(self, url, deadline=None) -> FakeRequestResponse:
         return FakeRequestResponse(url)
 
     def fake_peeringdb_get(self, url) -> FakeRequestResponse:
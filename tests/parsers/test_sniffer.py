@@ -0,0 +1,113 @@
+from os.path import basename, isfile
+import glob
+
+from rich_traceroute.traceroute.parsers import (
+    parse_raw_traceroute,
+    sniff_raw_traceroute
+)
+from rich_traceroute.traceroute.parsers.mtr_json import MTRJSONParser
+from rich_traceroute.traceroute.parsers.mtr import MTRParser, MTRParserInteractive
+from rich_traceroute.traceroute.parsers.junos import JunosParser
+from rich_traceroute.traceroute.parsers.linux import LinuxParser
+from rich_traceroute.traceroute.parsers.bsd import BSDParser
+from rich_traceroute.traceroute.parsers.iosxr import IOSXRParser
+from rich_traceroute.traceroute.parsers.win_tracert import WindowsTracertParser
+from rich_traceroute.traceroute.parsers.winmtr import WinMTRParser
+from rich_traceroute.traceroute.parsers.unknown1 import UnknownFormat1Parser
+
+
+def _sniff_test_file(path):
+    return sniff_raw_traceroute(open(path, "r").read())
+
+
+def _hops_only(path):
+    # The header line is removed.
+    return open(path, "r").read().split("\n", 1)[1]
+
+
+def test_sniffer_candidates():
+    assert _sniff_test_file("tests/data/traceroute/mtr_json_1.json") == [MTRJSONParser]
+    assert _sniff_test_file("tests/data/traceroute/mtr_1.txt") == [MTRParser]
+    assert _sniff_test_file("tests/data/traceroute/mtr_interactive_2.txt") == [MTRParserInteractive]
+    assert _sniff_test_file("tests/data/traceroute/mtr_interactive_1.txt") == [MTRParserInteractive]
+    assert _sniff_test_file("tests/data/traceroute/junos_1.txt") == [JunosParser]
+    assert _sniff_test_file("tests/data/traceroute/linux_1.txt") == [LinuxParser]
+    assert _sniff_test_file("tests/data/traceroute/linux_5.txt") == [LinuxParser]
+    assert _sniff_test_file("tests/data/traceroute/bsd_1.txt") == [BSDParser]
+    assert _sniff_test_file("tests/data/traceroute/bsd_4.txt") == [BSDParser]
+    assert _sniff_test_file("tests/data/traceroute/iosxr_1.txt") == [IOSXRParser]
+    assert _sniff_test_file("tests/data/traceroute/iosxr_2.txt") == [IOSXRParser]
+    assert _sniff_test_file("tests/data/traceroute/win_tracert_3.txt") == [WindowsTracertParser]
+    assert _sniff_test_file("tests/data/traceroute/winmtr_1.txt") == [WinMTRParser]
+    assert _sniff_test_file("tests/data/traceroute/unknown1_1.txt") == [UnknownFormat1Parser]
+
+
+def test_sniffer_one_candidate_per_file():
+    # The signatures of the parsers are specific enough to
+    # tell apart all the formats of the test files.
+    parser_classes = {
+        "bsd": BSDParser,
+        "iosxr": IOSXRParser,
+        "junos": JunosParser,
+        "linux": LinuxParser,
+        "mtr": MTRParser,
+        "mtr_interactive": MTRParserInteractive,
+        "mtr_json": MTRJSONParser,
+        "unknown1": UnknownFormat1Parser,
+        "win_tracert": WindowsTracertParser,
+        "winmtr": WinMTRParser,
+    }
+
+    test_files = glob.glob("tests/data/traceroute/*")
+
+    for f in test_files:
+        if not isfile(f):
+            continue
+
+        file_format = basename(f).rsplit("_", 1)[0]
+
+        assert _sniff_test_file(f) == [parser_classes[file_format]], f
+
+
+def test_sniffer_no_signatures():
+    # No headers at all, just the hops, and nothing that
+    # is specific to a format: all the parsers must be used.
+    raw = _hops_only("tests/data/traceroute/linux_2.txt")
+
+    assert sniff_raw_traceroute(raw) == []
+
+    best_parser = parse_raw_traceroute(raw)
+    assert best_parser is not None
+    assert len(best_parser.hops) == 8
+
+
+def test_sniffer_misleading_signatures():
+    # The signature of the MTR JSON format is found, but
+    # the input is not JSON: the other parsers must be
+    # used as a fallback.
+    raw = "{\n" + _hops_only("tests/data/traceroute/linux_2.txt")
+
+    assert sniff_raw_traceroute(raw) == [MTRJSONParser]
+
+    best_parser = parse_raw_traceroute(raw)
+    assert isinstance(best_parser, LinuxParser)
+    assert len(best_parser.hops) == 8
+
+
+def test_sniffer_same_results_as_all_parsers():
+    # Sniffing must not change the outcome of the parsing
+    # process: the same parser that would be selected by
+    # running all of them must be picked.
+    test_files = glob.glob("tests/data/traceroute/*")
+
+    for f in test_files:
+        if not isfile(f):
+            continue
+
+        raw = open(f, "r").read()
+
+        sniffed_parser = parse_raw_traceroute(raw)
+        best_parser = parse_raw_traceroute(raw, sniff=False)
+
+        assert type(sniffed_parser) is type(best_parser), f
+        assert sniffed_parser.hops == best_parser.hops, f
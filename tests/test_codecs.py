@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+import ipaddress
+import json
+
+import pytest
+
+from rich_traceroute.enrichers.codecs import (
+    JSONCodec,
+    MsgpackCodec,
+    get_message_codec
+)
+from rich_traceroute.errors import MessageDecodeError, UnsupportedMessageError, UnsupportedMessageVersionError
+from rich_traceroute.structures import (
+    EnricherJob,
+    EnricherJob_Host,
+    IPDBInfo,
+    IXPNetwork
+)
+from rich_traceroute.traceroute import record_uid
+
+
+def _job() -> EnricherJob:
+    return EnricherJob(
+        traceroute_id=record_uid(),
+        hosts=[
+            EnricherJob_Host(n // 2 + 1, record_uid(), f"192.0.2.{n}")
+            for n in range(30)
+        ] + [EnricherJob_Host(16, "not-an-hex-id", "www.example.com")]
+    )
+
+
+def _ip_infos(n: int):
+    return [
+        IPDBInfo(
+            prefix=ipaddress.ip_network(f"10.{i // 256}.{i % 256}.0/24"),
+            origins=[(65500 + i, f"AS{65500 + i} holder")],
+            ixp_network=None
+        )
+        for i in range(n)
+    ] + [
+        IPDBInfo(
+            prefix=ipaddress.ip_network("2001:db8::/64"),
+            origins=None,
+            ixp_network=IXPNetwork(None, "IX", "IX description")
+        )
+    ]
+
+
+def _codecs():
+    return [JSONCodec(), MsgpackCodec()]
+
+
+@pytest.mark.parametrize("codec", _codecs(), ids=lambda c: c.NAME)
+def test_codecs_roundtrip(codec):
+    job = _job()
+    assert codec.decode_job(codec.encode_job(job)) == job
+
+    # Batches of 1, 15, 16 and 301 entries: msgpack uses
+    # different array headers for them.
+    for n in (0, 14, 15, 300):
+        ip_infos = _ip_infos(n)
+
+        body = codec.join_ip_infos([
+            codec.encode_ip_info(ip_info) for ip_info in ip_infos
+        ])
+
+        assert codec.decode_ip_infos(body) == ip_infos
+
+    msg = codec.message(b"body")
+    assert get_message_codec(
+        SimpleNamespace(content_type=msg.content_type, headers={"version": msg.version})
+    ) is not None
+
+
+def test_codecs_msgpack_is_compact():
+    job = _job()
+
+    assert len(MsgpackCodec().encode_job(job)) < len(JSONCodec().encode_job(job)) / 2
+
+
+def test_codecs_message_codec():
+    # Messages sent by workers that predate codecs.
+    codec = get_message_codec(SimpleNamespace(content_type=None, headers=None))
+    assert isinstance(codec, JSONCodec)
+
+    assert codec.decode_ip_infos(
+        json.dumps(_ip_infos(0)[0].to_json_dict()).encode()
+    ) == _ip_infos(0)
+
+    # Sent by a more recent version too.
+    with pytest.raises(UnsupportedMessageError, match="Unsupported content type"):
+        get_message_codec(SimpleNamespace(content_type="text/plain", headers=None))
+
+    # Sent by a more recent version.
+    with pytest.raises(UnsupportedMessageVersionError, match="Unsupported version"):
+        get_message_codec(
+            SimpleNamespace(content_type="application/json", headers={"version": 2})
+        )
+
+
+@pytest.mark.parametrize("codec", _codecs(), ids=lambda c: c.NAME)
+def test_codecs_invalid_messages(codec):
+    with pytest.raises(MessageDecodeError):
+        codec.decode_job(b"\x93\x01")
+
+    with pytest.raises(MessageDecodeError):
+        codec.decode_ip_infos(b"\x93\x01")
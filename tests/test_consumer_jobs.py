@@ -0,0 +1,212 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+import json
+import queue
+
+import pytest
+
+from rich_traceroute.config import ENRICHMENT_JOBS_MAX_RETRIES
+from rich_traceroute.enrichers.async_channel import EnrichmentJobsChannel
+from rich_traceroute.enrichers.constants import (
+    ENRICHMENT_JOBS_QUEUE_NAME,
+    ENRICHMENT_JOBS_RETRY_QUEUE_NAME
+)
+from rich_traceroute.enrichers.consumer import ConsumerAsyncConnection, ConsumerThread
+from rich_traceroute.enrichers.enricher import Enricher
+from rich_traceroute.structures import EnricherJob, EnricherJob_Host
+
+from .conftest import metrics_mock_wrapper
+
+
+METRIC_PREFIX = "rich_traceroute.enrichers.consumer"
+
+
+def _job(n: int) -> EnricherJob:
+    return EnricherJob(f"t{n}", [EnricherJob_Host(1, f"h{n}", "192.0.2.1")])
+
+
+def _consumer():
+    # Just what receive_traceroute_enrichment_job needs.
+    return SimpleNamespace(
+        enrichment_jobs_queue=queue.Queue(),
+        _ack_job=ConsumerThread._ack_job,
+        _retry_job_later=ConsumerThread._retry_job_later
+    )
+
+
+def _channel():
+    ch = MagicMock(is_open=True)
+
+    # Callbacks scheduled on the ioloop are run immediately.
+    ch.connection.ioloop.add_callback_threadsafe.side_effect = lambda cb: cb()
+
+    return ch
+
+
+def test_consumer_jobs_prefetch():
+    connection = ConsumerAsyncConnection(
+        SimpleNamespace(enrichers=[None] * 3, receive_traceroute_enrichment_job=None,
+                        receive_ip_info_data=None)
+    )
+    connection._setup_channels()
+
+    jobs_channel = connection._channels[0]
+
+    assert isinstance(jobs_channel, EnrichmentJobsChannel)
+    assert jobs_channel.PREFETCH_COUNT == 3
+    assert EnrichmentJobsChannel.PREFETCH_COUNT == 1
+
+
+def test_consumer_jobs_ack_on_completion(mocker):
+    consumer = _consumer()
+    ch = _channel()
+
+    metrics_mock_wrapper.mm.clear_records()
+
+    for n in range(2):
+        ConsumerThread.receive_traceroute_enrichment_job(
+            consumer, ch,
+            MagicMock(delivery_tag=n + 1, redelivered=n == 1),
+            None, json.dumps(_job(n).to_json_dict()).encode()
+        )
+
+    # Jobs are neither rejected nor acked when received.
+    assert ch.basic_nack.call_count == 0
+    assert ch.basic_ack.call_count == 0
+
+    processed = []
+
+    def process_job(self, job):
+        # Not acked while it's being processed.
+        assert ch.basic_ack.call_count == len(processed)
+        processed.append(job)
+
+    mocker.patch.object(Enricher, "process_traceroute_enrichment_job", process_job)
+
+    enricher = Enricher("enricher-test", consumer.enrichment_jobs_queue)
+    enricher.start()
+    enricher.stop()
+    enricher.join(5)
+
+    assert processed == [_job(0), _job(1)]
+
+    assert [c[1]["delivery_tag"] for c in ch.basic_ack.call_args_list] == [1, 2]
+
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat=f"{METRIC_PREFIX}.enrichment_jobs.received"
+    )) == 2
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat=f"{METRIC_PREFIX}.enrichment_jobs.redelivered"
+    )) == 1
+
+
+def test_consumer_jobs_ack_closed_channel(mocker):
+    consumer = _consumer()
+    ch = _channel()
+
+    ConsumerThread.receive_traceroute_enrichment_job(
+        consumer, ch, MagicMock(delivery_tag=1, redelivered=False),
+        None, json.dumps(_job(0).to_json_dict()).encode()
+    )
+
+    _, on_completed = consumer.enrichment_jobs_queue.get()
+
+    # The job has been sent again to another consumer.
+    ch.is_open = False
+    on_completed()
+
+    assert ch.basic_ack.call_count == 0
+
+
+def test_consumer_jobs_retry_queue():
+    channel = EnrichmentJobsChannel("test", MagicMock(), MagicMock())
+    channel.channel = MagicMock()
+
+    channel._setup_queue()
+
+    # The retry queue is declared first, so that it exists
+    # as soon as jobs are consumed.
+    kwargs = channel.channel.queue_declare.call_args[1]
+    assert kwargs["queue"] == ENRICHMENT_JOBS_RETRY_QUEUE_NAME
+    assert kwargs["arguments"]["x-dead-letter-exchange"] == ""
+    assert kwargs["arguments"]["x-dead-letter-routing-key"] == ENRICHMENT_JOBS_QUEUE_NAME
+    assert kwargs["arguments"]["x-message-ttl"] > 0
+
+    kwargs["callback"](None)
+
+    assert channel.channel.queue_declare.call_args[1]["queue"] == ENRICHMENT_JOBS_QUEUE_NAME
+
+
+@pytest.mark.parametrize(
+    "properties",
+    [
+        SimpleNamespace(content_type="application/json", headers={"version": 99}),
+        SimpleNamespace(content_type="application/x-unknown", headers=None),
+    ],
+    ids=["version", "content_type"]
+)
+def test_consumer_jobs_retry_later(properties):
+    consumer = _consumer()
+    ch = _channel()
+
+    metrics_mock_wrapper.mm.clear_records()
+
+    # A job sent by a worker running a more recent version.
+    body = json.dumps(_job(0).to_json_dict()).encode()
+
+    ConsumerThread.receive_traceroute_enrichment_job(
+        consumer, ch, MagicMock(delivery_tag=1, redelivered=False), properties, body
+    )
+
+    # Left to the workers that can decode it, after a delay.
+    ch.basic_publish.assert_called_once()
+    kwargs = ch.basic_publish.call_args[1]
+    assert kwargs["exchange"] == ""
+    assert kwargs["routing_key"] == ENRICHMENT_JOBS_RETRY_QUEUE_NAME
+    assert kwargs["body"] == body
+    assert kwargs["properties"].content_type == properties.content_type
+    assert kwargs["properties"].headers["retries"] == 1
+
+    ch.basic_ack.assert_called_once_with(delivery_tag=1)
+    assert ch.basic_nack.call_count == 0
+    assert consumer.enrichment_jobs_queue.empty()
+
+    # Until it would be expired anyway.
+    properties.headers = kwargs["properties"].headers
+    properties.headers["retries"] = ENRICHMENT_JOBS_MAX_RETRIES
+
+    ConsumerThread.receive_traceroute_enrichment_job(
+        consumer, ch, MagicMock(delivery_tag=2, redelivered=False), properties, body
+    )
+
+    ch.basic_publish.assert_called_once()
+    ch.basic_nack.assert_called_once_with(delivery_tag=2, requeue=False)
+
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat=f"{METRIC_PREFIX}.enrichment_jobs.retried"
+    )) == 1
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat=f"{METRIC_PREFIX}.enrichment_jobs.retries_exhausted"
+    )) == 1
+
+
+def test_consumer_jobs_decode_error():
+    consumer = _consumer()
+    ch = _channel()
+
+    metrics_mock_wrapper.mm.clear_records()
+
+    # A job that no worker can decode.
+    ConsumerThread.receive_traceroute_enrichment_job(
+        consumer, ch, MagicMock(delivery_tag=1, redelivered=False),
+        SimpleNamespace(content_type="application/json", headers={"version": 1}),
+        b"not a job"
+    )
+
+    # Discarded, so that it's not redelivered forever.
+    ch.basic_nack.assert_called_once_with(delivery_tag=1, requeue=False)
+    assert consumer.enrichment_jobs_queue.empty()
+
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat=f"{METRIC_PREFIX}.enrichment_jobs.decode_errors"
+    )) == 1
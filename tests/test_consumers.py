@@ -11,9 +11,10 @@ from rich_traceroute.traceroute import (
     Traceroute
 )
 from rich_traceroute.ip_info_db import IPInfo_Prefix
+from rich_traceroute.enrichers.ip_info_store import ip_info_store
 from rich_traceroute.structures import IPDBInfo, IXPNetwork
 from rich_traceroute.config import (
-    SOCKET_IO_DATA_EVENT,
+    SOCKET_IO_DATA_BATCH_EVENT,
     SOCKET_IO_ENRICHMENT_COMPLETED_EVENT,
 )
 
@@ -96,17 +97,21 @@ def _prefix_traceroute_id(
 
 
 def _get_socketio_emitted_records() -> List[Tuple]:
-    """Get a simplified version of calls from socketio_emit_mock."""
+    """Get a simplified version of calls from socketio_emit_mock.
+
+    Host events are sent in batches: one record for each host
+    of every batch is returned."""
     return [
         (
             call[0][1]["traceroute_id"],
-            call[0][1]["ip"],
-            call[0][1]["name"],
-            call[0][1]["origins"],
-            call[0][1]["ixp_network"],
+            host["ip"],
+            host["name"],
+            host["origins"],
+            host["ixp_network"],
         )
         for call in socketio_emit_mock.call_args_list
-        if call[0][0] == SOCKET_IO_DATA_EVENT
+        if call[0][0] == SOCKET_IO_DATA_BATCH_EVENT
+        for host in call[0][1]["hosts"]
     ]
 
 
@@ -122,7 +127,7 @@ def socketio(mocker):
     socketio_emit_mock = MagicMock()
 
     mocker.patch(
-        "rich_traceroute.enrichers.enricher.SocketIO.emit",
+        "rich_traceroute.enrichers.socketio_emitter.SocketIO.emit",
         socketio_emit_mock
     )
 
@@ -219,33 +224,29 @@ def test_consumers_basic():
     assert origin.holder == "GOOGLE"
     assert host.ixp_network is None
 
-    # Now, let's verify that all the enrichers from
-    # the consumer threads got their IP info DB populated
-    # equally. This is to ensure that the IP info records
-    # are properly distributed across the consumers.
-    for thread in CONSUMER_THREADS:
-        for enricher in thread.enrichers:
-            ip_info_db = enricher.ip_info_db
-
-            assert len(ip_info_db.nodes()) == 5
-
-            assert sorted(ip_info_db.prefixes()) == sorted([
-                "89.97.0.0/16",
-                "62.101.124.0/22",
-                "209.85.128.0/17",
-                "216.239.32.0/19",
-                "8.8.8.0/24",
-            ])
-
-            assert ip_info_db.search_exact(
-                "89.97.0.0/16"
-            ).data["ip_db_info"] == IPDBInfo(
-                prefix=ipaddress.ip_network("89.97.0.0/16"),
-                origins=[
-                    (12874, "FASTWEB - Fastweb SpA")
-                ],
-                ixp_network=None
-            )
+    # Now, let's verify that the IP info store shared by
+    # the enrichers of the consumer threads got populated.
+    ip_info_db = ip_info_store.radix
+
+    assert len(ip_info_db.nodes()) == 5
+
+    assert sorted(ip_info_db.prefixes()) == sorted([
+        "89.97.0.0/16",
+        "62.101.124.0/22",
+        "209.85.128.0/17",
+        "216.239.32.0/19",
+        "8.8.8.0/24",
+    ])
+
+    assert ip_info_db.search_exact(
+        "89.97.0.0/16"
+    ).data["ip_db_info"] == IPDBInfo(
+        prefix=ipaddress.ip_network("89.97.0.0/16"),
+        origins=[
+            (12874, "FASTWEB - Fastweb SpA")
+        ],
+        ixp_network=None
+    )
 
     # Check now that the IP Info DB is populated properly.
     db_prefixes = IPInfo_Prefix.select()
@@ -440,36 +441,32 @@ def test_ixp_networks_updater_integration(ixp_networks):
     assert host.ixp_network.ix_name == "MIX-IT"
     assert host.ixp_network.ix_description == "Milan Internet eXchange"
 
-    # Now, let's verify that all the enrichers from
-    # the consumer threads got their IP info DB populated
-    # equally. This is to ensure that the IXPNetworksUpdater
-    # properly dispatch the IP info entries to all the
-    # consumers.
-    for thread in CONSUMER_THREADS:
-        for enricher in thread.enrichers:
-
-            ip_info_db = enricher.ip_info_db
-
-            assert len(ip_info_db.nodes()) == 4
-
-            assert sorted(ip_info_db.prefixes()) == sorted([
-                "89.97.0.0/16",
-                "93.62.0.0/15",
-                "217.29.66.0/23",
-                "217.29.72.0/21"
-            ])
-
-            assert ip_info_db.search_exact(
-                "217.29.66.0/23"
-            ).data["ip_db_info"] == IPDBInfo(
-                prefix=ipaddress.ip_network("217.29.66.0/23"),
-                origins=None,
-                ixp_network=IXPNetwork(
-                    lan_name=None,
-                    ix_name="MIX-IT",
-                    ix_description="Milan Internet eXchange"
-                )
-            )
+    # Now, let's verify that the IP info store shared by
+    # the enrichers of the consumer threads got populated.
+    # This is to ensure that the IXPNetworksUpdater properly
+    # dispatch the IP info entries to the enrichers.
+    ip_info_db = ip_info_store.radix
+
+    assert len(ip_info_db.nodes()) == 4
+
+    assert sorted(ip_info_db.prefixes()) == sorted([
+        "89.97.0.0/16",
+        "93.62.0.0/15",
+        "217.29.66.0/23",
+        "217.29.72.0/21"
+    ])
+
+    assert ip_info_db.search_exact(
+        "217.29.66.0/23"
+    ).data["ip_db_info"] == IPDBInfo(
+        prefix=ipaddress.ip_network("217.29.66.0/23"),
+        origins=None,
+        ixp_network=IXPNetwork(
+            lan_name=None,
+            ix_name="MIX-IT",
+            ix_description="Milan Internet eXchange"
+        )
+    )
 
     # Check now that the IP Info DB is populated properly.
     db_prefixes = IPInfo_Prefix.select()
@@ -0,0 +1,204 @@
+from unittest.mock import MagicMock
+import ipaddress
+import json
+import queue
+import time
+
+from rich_traceroute.enrichers.async_channel import TracerouteDispatcherChannel
+from rich_traceroute.enrichers.codecs import EncodedMessage, JSONCodec
+from rich_traceroute.enrichers.consumer import ConsumerThread
+from rich_traceroute.enrichers.dispatcher import (
+    EnrichmentJobsDispatcher,
+    IPInfoBatcher
+)
+from rich_traceroute.enrichers.ip_info_store import ip_info_store
+from rich_traceroute.structures import (
+    EnricherJob,
+    EnricherJob_Host,
+    IPDBInfo,
+    IXPNetwork
+)
+
+from .conftest import metrics_mock_wrapper
+
+
+def _ip_info(n: int) -> IPDBInfo:
+    return IPDBInfo(
+        prefix=ipaddress.ip_network(f"10.{n // 256}.{n % 256}.0/24"),
+        origins=[(65500 + n, f"AS{65500 + n} holder")],
+        ixp_network=None
+    )
+
+
+def _enqueue(q: queue.Queue, ip_infos) -> None:
+    for ip_info in ip_infos:
+        q.put((time.monotonic(), ip_info))
+
+
+def _decode(batch: EncodedMessage):
+    assert batch.content_type == "application/json"
+    return JSONCodec().decode_ip_infos(batch.body)
+
+
+def test_ipinfo_batcher_max_entries():
+    q: queue.Queue = queue.Queue()
+    batcher = IPInfoBatcher(q, JSONCodec(), max_entries=4, max_size=64 * 1024, max_linger=60)
+
+    ip_infos = [_ip_info(n) for n in range(10)]
+    _enqueue(q, ip_infos)
+
+    assert _decode(batcher.get_batch()) == ip_infos[0:4]
+    assert _decode(batcher.get_batch()) == ip_infos[4:8]
+
+    # Not full yet, and not waiting since long enough.
+    assert batcher.get_batch() is None
+    assert len(batcher.pending) == 2
+
+    _enqueue(q, [_ip_info(10), _ip_info(11)])
+
+    assert _decode(batcher.get_batch()) == ip_infos[8:10] + [_ip_info(10), _ip_info(11)]
+    assert batcher.get_batch() is None
+
+
+def test_ipinfo_batcher_max_size():
+    q: queue.Queue = queue.Queue()
+
+    entry_len = len(JSONCodec().encode_ip_info(_ip_info(0)))
+
+    # Room for 3 entries only.
+    batcher = IPInfoBatcher(
+        q, JSONCodec(), max_entries=100,
+        max_size=IPInfoBatcher.BATCH_OVERHEAD + 3 * (entry_len + 1), max_linger=60
+    )
+
+    ip_infos = [_ip_info(n) for n in range(5)]
+    _enqueue(q, ip_infos)
+
+    batch = batcher.get_batch()
+    assert len(batch.body) <= batcher.max_size
+    assert _decode(batch) == ip_infos[0:3]
+
+    assert batcher.get_batch() is None
+
+
+def test_ipinfo_batcher_max_linger():
+    q: queue.Queue = queue.Queue()
+    batcher = IPInfoBatcher(q, JSONCodec(), max_entries=100, max_size=64 * 1024, max_linger=0.3)
+
+    _enqueue(q, [_ip_info(0)])
+    assert batcher.get_batch() is None
+
+    time.sleep(0.2)
+    _enqueue(q, [_ip_info(1)])
+    assert batcher.get_batch() is None
+
+    # The oldest entry has been waiting long enough.
+    time.sleep(0.2)
+
+    assert _decode(batcher.get_batch()) == [_ip_info(0), _ip_info(1)]
+
+    entries = metrics_mock_wrapper.mm.filter_records(
+        "histogram", stat="rich_traceroute.enrichers.dispatcher.ipinfo_batch.entries"
+    )
+    assert entries[-1][2] == 2
+
+
+def test_receive_ip_info_batch(mocker):
+    ip_infos = [
+        _ip_info(0),
+        IPDBInfo(
+            prefix=ipaddress.ip_network("2001:db8::/64"),
+            origins=None,
+            ixp_network=IXPNetwork("LAN", "IX", "IX description")
+        )
+    ]
+
+    body = json.dumps([ip_info.to_compact_list() for ip_info in ip_infos]).encode()
+
+    ch = MagicMock()
+    add_many = mocker.spy(ip_info_store, "add_many")
+
+    ConsumerThread.receive_ip_info_data(None, ch, MagicMock(delivery_tag=1), None, body)
+
+    # One ack and one store update for the whole batch.
+    ch.basic_ack.assert_called_once_with(delivery_tag=1)
+    add_many.assert_called_once_with(ip_infos)
+
+    assert ip_info_store.lookup(ipaddress.ip_address("2001:db8::1")) == ip_infos[1]
+
+    # Messages in the previous format are still accepted.
+    body = json.dumps(_ip_info(1).to_json_dict()).encode()
+
+    ConsumerThread.receive_ip_info_data(None, ch, MagicMock(delivery_tag=2), None, body)
+
+    assert ip_info_store.lookup(ipaddress.ip_address("10.0.1.1")) == _ip_info(1)
+
+
+def test_dispatcher_publish_on_dispatch():
+    dispatcher = EnrichmentJobsDispatcher()
+    dispatcher.reconnector.async_connection = MagicMock()
+
+    request_publish = dispatcher.reconnector.async_connection.request_publish
+
+    jobs = [
+        EnricherJob(f"t{n}", [EnricherJob_Host(1, f"h{n}", "192.0.2.1")])
+        for n in range(3)
+    ]
+
+    metrics_mock_wrapper.mm.clear_records()
+
+    for job in jobs:
+        dispatcher.dispatch(job)
+
+    # Only one wake up for the jobs enqueued before
+    # the ioloop gets to publish them.
+    assert request_publish.call_count == 1
+
+    assert [
+        JSONCodec().decode_job(dispatcher.get_message_to_publish().body)
+        for _ in jobs
+    ] == jobs
+    assert dispatcher.get_message_to_publish() is None
+
+    dispatcher.dispatch(jobs[0])
+    assert request_publish.call_count == 2
+
+    latency = metrics_mock_wrapper.mm.filter_records(
+        "timing",
+        stat="rich_traceroute.enrichers.dispatcher.traceroute_dispatcher.dispatch_to_publish"
+    )
+    assert len(latency) == 3
+
+
+def test_channel_request_publish():
+    connection = MagicMock()
+    messages = [
+        EncodedMessage(b"msg1", "application/json", 1),
+        EncodedMessage(b"msg2", "application/json", 1)
+    ]
+
+    channel = TracerouteDispatcherChannel(
+        name="test",
+        connection=connection,
+        close_connection=MagicMock(),
+        get_message_to_publish=lambda: messages.pop(0) if messages else None
+    )
+    channel.channel = MagicMock(is_open=True)
+
+    channel.request_publish()
+
+    # Messages are published by the ioloop thread.
+    connection.ioloop.add_callback_threadsafe.assert_called_once_with(
+        channel.publish_pending_messages
+    )
+    assert channel.channel.basic_publish.call_count == 0
+
+    channel.publish_pending_messages()
+
+    calls = channel.channel.basic_publish.call_args_list
+
+    assert [c[1]["body"] for c in calls] == [b"msg1", b"msg2"]
+
+    # The receiver picks the codec on the basis of these.
+    assert calls[0][1]["properties"].content_type == "application/json"
+    assert calls[0][1]["properties"].headers == {"version": 1}
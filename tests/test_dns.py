@@ -1,4 +1,130 @@
-from rich_traceroute.enrichers.dns import ip_to_name, name_to_ip
+from typing import Dict, Optional, Set
+import socket
+import threading
+import time
+
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import pytest
+
+import rich_traceroute.enrichers.dns as rt_dns
+from rich_traceroute.enrichers.dns import (
+    ip_to_name,
+    name_to_ip,
+    setup_resolver
+)
+
+
+class StubDNSServer(threading.Thread):
+    """Minimal authoritative-like DNS server for the tests."""
+
+    def __init__(
+        self,
+        records: Dict[str, str],
+        delay: float = 0,
+        drop: Optional[Set[str]] = None
+    ):
+        super().__init__(name="StubDNSServer")
+
+        self.daemon = True
+
+        self.records = records
+        self.delay = delay
+        self.drop = drop or set()
+
+        self.queries = []
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+
+        self.stop_requested = False
+
+    def _answer(self, query: dns.message.Message, addr) -> None:
+        question = query.question[0]
+        qname = question.name.to_text()
+
+        response = dns.message.make_response(query)
+
+        if qname in self.records:
+            response.answer.append(
+                dns.rrset.from_text(
+                    question.name, 60, "IN",
+                    dns.rdatatype.to_text(question.rdtype),
+                    self.records[qname]
+                )
+            )
+        else:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+
+        try:
+            self.sock.sendto(response.to_wire(), addr)
+        except OSError:
+            # Server already stopped.
+            pass
+
+    def run(self):
+        self.sock.settimeout(0.1)
+
+        while not self.stop_requested:
+            try:
+                wire, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+
+            query = dns.message.from_wire(wire)
+            qname = query.question[0].name.to_text()
+
+            self.queries.append(qname)
+
+            if qname in self.drop:
+                continue
+
+            if self.delay:
+                threading.Timer(self.delay, self._answer, (query, addr)).start()
+            else:
+                self._answer(query, addr)
+
+    def stop(self):
+        self.stop_requested = True
+        self.join()
+        self.sock.close()
+
+
+RECORDS = {
+    "1.2.0.192.in-addr.arpa.": "router1.example.net.",
+    "router1.example.net.": "192.0.2.1",
+}
+
+
+@pytest.fixture
+def stub_dns(request):
+    params = getattr(request, "param", {})
+
+    server = StubDNSServer(RECORDS, **params)
+    server.start()
+
+    for cache in (
+        rt_dns.name_to_ip_cache,
+        rt_dns.ip_to_name_cache,
+        rt_dns.name_to_ip_negative_cache,
+        rt_dns.ip_to_name_negative_cache,
+    ):
+        cache.clear()
+
+    resolver = setup_resolver(["127.0.0.1"], port=server.port)
+    resolver.timeout = 1
+    resolver.retry_interval = 0.5
+
+    yield server
+
+    resolver.stop()
+    resolver.join()
+    rt_dns.resolver = None
+
+    server.stop()
 
 
 def test_dns_name_to_ip():
@@ -7,3 +133,95 @@ def test_dns_name_to_ip():
 
 def test_dns_ip_to_name():
     assert ip_to_name("1.1.1.1") == "one.one.one.one"
+
+
+def test_dns_stub_lookups(stub_dns):
+    assert ip_to_name("192.0.2.1") == "router1.example.net"
+    assert name_to_ip("router1.example.net") == "192.0.2.1"
+
+    # Served from the cache.
+    assert ip_to_name("192.0.2.1") == "router1.example.net"
+    assert name_to_ip("router1.example.net") == "192.0.2.1"
+
+    assert stub_dns.queries == [
+        "1.2.0.192.in-addr.arpa.",
+        "router1.example.net."
+    ]
+
+
+@pytest.mark.parametrize("stub_dns", [{"delay": 0.3}], indirect=True)
+def test_dns_coalescing(stub_dns):
+    results = []
+
+    def _lookup():
+        results.append(ip_to_name("192.0.2.1"))
+
+    threads = [threading.Thread(target=_lookup) for _ in range(10)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["router1.example.net"] * 10
+
+    # Only one query was sent for the 10 concurrent lookups.
+    assert stub_dns.queries == ["1.2.0.192.in-addr.arpa."]
+
+
+@pytest.mark.parametrize("stub_dns", [{"delay": 0.3}], indirect=True)
+def test_dns_pipelining(stub_dns):
+    results = []
+
+    def _lookup(n):
+        results.append(ip_to_name(f"192.0.2.{n}"))
+
+    threads = [
+        threading.Thread(target=_lookup, args=(n,))
+        for n in range(1, 21)
+    ]
+
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+
+    # 20 queries, all of them in flight at the same time.
+    assert len(stub_dns.queries) == 20
+    assert elapsed < 20 * 0.3 / 4
+
+    assert sorted(results) == [""] * 19 + ["router1.example.net"]
+
+
+def test_dns_negative_cache(stub_dns):
+    assert ip_to_name("192.0.2.99") == ""
+    assert ip_to_name("192.0.2.99") == ""
+
+    assert stub_dns.queries == ["99.2.0.192.in-addr.arpa."]
+
+    assert "192.0.2.99" in rt_dns.ip_to_name_negative_cache
+    assert "192.0.2.99" not in rt_dns.ip_to_name_cache
+
+    # Negative entries have their own, shorter, TTL.
+    assert rt_dns.ip_to_name_negative_cache.ttl < rt_dns.ip_to_name_cache.ttl
+
+
+@pytest.mark.parametrize(
+    "stub_dns", [{"drop": {"1.2.0.192.in-addr.arpa."}}], indirect=True
+)
+def test_dns_timeout(stub_dns):
+    start = time.perf_counter()
+    assert ip_to_name("192.0.2.1") == ""
+    elapsed = time.perf_counter() - start
+
+    assert 0.9 < elapsed < 2
+
+    # The query is retransmitted until the timeout expires.
+    assert len(stub_dns.queries) >= 2
+
+    # Timeouts are cached as failures too.
+    assert "192.0.2.1" in rt_dns.ip_to_name_negative_cache
@@ -1,33 +1,71 @@
 import pytest
-from unittest.mock import MagicMock, call
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import ANY, MagicMock, call
 from ipaddress import IPv4Address, IPv4Network
 import datetime
+import threading
+import time
+from typing import List
+
+import requests
 
 from rich_traceroute.traceroute import (
     create_traceroute,
-    Traceroute
+    load_traceroute,
+    Traceroute,
+    Hop,
+    Host,
+    HostOrigins,
+    HostIXPNetwork
 )
+from rich_traceroute.db import db
 from rich_traceroute.enrichers.enricher import Enricher
+from rich_traceroute.enrichers.ip_info_backfiller import IPInfoBackfiller, ip_info_backfiller
+from rich_traceroute.enrichers.ip_info_store import ip_info_store
+from rich_traceroute.enrichers.ripestat import (
+    get_ripestat_executor,
+    ripestat_circuit_breaker
+)
+from rich_traceroute.enrichers.socketio_emitter import SocketIOEmitter
+from rich_traceroute.errors import ExternalSourceTransientError, ExternalSourceUnavailableError
 from rich_traceroute.structures import EnricherJob, IPDBInfo, IXPNetwork
 
+from .conftest import metrics_mock_wrapper
+
 
 # Will be set by the fixture and made available to the
 # test case function for inspection.
 get_ip_info_from_external_sources_mock = None
 enricher: Enricher
 
+# Executors created by _setup_enricher; they are shut down
+# at the end of each test.
+executors: List[ThreadPoolExecutor] = []
+
 
 @pytest.fixture(autouse=True)
 def prevent_any_rabbitmq_connection(db, mocker):
 
     _setup_enricher(mocker)
 
+    yield
+
+    while executors:
+        executors.pop().shutdown(wait=True)
+
 
 def _setup_enricher(mocker):
     global enricher
 
     enricher = Enricher("enricher-1", None)
 
+    # RIPEstat queries are run one at a time, so that the
+    # IP info fetched for an IP can be reused for the next
+    # ones deterministically.
+    enricher.ripestat_executor = ThreadPoolExecutor(max_workers=1)
+
+    executors.extend([enricher.hosts_executor, enricher.ripestat_executor])
+
     def process_job_locally(job: EnricherJob) -> None:
         enricher.process_traceroute_enrichment_job(job)
 
@@ -55,15 +93,14 @@ def _setup_enricher(mocker):
         pass
 
     mocker.patch(
-        "rich_traceroute.enrichers.enricher.SocketIO.emit",
+        "rich_traceroute.enrichers.socketio_emitter.SocketIO.emit",
         socketio_emit
     )
 
-    # To simulate the thread startup, I'm invoking
-    # the _load_ip_info_entries_from_db method of the enricher
-    # instance here: this would normally happen as soon as
-    # the enricher thread runs.
-    enricher._load_ip_info_entries_from_db()
+    # To simulate the consumers startup, I'm loading the
+    # IP info store here: this would normally happen as soon
+    # as the consumer threads are set up.
+    ip_info_store.load_from_db()
 
 
 def test_enricher_basic():
@@ -73,17 +110,26 @@ def test_enricher_basic():
     # Verify the calls to the function that's used to
     # retrieve IP information from external sources.
 
-    # Please note: a call for hop 9 IP 216.239.50.241 should not
-    # be performed because an entry for 216.239.32.0/19 should
-    # be found while getting IPDBInfo for 216.239.51.9
-    assert get_ip_info_from_external_sources_mock.call_args_list == [
-        call(IPv4Address("89.97.200.190")),
-        call(IPv4Address("62.101.124.17")),      # 62-101-124-17.fastres.net
-        call(IPv4Address("209.85.168.64")),
-        call(IPv4Address("216.239.51.9")),
-        # call(IPv4Address("216.239.50.241")), <<< expected to be missing
-        call(IPv4Address("8.8.8.8"))
-    ]
+    # Please note: only one call is expected for hop 8 IP
+    # 216.239.51.9 and hop 9 IP 216.239.50.241, because the
+    # entry for 216.239.32.0/19 fetched for the first one to
+    # be resolved should be found for the other one.
+    # Calls are performed as soon as hosts are resolved, so
+    # their order may vary.
+    assert get_ip_info_from_external_sources_mock.call_count == 5
+    get_ip_info_from_external_sources_mock.assert_has_calls(
+        [
+            call(IPv4Address("89.97.200.190"), ANY),
+            call(IPv4Address("62.101.124.17"), ANY),      # 62-101-124-17.fastres.net
+            call(IPv4Address("209.85.168.64"), ANY),
+            call(IPv4Address("8.8.8.8"), ANY)
+        ],
+        any_order=True
+    )
+    assert len([
+        c for c in get_ip_info_from_external_sources_mock.call_args_list
+        if c[0][0] in (IPv4Address("216.239.51.9"), IPv4Address("216.239.50.241"))
+    ]) == 1
 
     # Verify that the traceroute is marked as parsed
     # and enriched properly.
@@ -160,10 +206,22 @@ def test_enricher_basic():
     t.to_json()
 
 
+def test_enricher_single_cache_lookup(mocker):
+    # Each host is looked up only once in the cache, by the
+    # RIPEstat task (queries are run one at a time here, so
+    # no task waits for the fetch of another one).
+    get_ip_info_from_db_mock = mocker.spy(enricher, "_get_ip_info_from_db")
+
+    raw = open("tests/data/traceroute/mtr_json_1.json").read()
+    create_traceroute(raw)
+
+    assert get_ip_info_from_db_mock.call_count == 6
+
+
 def test_enricher_expired_cache():
     """
     Create a traceroute, then manipulate the enrichers
-    ip_info_db PyRadix object to mark an entry as
+    IP info store PyRadix object to mark an entry as
     expired, to verify that the code works properly and
     the information for that prefix are retrieved again
     from the external sources.
@@ -180,7 +238,7 @@ def test_enricher_expired_cache():
     # Mark an enricher's cache entry as updated one year
     # ago, so it will be discarded during the next
     # enrichement process.
-    enricher.ip_info_db.search_exact(
+    ip_info_store.radix.search_exact(
         "89.97.0.0/16"
     ).data["last_updated"] = datetime.datetime.utcnow() - datetime.timedelta(days=365)
 
@@ -212,12 +270,14 @@ def test_enricher_load_from_db(mocker):
     # expected to be called 5 times.
     assert len(get_ip_info_from_external_sources_mock.call_args_list) == 5
 
-    # Now destroy the enricher and create it from scratch.
-    # IP Info entries that were previously retrieved will
-    # be loaded from the DB.
+    # Now destroy the enricher and the IP info store, as it
+    # would happen when the process is restarted, and create
+    # them from scratch. IP Info entries that were previously
+    # retrieved will be loaded from the DB.
+    ip_info_store.reset()
     _setup_enricher(mocker)
 
-    assert len(enricher.ip_info_db.prefixes()) == 5
+    assert len(ip_info_store.radix.prefixes()) == 5
 
     # Run a second enrichment process for the same traceroute.
     raw = open("tests/data/traceroute/mtr_json_1.json").read()
@@ -230,6 +290,502 @@ def test_enricher_load_from_db(mocker):
     assert len(get_ip_info_from_external_sources_mock.call_args_list) == 0
 
 
+def test_enricher_concurrent_external_queries(mocker):
+    """
+    Verify that the IP info missing from the cache are
+    fetched concurrently, using the pool shared by the
+    enrichers, and that the same prefix is not dispatched
+    twice within the same job.
+    """
+
+    enricher.ripestat_executor = get_ripestat_executor()
+
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    urls = []
+
+    original_ripe_stat_query = Enricher._ripe_stat_query
+
+    def slow_ripe_stat_query(self, url, deadline=None):
+        nonlocal in_flight, max_in_flight
+
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            urls.append(url)
+
+        time.sleep(0.2)
+
+        with lock:
+            in_flight -= 1
+
+        return original_ripe_stat_query(self, url, deadline)
+
+    mocker.patch.object(Enricher, "_ripe_stat_query", slow_ripe_stat_query)
+
+    dispatched = []
+    mocker.patch(
+        "rich_traceroute.enrichers.enricher.dispatch_ipinfo",
+        lambda ip_info: dispatched.append(ip_info.prefix)
+    )
+
+    raw = open("tests/data/traceroute/mtr_json_1.json").read()
+    create_traceroute(raw)
+
+    assert max_in_flight > 1
+
+    # 216.239.50.241 and 216.239.51.9 are covered by the same
+    # prefix: the lookup of the second one waits for the fetch
+    # of the first one, and finds its info in the cache.
+    assert len(urls) == 5
+    assert len([
+        url for url in urls
+        if "216.239.51.9" in url or "216.239.50.241" in url
+    ]) == 1
+
+    assert sorted(dispatched) == sorted(set(dispatched))
+    assert len(dispatched) == 5
+
+    t = load_traceroute(Traceroute.select()[0].id)
+    host = t.get_hop_n(9).hosts[0]
+    assert str(host.ip) == "216.239.50.241"
+    assert host.origins[0].asn == 15169
+
+
+def test_enricher_coalesce_external_queries(mocker):
+    """
+    Verify that concurrent lookups of the same IP, also from
+    different enrichers, share the same query.
+    """
+
+    metrics_mock_wrapper.mm.clear_records()
+
+    urls = []
+
+    original_ripe_stat_query = Enricher._ripe_stat_query
+
+    def slow_ripe_stat_query(self, url, deadline=None):
+        urls.append(url)
+
+        time.sleep(0.2)
+
+        return original_ripe_stat_query(self, url, deadline)
+
+    mocker.patch.object(Enricher, "_ripe_stat_query", slow_ripe_stat_query)
+
+    other_enricher = Enricher("enricher-2", None)
+
+    results = []
+
+    threads = [
+        threading.Thread(
+            target=lambda e: results.append(e._get_ip_info_for_ip(IPv4Address("8.8.8.8"))),
+            args=(e,)
+        )
+        for e in (enricher, other_enricher)
+    ]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(urls) == 1
+
+    # Only one of them actually fetched the info.
+    assert sorted(fetched for _, fetched in results) == [False, True]
+    assert all(
+        ip_info.prefix == IPv4Network("8.8.8.0/24")
+        for ip_info, _ in results
+    )
+
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat="rich_traceroute.enrichers.enricher.ip_info_fetch.coalesced"
+    )) == 1
+
+
+def test_enricher_parallel_hosts(mocker):
+    """
+    Verify that slow DNS lookups don't stall the enrichment
+    of the other hosts of the traceroute, and that the
+    completed event is emitted only after all the hosts
+    are done.
+    """
+
+    original_get_hostname_from_ip = Enricher._get_hostname_from_ip
+
+    lookups = []
+
+    def slow_get_hostname_from_ip(ip):
+        lookups.append(ip)
+        time.sleep(0.2)
+        return original_get_hostname_from_ip(ip)
+
+    mocker.patch.object(
+        Enricher, "_get_hostname_from_ip", staticmethod(slow_get_hostname_from_ip)
+    )
+
+    events = []
+
+    mocker.patch.object(
+        enricher, "emit_host_enriched_event",
+        lambda traceroute_id, host: events.append(host.original_host)
+    )
+    mocker.patch.object(
+        enricher, "emit_enrichment_completed_event",
+        lambda traceroute: events.append("completed")
+    )
+
+    raw = open("tests/data/traceroute/mtr_json_1.json").read()
+
+    start = time.perf_counter()
+    t = create_traceroute(raw)
+    elapsed = time.perf_counter() - start
+
+    # 4 hosts at a time (workers.host_concurrency).
+    assert enricher.hosts_executor._max_workers == 4
+    assert len(lookups) == 4
+    assert elapsed < 4 * 0.2
+
+    # One event per host, then the completed one.
+    assert len(events) == 11
+    assert events[-1] == "completed"
+
+    t = load_traceroute(t.id)
+    assert t.enriched is True
+    assert all(
+        host.enriched
+        for hop in t.hops
+        for host in hop.hosts
+    )
+
+
+def test_enricher_resume_job(mocker):
+    """
+    Simulate a job that is sent again after the worker
+    processing it died: only the hosts that were not
+    enriched yet must be processed, and their origins and
+    IXP networks must not be duplicated.
+    """
+
+    raw = open("tests/data/traceroute/mtr_json_1.json").read()
+    t = create_traceroute(raw)
+
+    def _host_rows():
+        return (
+            sorted((o.host_id_id, o.asn) for o in HostOrigins.select()),
+            sorted(n.host_id_id for n in HostIXPNetwork.select())
+        )
+
+    rows = _host_rows()
+    assert rows[0]
+
+    # Hosts whose enrichment was interrupted.
+    hosts = [
+        host
+        for hop in load_traceroute(t.id).hops
+        for host in hop.hosts
+        if host.origins or host.ixp_network
+    ][:2]
+
+    Host.update(enriched=False).where(
+        Host.id.in_([host.id for host in hosts])
+    ).execute()
+
+    resolve_host = mocker.spy(enricher, "_resolve_host")
+
+    Traceroute.get(Traceroute.id == t.id).dispatch_to_enrichers()
+
+    assert sorted(c[0][0].host_id for c in resolve_host.call_args_list) == \
+        sorted(host.id for host in hosts)
+
+    assert _host_rows() == rows
+
+    t = load_traceroute(t.id)
+    assert t.enriched is True
+    assert all(
+        host.enriched
+        for hop in t.hops
+        for host in hop.hosts
+    )
+
+
+def test_enricher_circuit_breaker_backfill(mocker):
+    """
+    While the RIPEstat circuit breaker is open, jobs are
+    completed using the IP info that are already known, and
+    the missing ones are backfilled later.
+    """
+
+    for _ in range(ripestat_circuit_breaker.failure_threshold):
+        ripestat_circuit_breaker.record_failure()
+
+    ripe_stat_query = mocker.spy(Enricher, "_ripe_stat_query")
+
+    mocker.patch(
+        "rich_traceroute.enrichers.ip_info_backfiller.dispatch_ipinfo",
+        lambda ip_info: None
+    )
+
+    raw = open("tests/data/traceroute/mtr_json_1.json").read()
+    t = create_traceroute(raw)
+
+    # One attempt for each IP, RIPEstat never queried.
+    assert get_ip_info_from_external_sources_mock.call_count == 6
+    assert ripe_stat_query.call_count == 0
+
+    t = load_traceroute(t.id)
+    assert t.enriched is True
+    assert not any(
+        host.origins
+        for hop in t.hops
+        for host in hop.hosts
+    )
+
+    assert len(ip_info_backfiller.pending) == 6
+
+    emit_enrichment_completed = mocker.patch.object(
+        SocketIOEmitter, "emit_enrichment_completed"
+    )
+
+    # RIPEstat is back.
+    ripestat_circuit_breaker.reset()
+
+    # 216.239.50.241 is covered by the prefix fetched
+    # for 216.239.51.9.
+    assert ip_info_backfiller.run() == 1
+    assert ripe_stat_query.call_count == 5
+
+    assert ip_info_backfiller.pending == {}
+
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat="rich_traceroute.enrichers.ip_info_backfiller.hosts_updated"
+    )) == 6
+
+    # The pages showing the traceroute get the updated version.
+    emit_enrichment_completed.assert_called_once()
+    emitted = emit_enrichment_completed.call_args[0][0]
+    assert emitted.id == t.id
+    assert emitted.get_hop_n(10).hosts[0].origins[0].asn == 15169
+
+    t = load_traceroute(t.id)
+    host = t.get_hop_n(10).hosts[0]
+    assert str(host.ip) == "8.8.8.8"
+    assert [(o.asn, o.holder) for o in host.origins] == [(15169, "GOOGLE")]
+
+    host = t.get_hop_n(9).hosts[0]
+    assert str(host.ip) == "216.239.50.241"
+    assert host.origins[0].asn == 15169
+
+
+def test_enricher_circuit_breaker_opens(mocker):
+    """
+    Consecutive RIPEstat failures open the circuit breaker.
+    """
+
+    def failing_ripe_stat_query(self, url, deadline=None):
+        raise requests.ConnectionError()
+
+    mocker.patch.object(Enricher, "_ripe_stat_query", failing_ripe_stat_query)
+
+    for _ in range(ripestat_circuit_breaker.failure_threshold):
+        assert ripestat_circuit_breaker.is_closed
+        with pytest.raises(ExternalSourceTransientError):
+            enricher._get_ip_info_from_external_sources(IPv4Address("8.8.8.8"))
+
+    assert not ripestat_circuit_breaker.is_closed
+
+    with pytest.raises(ExternalSourceUnavailableError):
+        enricher._get_ip_info_from_external_sources(IPv4Address("8.8.8.8"))
+
+
+@pytest.mark.parametrize(
+    "status_code,is_failure",
+    [
+        (400, False),
+        (404, False),
+        (429, True),
+        (500, True),
+        (503, True),
+    ]
+)
+def test_enricher_circuit_breaker_status_codes(mocker, status_code, is_failure):
+    """
+    Only the responses that mean that RIPEstat is not working
+    are counted by the circuit breaker.
+    """
+
+    def ripe_stat_query(self, url, deadline=None):
+        response = requests.Response()
+        response.status_code = status_code
+        return response
+
+    mocker.patch.object(Enricher, "_ripe_stat_query", ripe_stat_query)
+
+    for _ in range(ripestat_circuit_breaker.failure_threshold):
+        if is_failure:
+            with pytest.raises(ExternalSourceTransientError):
+                enricher._get_ip_info_from_external_sources(IPv4Address("8.8.8.8"))
+        else:
+            assert enricher._get_ip_info_from_external_sources(IPv4Address("8.8.8.8")) is None
+
+    assert ripestat_circuit_breaker.is_closed is not is_failure
+
+
+def test_ip_info_backfiller_transient_failures():
+    """
+    IPs whose info can't be fetched because of transient
+    failures are kept pending, up to max_attempts passes.
+    """
+
+    metrics_mock_wrapper.mm.clear_records()
+
+    def failing_fetch(ip):
+        raise ExternalSourceTransientError()
+
+    def not_found_fetch(ip):
+        return None
+
+    backfiller = IPInfoBackfiller(max_attempts=2)
+    backfiller.add(IPv4Address("8.8.8.8"), "1", "1", failing_fetch)
+
+    assert backfiller.run() == 0
+    assert list(backfiller.pending) == [IPv4Address("8.8.8.8")]
+
+    assert backfiller.run() == 0
+    assert backfiller.pending == {}
+
+    prefix = "rich_traceroute.enrichers.ip_info_backfiller"
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat=f"{prefix}.failed_attempts"
+    )) == 1
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat=f"{prefix}.given_up"
+    )) == 1
+
+    # IPs that are not found are not attempted again.
+    backfiller.add(IPv4Address("8.8.8.8"), "1", "1", not_found_fetch)
+
+    assert backfiller.run() == 0
+    assert backfiller.pending == {}
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat=f"{prefix}.not_found"
+    )) == 1
+
+
+def test_traceroute_parse_bulk_insert(mocker):
+    """
+    Verify that the enrichment job built by Traceroute.parse
+    using the hosts IDs generated in memory matches the
+    records that are actually stored in the DB.
+    """
+
+    jobs = []
+
+    mocker.patch(
+        "rich_traceroute.traceroute.dispatch_traceroute_enrichment_job",
+        jobs.append
+    )
+
+    # Multiple hosts per hop.
+    raw = open("tests/data/traceroute/bsd_1.txt").read()
+    t = create_traceroute(raw)
+
+    assert t.parsed is True
+    assert Traceroute.get(Traceroute.id == t.id).parsed is True
+
+    assert len(jobs) == 1
+    job = jobs[0]
+
+    assert job.traceroute_id == t.id
+    assert len(job.hosts) == 13
+
+    db_hosts = [
+        (hop.hop_number, host.id, host.original_host)
+        for hop in t.hops
+        for host in hop.hosts
+    ]
+
+    assert sorted(job.hosts) == sorted(db_hosts)
+
+    hop = t.get_hop_n(5)
+    assert sorted(host.original_host for host in hop.hosts) == [
+        "89.97.200.186",
+        "89.97.200.190",
+        "89.97.200.201"
+    ]
+
+
+def test_traceroute_parse_atomic(mocker):
+    """
+    If something goes wrong while storing hops and hosts,
+    none of them must be saved and the traceroute must not
+    be marked as parsed.
+    """
+
+    jobs = []
+
+    mocker.patch(
+        "rich_traceroute.traceroute.dispatch_traceroute_enrichment_job",
+        jobs.append
+    )
+
+    def failing_insert_many(*args, **kwargs):
+        raise RuntimeError("Test")
+
+    mocker.patch.object(Host, "insert_many", failing_insert_many)
+
+    raw = open("tests/data/traceroute/bsd_1.txt").read()
+
+    with pytest.raises(RuntimeError):
+        create_traceroute(raw)
+
+    t = Traceroute.select()[0]
+
+    assert t.parsed is False
+    assert Hop.select().count() == 0
+    assert Host.select().count() == 0
+    assert jobs == []
+
+
+def test_load_traceroute(mocker):
+    """
+    Verify that the rendering of a traceroute loaded via
+    load_traceroute is performed using a constant number
+    of queries, regardless of the n. of hops and hosts.
+    """
+
+    execute_sql_spy = mocker.spy(db.obj, "execute_sql")
+
+    for path in [
+        "tests/data/traceroute/mtr_json_1.json",
+        "tests/data/traceroute/bsd_1.txt"
+    ]:
+        raw = open(path).read()
+        t_id = create_traceroute(raw).id
+
+        execute_sql_spy.reset_mock()
+
+        t = load_traceroute(t_id)
+        t_dict = t.to_dict()
+        t_text = t.to_text()
+
+        # Traceroute, Hop, Host, HostOrigins, HostIXPNetwork
+        assert execute_sql_spy.call_count == 5
+
+        # The output must be the same that is obtained
+        # when the traceroute is lazily loaded.
+        t = Traceroute.get(Traceroute.id == t_id)
+        assert t_dict == t.to_dict()
+        assert t_text == t.to_text()
+
+        assert list(t_dict["hops"].keys()) == sorted(t_dict["hops"].keys())
+
+    with pytest.raises(Traceroute.DoesNotExist):
+        load_traceroute("123456")
+
+
 def test_traceroute_to_text():
 
     def _normalize_text(s):
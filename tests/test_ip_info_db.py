@@ -2,10 +2,14 @@ import ipaddress
 import datetime
 import time
 
+from rich_traceroute.db import db as rt_db
+
 from rich_traceroute.ip_info_db import (
     IPInfo_Prefix,
     IPInfo_Origin,
     IPInfo_IXPNetwork,
+    bulk_upsert,
+    iter_ip_info_entries,
     remove_old_entries
 )
 from rich_traceroute.structures import IPDBInfo, IXPNetwork
@@ -256,3 +260,120 @@ def test_ip_info_db_remove_old_entries(db):
 
     origins = IPInfo_Origin.select()
     assert len(origins) == 1
+
+
+def test_ip_info_db_iter_entries(db, mocker):
+    """Bulk loading of the entries, compared to the ORM objects."""
+
+    for n in range(7):
+        origins = [(65500 + i, f"AS{65500 + i}") for i in range(n % 3)]
+
+        ixp_network = None
+        if n % 2:
+            ixp_network = IXPNetwork(
+                lan_name=None,
+                ix_name=f"IX {n}",
+                ix_description=None
+            )
+
+        IPInfo_Prefix.create_from_ipdbinfo(
+            IPDBInfo(
+                prefix=ipaddress.ip_network(f"192.0.{n}.0/24"),
+                origins=origins or None,
+                ixp_network=ixp_network
+            )
+        )
+
+    # An IXP network whose attributes are all None.
+    IPInfo_Prefix.create_from_ipdbinfo(
+        IPDBInfo(
+            prefix=ipaddress.ip_network("2001:db8::/32"),
+            origins=None,
+            ixp_network=IXPNetwork(None, None, None)
+        )
+    )
+
+    expected = sorted(
+        [
+            (db_prefix.to_ipdbinfo(), db_prefix.last_updated)
+            for db_prefix in IPInfo_Prefix.select()
+        ],
+        key=lambda entry: str(entry[0].prefix)
+    )
+
+    execute_sql = mocker.spy(rt_db.obj, "execute_sql")
+
+    entries = list(iter_ip_info_entries(chunk_size=3))
+
+    # 3 chunks, 2 queries each, plus the last one
+    # that returns no prefixes.
+    assert execute_sql.call_count == 7
+
+    assert sorted(entries, key=lambda entry: str(entry[0].prefix)) == expected
+
+    for ip_info, last_updated in entries:
+        assert isinstance(ip_info.prefix, (ipaddress.IPv4Network, ipaddress.IPv6Network))
+        assert isinstance(last_updated, datetime.datetime)
+
+
+def test_ip_info_db_bulk_upsert(db, mocker):
+    """Create and then update records in bulk."""
+
+    ip_infos = [
+        IPDBInfo(
+            prefix=ipaddress.ip_network(f"10.{n // 256}.{n % 256}.0/24"),
+            origins=[(65000 + n, f"AS{65000 + n}"), (64500, "AS64500")],
+            ixp_network=IXPNetwork(
+                lan_name=None,
+                ix_name=f"IX {n}",
+                ix_description=None
+            ) if n % 2 else None
+        )
+        for n in range(250)
+    ]
+
+    execute_sql = mocker.spy(rt_db.obj, "execute_sql")
+
+    assert bulk_upsert(ip_infos) == 250
+
+    # 3 batches (100, 100 and 50 prefixes). For each of them,
+    # 1 INSERT for the prefixes, 1 for every 100 origins and
+    # 1 for the IXP networks.
+    inserts = [
+        c for c in execute_sql.call_args_list
+        if c[0][0].startswith("INSERT")
+    ]
+    assert len(inserts) == 4 + 4 + 3
+
+    assert IPInfo_Prefix.select().count() == 250
+    assert IPInfo_Origin.select().count() == 500
+    assert IPInfo_IXPNetwork.select().count() == 125
+
+    for ip_info in ip_infos[:10]:
+        db_prefix = IPInfo_Prefix.get(IPInfo_Prefix.prefix == ip_info.prefix)
+        assert db_prefix.to_ipdbinfo() == ip_info
+
+    first_last_updated = IPInfo_Prefix.get(
+        IPInfo_Prefix.prefix == ip_infos[0].prefix
+    ).last_updated
+
+    time.sleep(0.01)
+
+    # Update: the last entry for the same prefix wins.
+    new_ip_info = IPDBInfo(
+        prefix=ip_infos[1].prefix,
+        origins=[(65501, "new origin")],
+        ixp_network=None
+    )
+    assert bulk_upsert([ip_infos[0], ip_infos[1], new_ip_info]) == 2
+
+    assert IPInfo_Prefix.select().count() == 250
+    assert IPInfo_Origin.select().count() == 500 - 2 + 1
+    assert IPInfo_IXPNetwork.select().count() == 124
+
+    db_prefix = IPInfo_Prefix.get(IPInfo_Prefix.prefix == ip_infos[1].prefix)
+    assert db_prefix.to_ipdbinfo() == new_ip_info
+
+    db_prefix = IPInfo_Prefix.get(IPInfo_Prefix.prefix == ip_infos[0].prefix)
+    assert db_prefix.to_ipdbinfo() == ip_infos[0]
+    assert db_prefix.last_updated > first_last_updated
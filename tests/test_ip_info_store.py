@@ -0,0 +1,417 @@
+import datetime
+import ipaddress
+import os
+import struct
+import threading
+import time
+
+import pytest
+
+from rich_traceroute.config import (
+    IP_INFO_EXPIRY,
+    IP_INFO_MAX_STALENESS,
+    IP_INFO_REFRESH_AHEAD_MIN_HITS
+)
+from rich_traceroute.enrichers.enricher import Enricher
+from rich_traceroute.enrichers.ip_info_refresher import IPInfoRefresher
+from rich_traceroute.enrichers.ip_info_store import (
+    SNAPSHOT_MAGIC,
+    SNAPSHOT_VERSION,
+    ip_info_store,
+    load_ip_info_store_snapshot,
+    sweep_ip_info_store
+)
+from rich_traceroute import ip_info_db
+from rich_traceroute.ip_info_db import IPInfo_Prefix
+from rich_traceroute.structures import IPDBInfo, IXPNetwork
+
+from .conftest import metrics_mock_wrapper
+
+
+def _ip_info(prefix: str, asn: int) -> IPDBInfo:
+    return IPDBInfo(
+        prefix=ipaddress.ip_network(prefix),
+        origins=[(asn, f"AS{asn}")],
+        ixp_network=None
+    )
+
+
+def test_ip_info_store_shared_by_enrichers():
+    enricher_1 = Enricher("enricher-1", None)
+    enricher_2 = Enricher("enricher-2", None)
+
+    enricher_1.add_ip_info_to_local_cache(
+        _ip_info("192.0.2.0/24", 65501), dispatch_to_others=False
+    )
+
+    assert enricher_2._get_ip_info_from_db(
+        ipaddress.ip_address("192.0.2.1")
+    ) == _ip_info("192.0.2.0/24", 65501)
+
+    assert enricher_2._get_ip_info_from_db(
+        ipaddress.ip_address("198.51.100.1")
+    ) is None
+
+
+def test_ip_info_store_expired_entries():
+    ip_info_store.add(
+        _ip_info("192.0.2.0/24", 65501),
+        last_updated=datetime.datetime.utcnow() - datetime.timedelta(days=365)
+    )
+
+    assert ip_info_store.lookup(ipaddress.ip_address("192.0.2.1")) is None
+    assert ip_info_store.radix.search_exact("192.0.2.0/24") is None
+
+
+def test_ip_info_store_delete_while_looking_up(mocker):
+    ip_info_store.add(_ip_info("192.0.2.0/24", 65501))
+
+    node = ip_info_store.radix.search_best("192.0.2.1")
+
+    ip_info_store.delete("192.0.2.0/24")
+
+    # A lookup that found the node right before it was deleted.
+    mocker.patch.object(ip_info_store, "radix", mocker.Mock(wraps=ip_info_store.radix))
+    ip_info_store.radix.search_best.return_value = node
+
+    assert ip_info_store.lookup(ipaddress.ip_address("192.0.2.1")) is None
+
+
+def test_ip_info_store_load_from_db_once(db, mocker):
+    IPInfo_Prefix.create_from_ipdbinfo(_ip_info("192.0.2.0/24", 65501))
+    IPInfo_Prefix.create_from_ipdbinfo(_ip_info("198.51.100.0/24", 65502))
+
+    # An entry more recent than the one in the DB.
+    ip_info_store.add(_ip_info("198.51.100.0/24", 65503))
+
+    iter_ip_info_entries = mocker.spy(ip_info_db, "iter_ip_info_entries")
+    mocker.patch(
+        "rich_traceroute.enrichers.ip_info_store.iter_ip_info_entries",
+        iter_ip_info_entries
+    )
+
+    ip_info_store.load_from_db()
+    ip_info_store.load_from_db()
+
+    assert iter_ip_info_entries.call_count == 1
+
+    assert sorted(ip_info_store.radix.prefixes()) == [
+        "192.0.2.0/24",
+        "198.51.100.0/24"
+    ]
+
+    assert ip_info_store.lookup(
+        ipaddress.ip_address("198.51.100.1")
+    ) == _ip_info("198.51.100.0/24", 65503)
+
+
+def test_ip_info_store_load_from_db_concurrent_writers(db, mocker):
+    IPInfo_Prefix.create_from_ipdbinfo(_ip_info("192.0.2.0/24", 65501))
+    IPInfo_Prefix.create_from_ipdbinfo(_ip_info("198.51.100.0/24", 65502))
+
+    writers = []
+    radix = ip_info_store.radix
+
+    def add_more_recent_entry(prefix):
+        # An enricher adds a more recent entry right after the
+        # loader checked the one in the store.
+        node = radix.search_exact(prefix)
+
+        writer = threading.Thread(
+            target=ip_info_store.add,
+            args=(_ip_info(prefix, 65510),)
+        )
+        writer.start()
+        writer.join(0.1)
+
+        writers.append(writer)
+
+        return node
+
+    mocker.patch.object(ip_info_store, "radix", mocker.Mock(wraps=radix))
+    ip_info_store.radix.search_exact.side_effect = add_more_recent_entry
+
+    ip_info_store.load_from_db(batch_size=1)
+
+    for writer in writers:
+        writer.join()
+
+    assert len(writers) == 2
+
+    # The entries of the DB never replace the more recent ones.
+    assert ip_info_store.lookup(
+        ipaddress.ip_address("192.0.2.1")
+    ) == _ip_info("192.0.2.0/24", 65510)
+    assert ip_info_store.lookup(
+        ipaddress.ip_address("198.51.100.1")
+    ) == _ip_info("198.51.100.0/24", 65510)
+
+
+def test_ip_info_store_snapshot(tmpdir):
+    path = str(tmpdir.join("ip_info.snapshot"))
+
+    now = datetime.datetime.utcnow()
+
+    entries = [
+        (_ip_info("192.0.2.0/24", 65501), now - datetime.timedelta(hours=1)),
+        (
+            IPDBInfo(
+                prefix=ipaddress.ip_network("2001:db8::/32"),
+                origins=None,
+                ixp_network=IXPNetwork("LAN", "IX", None)
+            ),
+            now
+        ),
+    ]
+
+    for ip_info, last_updated in entries:
+        ip_info_store.add(ip_info, last_updated=last_updated)
+
+    # Expired entries are not saved.
+    ip_info_store.add(
+        _ip_info("198.51.100.0/24", 65502),
+        last_updated=now - datetime.timedelta(days=365)
+    )
+
+    assert ip_info_store.write_snapshot(path) == 2
+
+    ip_info_store.reset()
+
+    assert ip_info_store.load_snapshot(path) == 2
+
+    for ip_info, last_updated in entries:
+        node = ip_info_store.radix.search_exact(str(ip_info.prefix))
+        assert node.data["ip_db_info"] == ip_info
+        assert abs(node.data["last_updated"] - last_updated) < datetime.timedelta(milliseconds=1)
+
+    assert ip_info_store.radix.search_exact("198.51.100.0/24") is None
+
+
+def test_ip_info_store_snapshot_concurrent_writers(tmpdir, mocker):
+    path = str(tmpdir.join("ip_info.snapshot"))
+
+    for n in range(256):
+        ip_info_store.add(_ip_info(f"10.{n}.0.0/16", 65501))
+
+    # Widen the window between writing the temporary
+    # file and moving it.
+    original_replace = os.replace
+
+    def slow_replace(src, dst):
+        time.sleep(0.01)
+        original_replace(src, dst)
+
+    mocker.patch("os.replace", slow_replace)
+
+    # The periodic writer and the one that runs at exit.
+    errors = []
+
+    def _write():
+        try:
+            for _ in range(10):
+                ip_info_store.write_snapshot(path)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=_write) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert tmpdir.listdir() == [tmpdir.join("ip_info.snapshot")]
+
+    ip_info_store.reset()
+
+    assert ip_info_store.load_snapshot(path) == 256
+
+
+def test_ip_info_store_snapshot_version(tmpdir):
+    path = str(tmpdir.join("ip_info.snapshot"))
+
+    ip_info_store.add(_ip_info("192.0.2.0/24", 65501))
+    ip_info_store.write_snapshot(path)
+    ip_info_store.reset()
+
+    with open(path, "r+b") as f:
+        f.seek(len(SNAPSHOT_MAGIC))
+        f.write(struct.pack("!H", SNAPSHOT_VERSION + 1))
+
+    with pytest.raises(ValueError, match="Unsupported snapshot version"):
+        ip_info_store.load_snapshot(path)
+
+    # Snapshots that can't be used are just ignored.
+    load_ip_info_store_snapshot(path)
+    assert ip_info_store.radix.prefixes() == []
+
+
+def _add_aged(prefix: str, asn: int, age: datetime.timedelta) -> None:
+    ip_info_store.add(
+        _ip_info(prefix, asn),
+        last_updated=datetime.datetime.utcnow() - age
+    )
+
+
+def test_ip_info_store_stale_while_revalidate(db, mocker):
+    dispatch_ipinfo = mocker.patch(
+        "rich_traceroute.enrichers.ip_info_refresher.dispatch_ipinfo"
+    )
+
+    _add_aged("192.0.2.0/24", 65501, IP_INFO_EXPIRY + datetime.timedelta(hours=1))
+
+    fetch_can_complete = threading.Event()
+    fetched_ips = []
+
+    def fetch(ip):
+        fetched_ips.append(ip)
+        fetch_can_complete.wait(5)
+        return _ip_info("192.0.2.0/24", 65502)
+
+    refresher = IPInfoRefresher()
+    futures = []
+
+    def refresh(ip_info):
+        futures.append(refresher.schedule(ip_info, fetch))
+
+    # The expired entry is returned immediately, while
+    # only one refresh is scheduled.
+    for _ in range(3):
+        assert ip_info_store.lookup(
+            ipaddress.ip_address("192.0.2.1"), refresh=refresh
+        ) == _ip_info("192.0.2.0/24", 65501)
+
+    assert futures[0] is not None
+    assert futures[1:] == [None, None]
+
+    fetch_can_complete.set()
+
+    assert futures[0].result(5) == _ip_info("192.0.2.0/24", 65502)
+
+    assert fetched_ips == [ipaddress.ip_address("192.0.2.0")]
+    dispatch_ipinfo.assert_called_once_with(_ip_info("192.0.2.0/24", 65502))
+
+    assert ip_info_store.lookup(
+        ipaddress.ip_address("192.0.2.1"), refresh=refresh
+    ) == _ip_info("192.0.2.0/24", 65502)
+    assert IPInfo_Prefix.get_by_id("192.0.2.0/24").to_ipdbinfo() == \
+        _ip_info("192.0.2.0/24", 65502)
+
+    # Entries that are too old are not used anymore.
+    _add_aged(
+        "198.51.100.0/24", 65503,
+        IP_INFO_EXPIRY + IP_INFO_MAX_STALENESS + datetime.timedelta(hours=1)
+    )
+    assert ip_info_store.lookup(
+        ipaddress.ip_address("198.51.100.1"), refresh=refresh
+    ) is None
+    assert len(futures) == 3
+
+
+def test_ip_info_store_refresh_ahead():
+    refreshed = []
+
+    _add_aged("192.0.2.0/24", 65501, IP_INFO_EXPIRY - datetime.timedelta(hours=1))
+    _add_aged("198.51.100.0/24", 65502, datetime.timedelta(hours=1))
+
+    for _ in range(IP_INFO_REFRESH_AHEAD_MIN_HITS - 1):
+        for ip in ("192.0.2.1", "198.51.100.1"):
+            ip_info_store.lookup(ipaddress.ip_address(ip), refresh=refreshed.append)
+
+    assert refreshed == []
+
+    for ip in ("192.0.2.1", "198.51.100.1"):
+        ip_info_store.lookup(ipaddress.ip_address(ip), refresh=refreshed.append)
+
+    # Only the entry that is about to expire is refreshed.
+    assert refreshed == [_ip_info("192.0.2.0/24", 65501)]
+
+
+def test_ip_info_refresher_failures():
+    fetched_ips = []
+
+    def fetch(ip):
+        fetched_ips.append(ip)
+        return None
+
+    refresher = IPInfoRefresher()
+
+    future = refresher.schedule(_ip_info("192.0.2.0/24", 65501), fetch)
+    assert future.result(5) is None
+
+    # Failed refreshes are not retried immediately.
+    assert refresher.schedule(_ip_info("192.0.2.0/24", 65501), fetch) is None
+    assert len(fetched_ips) == 1
+
+    # IXP networks are refreshed by the IXP networks updater.
+    assert refresher.schedule(
+        IPDBInfo(
+            prefix=ipaddress.ip_network("203.0.113.0/24"),
+            origins=None,
+            ixp_network=IXPNetwork("LAN", "IX", "IX description")
+        ),
+        fetch
+    ) is None
+
+
+def test_ip_info_store_sweep(mocker):
+    too_old = IP_INFO_EXPIRY + IP_INFO_MAX_STALENESS + datetime.timedelta(hours=1)
+
+    for n in range(10):
+        _add_aged(f"192.0.2.{n * 8}/29", 65500 + n, too_old)
+
+    # Stale, but still usable while being refreshed.
+    _add_aged("198.51.100.0/24", 65511, IP_INFO_EXPIRY + datetime.timedelta(hours=1))
+
+    _add_aged("203.0.113.0/24", 65512, datetime.timedelta(hours=1))
+
+    # An old entry that was updated in the meantime.
+    _add_aged("192.0.2.128/25", 65513, too_old)
+    _add_aged("192.0.2.128/25", 65514, datetime.timedelta(hours=1))
+
+    # An old entry that was already deleted.
+    _add_aged("192.0.2.0/28", 65515, too_old)
+    ip_info_store.delete("192.0.2.0/28")
+
+    sweep_batch = mocker.spy(ip_info_store, "_sweep_batch")
+
+    assert ip_info_store.sweep(batch_size=4) == 10
+
+    # The lock is released every 4 entries.
+    assert sweep_batch.call_count == 4
+
+    assert sorted(ip_info_store.radix.prefixes()) == [
+        "192.0.2.128/25",
+        "198.51.100.0/24",
+        "203.0.113.0/24"
+    ]
+
+    # Only the items of the remaining entries are left
+    # in the index.
+    assert sorted(prefix for _, prefix in ip_info_store.expiry_index) == [
+        "192.0.2.128/25",
+        "198.51.100.0/24",
+        "203.0.113.0/24"
+    ]
+
+    assert ip_info_store.sweep() == 0
+
+
+def test_ip_info_store_sweep_metrics():
+    metrics_mock_wrapper.mm.clear_records()
+
+    _add_aged(
+        "192.0.2.0/24", 65501,
+        IP_INFO_EXPIRY + IP_INFO_MAX_STALENESS + datetime.timedelta(hours=1)
+    )
+    _add_aged("198.51.100.0/24", 65502, datetime.timedelta(hours=1))
+
+    sweep_ip_info_store()
+
+    prefix = "rich_traceroute.enrichers.ip_info_store"
+
+    evicted = metrics_mock_wrapper.mm.filter_records("incr", stat=f"{prefix}.sweep.evicted")
+    assert [record[2] for record in evicted] == [1]
+
+    size = metrics_mock_wrapper.mm.filter_records("gauge", stat=f"{prefix}.size")
+    assert [record[2] for record in size] == [1]
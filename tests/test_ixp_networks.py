@@ -1,16 +1,33 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import threading
+
 import pytest
 from unittest.mock import MagicMock, call
 import ipaddress
 
 
-from rich_traceroute.enrichers.ixp_networks import IXPNetworksUpdater
+import rich_traceroute.enrichers.ixp_networks as ixp_networks
+from rich_traceroute.enrichers.ip_info_store import ip_info_store
+from rich_traceroute.enrichers.ixp_networks import (
+    IXPNetworksUpdater,
+    PeeringDB
+)
+from rich_traceroute.ip_info_db import IPInfo_Prefix
 from rich_traceroute.structures import IPDBInfo, IXPNetwork
 
+from .conftest import metrics_mock_wrapper
+
 
 # Will be set by the fixture and made available to the
 # test case function for inspection.
 updater_dispatch_ip_info_mock = None
 
+# The original methods, before the fixtures patch them.
+PEERINGDB_GET = PeeringDB._get
+UPDATER_DISPATCH_IP_INFO = IXPNetworksUpdater._dispatch_ip_info
+
 
 @pytest.fixture(autouse=True)
 def mock_updater(mocker):
@@ -43,3 +60,263 @@ def test_ixp_networks_1(db):
         )
     )
     assert expected_call in updater_dispatch_ip_info_mock.call_args_list
+
+
+def test_ixp_networks_get_ip_infos():
+    updater = IXPNetworksUpdater()
+
+    pdb_ix_data = [
+        {"id": 1, "name": "IX1", "name_long": "Internet Exchange 1"},
+        {"id": 2, "name": "IX2", "name_long": ""},
+        {"id": 3, "name": "IX3", "name_long": "IX without LANs"},
+    ]
+    pdb_ixlan_data = [
+        {"id": 10, "ix_id": 1, "name": "LAN 10"},
+        {"id": 20, "ix_id": 2, "name": ""},
+        {"id": 11, "ix_id": 1, "name": "LAN 11"},
+        {"id": 99, "ix_id": 99, "name": "LAN of an unknown IX"},
+    ]
+    pdb_ix_prefixes = [
+        {"ixlan_id": 10, "prefix": "192.0.2.0/25"},
+        {"ixlan_id": 20, "prefix": "198.51.100.0/24"},
+        {"ixlan_id": 10, "prefix": "2001:db8::/64"},
+        {"ixlan_id": 11, "prefix": "192.0.2.128/25"},
+        {"ixlan_id": 98, "prefix": "203.0.113.0/24"},
+    ]
+
+    ip_infos = updater._get_ip_infos(pdb_ix_data, pdb_ixlan_data, pdb_ix_prefixes)
+
+    ixp_10 = IXPNetwork("LAN 10", "IX1", "Internet Exchange 1")
+    ixp_11 = IXPNetwork("LAN 11", "IX1", "Internet Exchange 1")
+    ixp_20 = IXPNetwork(None, "IX2", None)
+
+    assert ip_infos == [
+        IPDBInfo(ipaddress.ip_network("192.0.2.0/25"), None, ixp_10),
+        IPDBInfo(ipaddress.ip_network("2001:db8::/64"), None, ixp_10),
+        IPDBInfo(ipaddress.ip_network("192.0.2.128/25"), None, ixp_11),
+        IPDBInfo(ipaddress.ip_network("198.51.100.0/24"), None, ixp_20),
+    ]
+
+
+def test_ixp_networks_metrics(db):
+    metrics_mock_wrapper.mm.clear_records()
+
+    IXPNetworksUpdater().update_ixp_networks()
+
+    prefix = "rich_traceroute.enrichers.ixp_networks"
+
+    assert metrics_mock_wrapper.mm.filter_records(
+        "timing", stat=f"{prefix}._get_ip_infos"
+    )
+
+    peak_memory = metrics_mock_wrapper.mm.filter_records(
+        "gauge", stat=f"{prefix}._get_ip_infos.peak_memory"
+    )
+    assert len(peak_memory) == 1
+    assert peak_memory[0][2] > 0
+
+
+class StubPeeringDBServer(threading.Thread):
+    """Minimal PeeringDB API server for the tests.
+
+    'objects' maps each endpoint ("ix", "ixlan", "ixpfx") to
+    the list of its objects; each object has an 'updated'
+    timestamp, used to honor the 'since' parameter.
+    """
+
+    def __init__(self):
+        super().__init__(name="StubPeeringDBServer")
+
+        self.daemon = True
+
+        self.objects = {"ix": [], "ixlan": [], "ixpfx": []}
+        self.failing = set()
+        self.requests = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                endpoint = url.path.split("/")[-1]
+                since = parse_qs(url.query).get("since")
+
+                server.requests.append(self.path)
+
+                if endpoint in server.failing:
+                    self.send_error(404)
+                    return
+
+                data = [
+                    obj for obj in server.objects[endpoint]
+                    if (since and obj["updated"] >= int(since[0])) or
+                    (not since and obj["status"] == "ok")
+                ]
+
+                body = json.dumps({"data": data}).encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/api"
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def stub_peeringdb(mocker):
+    server = StubPeeringDBServer()
+    server.start()
+
+    mocker.patch.object(PeeringDB, "_get", PEERINGDB_GET)
+    mocker.patch.object(
+        IXPNetworksUpdater, "_dispatch_ip_info", UPDATER_DISPATCH_IP_INFO
+    )
+
+    for endpoint in ("ix", "ixlan", "ixpfx"):
+        mocker.patch.object(
+            ixp_networks,
+            f"PEERINGDB_API_{endpoint.upper()}",
+            f"{server.url}/{endpoint}"
+        )
+
+    yield server
+
+    server.stop()
+
+
+def _pdb_objects(server, updated):
+    server.objects["ix"] = [
+        {"id": 1, "name": "IX1", "name_long": "Internet Exchange 1",
+         "status": "ok", "updated": updated},
+        {"id": 2, "name": "IX2", "name_long": "Internet Exchange 2",
+         "status": "ok", "updated": updated},
+    ]
+    server.objects["ixlan"] = [
+        {"id": 10, "ix_id": 1, "name": "", "status": "ok", "updated": updated},
+        {"id": 20, "ix_id": 2, "name": "", "status": "ok", "updated": updated},
+    ]
+    server.objects["ixpfx"] = [
+        {"id": 100, "ixlan_id": 10, "prefix": "192.0.2.0/24",
+         "status": "ok", "updated": updated},
+        {"id": 101, "ixlan_id": 10, "prefix": "2001:db8:1::/64",
+         "status": "ok", "updated": updated},
+        {"id": 200, "ixlan_id": 20, "prefix": "198.51.100.0/24",
+         "status": "ok", "updated": updated},
+    ]
+
+
+def _db_prefixes():
+    return sorted(str(p.prefix) for p in IPInfo_Prefix.select())
+
+
+def test_ixp_networks_delta_sync(db, stub_peeringdb, mocker):
+    _pdb_objects(stub_peeringdb, updated=0)
+
+    updater = IXPNetworksUpdater()
+    updater.update_ixp_networks()
+
+    # First run: full sync.
+    assert stub_peeringdb.requests == ["/api/ix", "/api/ixlan", "/api/ixpfx"]
+    assert _db_prefixes() == [
+        "192.0.2.0/24", "198.51.100.0/24", "2001:db8:1::/64"
+    ]
+    assert updater.last_sync == updater.last_full_sync
+
+    last_sync = updater.last_sync
+
+    # IX2 is renamed, one of the prefixes of IX1 is
+    # deleted and a new one is added.
+    updated = last_sync + 1
+    stub_peeringdb.objects["ix"][1].update(name="IX2-new", updated=updated)
+    stub_peeringdb.objects["ixpfx"][1].update(status="deleted", updated=updated)
+    stub_peeringdb.objects["ixpfx"].append(
+        {"id": 102, "ixlan_id": 10, "prefix": "203.0.113.0/24",
+         "status": "ok", "updated": updated}
+    )
+
+    stub_peeringdb.requests.clear()
+    dispatch = mocker.spy(IXPNetworksUpdater, "_dispatch_ip_info")
+
+    updater.update_ixp_networks()
+
+    # Only the changes are requested...
+    assert stub_peeringdb.requests == [
+        f"/api/ix?since={last_sync}",
+        f"/api/ixlan?since={last_sync}",
+        f"/api/ixpfx?since={last_sync}",
+    ]
+
+    # ... and only the affected prefixes are written.
+    ixp_1 = IXPNetwork(None, "IX1", "Internet Exchange 1")
+    ixp_2 = IXPNetwork(None, "IX2-new", "Internet Exchange 2")
+
+    assert sorted(
+        (str(c[0][1].prefix), c[0][1].ixp_network)
+        for c in dispatch.call_args_list
+    ) == [
+        ("198.51.100.0/24", ixp_2),
+        ("203.0.113.0/24", ixp_1),
+    ]
+
+    assert _db_prefixes() == [
+        "192.0.2.0/24", "198.51.100.0/24", "203.0.113.0/24"
+    ]
+    assert IPInfo_Prefix.get_by_id("198.51.100.0/24").to_ipdbinfo().ixp_network == ixp_2
+
+    assert ip_info_store.lookup(ipaddress.ip_address("2001:db8:1::1")) is None
+    assert ip_info_store.lookup(ipaddress.ip_address("203.0.113.1")).ixp_network == ixp_1
+
+    assert updater.last_sync >= last_sync
+    assert updater.last_full_sync == last_sync
+
+    # When the full sync interval is elapsed, all the
+    # objects are retrieved again.
+    updater.last_full_sync -= ixp_networks.IXP_NETWORKS_FULL_SYNC_INTERVAL
+
+    stub_peeringdb.requests.clear()
+    dispatch.reset_mock()
+
+    updater.update_ixp_networks()
+
+    assert stub_peeringdb.requests == ["/api/ix", "/api/ixlan", "/api/ixpfx"]
+    assert dispatch.call_count == 3
+
+
+def test_ixp_networks_delta_sync_peeringdb_errors(db, stub_peeringdb):
+    _pdb_objects(stub_peeringdb, updated=0)
+
+    updater = IXPNetworksUpdater()
+    updater.update_ixp_networks()
+
+    last_sync = updater.last_sync
+
+    stub_peeringdb.failing.add("ixpfx")
+    stub_peeringdb.requests.clear()
+
+    updater.update_ixp_networks()
+
+    # Without all the data nothing is changed, and the
+    # next run starts again from the last good sync.
+    assert stub_peeringdb.requests[-1] == f"/api/ixpfx?since={last_sync}"
+    assert updater.last_sync == last_sync
+    assert _db_prefixes() == [
+        "192.0.2.0/24", "198.51.100.0/24", "2001:db8:1::/64"
+    ]
+
+    assert metrics_mock_wrapper.mm.filter_records(
+        "incr", stat="rich_traceroute.enrichers.ixp_networks.peeringdb.http_errors"
+    )
@@ -0,0 +1,119 @@
+import datetime
+
+import pytest
+
+from rich_traceroute.traceroute import create_traceroute, Traceroute
+from rich_traceroute.traceroute.last_seen import LastSeenFlusher
+
+from .conftest import metrics_mock_wrapper
+
+
+METRIC_PREFIX = "rich_traceroute.traceroute.last_seen"
+
+
+@pytest.fixture(autouse=True)
+def setup(db, mocker):
+    mocker.patch(
+        "rich_traceroute.traceroute.dispatch_traceroute_enrichment_job",
+        lambda job: None
+    )
+
+    metrics_mock_wrapper.mm.clear_records()
+
+
+def _create_traceroutes(n):
+    raw = open("tests/data/traceroute/mtr_json_1.json").read()
+
+    res = []
+    for _ in range(n):
+        t = create_traceroute(raw)
+
+        Traceroute.update(
+            last_seen=datetime.datetime(2021, 1, 1)
+        ).where(
+            Traceroute.id == t.id
+        ).execute()
+
+        res.append(t.id)
+
+    return res
+
+
+def _get_last_seen(traceroute_id):
+    return Traceroute.get(Traceroute.id == traceroute_id).last_seen
+
+
+def test_last_seen_flusher(mocker):
+    t1, t2, t3 = _create_traceroutes(3)
+
+    flusher = LastSeenFlusher(interval=60, max_size=10)
+
+    flusher.track(t1)
+    flusher.track(t2)
+    flusher.track(t1)
+
+    assert flusher.buffer == {t1, t2}
+
+    # Nothing is written to the DB until the buffer is flushed.
+    assert _get_last_seen(t1) == datetime.datetime(2021, 1, 1)
+
+    execute_sql = mocker.spy(Traceroute._meta.database.obj, "execute_sql")
+
+    flusher.flush()
+
+    assert flusher.buffer == set()
+
+    # A single UPDATE, only for the last_seen column.
+    updates = [
+        call[0][0] for call in execute_sql.call_args_list
+        if call[0][0].startswith("UPDATE")
+    ]
+    assert len(updates) == 1
+    assert updates[0].startswith('UPDATE "traceroute" SET "last_seen" = ?')
+    assert " IN (" in updates[0]
+
+    assert _get_last_seen(t1) > datetime.datetime(2021, 1, 1)
+    assert _get_last_seen(t2) > datetime.datetime(2021, 1, 1)
+    assert _get_last_seen(t3) == datetime.datetime(2021, 1, 1)
+
+    # An empty buffer doesn't hit the DB.
+    execute_sql.reset_mock()
+    flusher.flush()
+    assert execute_sql.call_count == 0
+
+
+def test_last_seen_flusher_bounded_buffer():
+    t1, t2, t3 = _create_traceroutes(3)
+
+    flusher = LastSeenFlusher(interval=60, max_size=2)
+
+    flusher.track(t1)
+    assert not flusher.flush_requested.is_set()
+
+    flusher.track(t2)
+    assert flusher.flush_requested.is_set()
+
+    # Buffer full: new IDs are discarded.
+    flusher.track(t3)
+    assert flusher.buffer == {t1, t2}
+
+    assert len(
+        metrics_mock_wrapper.mm.filter_records(
+            "incr", stat=f"{METRIC_PREFIX}.dropped"
+        )
+    ) == 1
+
+
+def test_last_seen_flusher_flush_on_stop():
+    t1, = _create_traceroutes(1)
+
+    flusher = LastSeenFlusher(interval=60, max_size=10)
+    flusher.start()
+
+    flusher.track(t1)
+
+    flusher.stop()
+    flusher.join(5)
+
+    assert not flusher.is_alive()
+    assert _get_last_seen(t1) > datetime.datetime(2021, 1, 1)
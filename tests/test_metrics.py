@@ -0,0 +1,45 @@
+import logging
+import tracemalloc
+
+import markus
+
+from rich_traceroute.metrics import log_execution_time
+
+from .conftest import metrics_mock_wrapper
+
+METRICS = markus.get_metrics("test")
+LOGGER = logging.getLogger("test")
+
+
+def test_log_execution_time_peak_memory():
+    metrics_mock_wrapper.mm.clear_records()
+
+    # Memory allocated before the block is not counted.
+    before = bytearray(8 * 1024 * 1024)
+
+    with log_execution_time(METRICS, LOGGER, "block", record_memory=True) as timing:
+        data = bytearray(4 * 1024 * 1024)
+        del data
+
+    del before
+
+    assert 4 * 1024 * 1024 <= timing.peak_memory < 8 * 1024 * 1024
+
+    peak_memory = metrics_mock_wrapper.mm.filter_records(
+        "gauge", stat="test.block.peak_memory"
+    )
+    assert len(peak_memory) == 1
+    assert peak_memory[0][2] == timing.peak_memory
+
+    # Tracing is stopped at the end of the block.
+    assert not tracemalloc.is_tracing()
+
+
+def test_log_execution_time_no_memory():
+    metrics_mock_wrapper.mm.clear_records()
+
+    with log_execution_time(METRICS, LOGGER, "block") as timing:
+        pass
+
+    assert timing.peak_memory is None
+    assert not metrics_mock_wrapper.mm.filter_records("gauge")
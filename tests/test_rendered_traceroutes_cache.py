@@ -0,0 +1,144 @@
+from unittest.mock import MagicMock
+import ipaddress
+
+import pytest
+
+from rich_traceroute.traceroute import (
+    create_traceroute,
+    load_traceroute,
+    Traceroute
+)
+from rich_traceroute.structures import IPDBInfo
+from rich_traceroute.traceroute.cache import (
+    RenderedTraceroute,
+    RenderedTraceroutesCache,
+    rendered_traceroutes_cache,
+    pending_rendered_traceroutes_cache,
+    render_traceroute
+)
+
+from .conftest import metrics_mock_wrapper
+
+
+METRIC_PREFIX = "rich_traceroute.traceroute.cache.rendered_traceroutes_cache"
+
+load_traceroute_mock: MagicMock
+
+
+@pytest.fixture(autouse=True)
+def setup(db, mocker):
+    global load_traceroute_mock
+
+    # Enrichment is not needed here.
+    mocker.patch(
+        "rich_traceroute.traceroute.dispatch_traceroute_enrichment_job",
+        lambda job: None
+    )
+
+    load_traceroute_mock = MagicMock(wraps=load_traceroute)
+    mocker.patch(
+        "rich_traceroute.traceroute.cache.load_traceroute",
+        load_traceroute_mock
+    )
+
+    rendered_traceroutes_cache.clear()
+    pending_rendered_traceroutes_cache.clear()
+    metrics_mock_wrapper.mm.clear_records()
+
+    yield
+
+    rendered_traceroutes_cache.clear()
+    pending_rendered_traceroutes_cache.clear()
+
+
+def _count_records(metric):
+    return len(
+        metrics_mock_wrapper.mm.filter_records(
+            "incr", stat=f"{METRIC_PREFIX}.{metric}"
+        )
+    )
+
+
+def test_rendered_traceroutes_cache_enriched_only():
+    raw = open("tests/data/traceroute/mtr_json_1.json").read()
+    t_id = create_traceroute(raw).id
+
+    # Not enriched yet: it must not be cached.
+    rendered = render_traceroute(t_id)
+    assert rendered.data["status"] == "wip"
+    assert rendered.text == ""
+    assert t_id not in rendered_traceroutes_cache
+
+    render_traceroute(t_id)
+    assert load_traceroute_mock.call_count == 2
+    assert _count_records("misses") == 2
+    assert _count_records("hits") == 0
+
+    Traceroute.update(enriched=True).where(Traceroute.id == t_id).execute()
+
+    rendered = render_traceroute(t_id)
+    assert t_id in rendered_traceroutes_cache
+    assert load_traceroute_mock.call_count == 3
+
+    # From now on, the DB is not used anymore.
+    assert render_traceroute(t_id) is rendered
+    assert render_traceroute(t_id) is rendered
+    assert load_traceroute_mock.call_count == 3
+
+    assert _count_records("misses") == 3
+    assert _count_records("hits") == 2
+
+    t = Traceroute.get(Traceroute.id == t_id)
+    assert rendered.data == t.to_dict()
+    assert rendered.json == t.to_json()
+    assert rendered.text == t.to_text()
+
+
+def test_rendered_traceroutes_cache_may_be_backfilled():
+    raw = open("tests/data/traceroute/mtr_json_1.json").read()
+    t_id = create_traceroute(raw).id
+
+    Traceroute.update(enriched=True).where(Traceroute.id == t_id).execute()
+
+    # A global IP without IP info: they may be backfilled
+    # later by the workers, so it's cached for a short time.
+    host = load_traceroute(t_id).get_hop_n(10).hosts[0]
+    host.ip = "8.8.8.8"
+    host.save()
+
+    rendered = render_traceroute(t_id)
+    assert t_id not in rendered_traceroutes_cache
+    assert t_id in pending_rendered_traceroutes_cache
+    assert pending_rendered_traceroutes_cache.ttl < rendered_traceroutes_cache.ttl
+
+    assert render_traceroute(t_id) is rendered
+    assert load_traceroute_mock.call_count == 1
+    assert _count_records("hits") == 1
+
+    host.set_ip_info(
+        IPDBInfo(ipaddress.ip_network("8.8.8.0/24"), [(15169, "GOOGLE")], None)
+    )
+
+    # Once the pending entry expires, the updated traceroute
+    # is loaded from the DB and cached as usual.
+    pending_rendered_traceroutes_cache.clear()
+
+    rendered = render_traceroute(t_id)
+    assert load_traceroute_mock.call_count == 2
+    assert rendered.data["hops"][10][0]["origins"]
+    assert t_id in rendered_traceroutes_cache
+
+
+def test_rendered_traceroutes_cache_evictions():
+    cache = RenderedTraceroutesCache(maxsize=2, ttl=60)
+
+    for traceroute_id in ("1", "2", "3"):
+        cache[traceroute_id] = RenderedTraceroute(traceroute_id, {}, "{}", "")
+
+    assert sorted(cache.keys()) == ["2", "3"]
+    assert _count_records("evictions") == 1
+
+
+def test_rendered_traceroutes_cache_not_found():
+    with pytest.raises(Traceroute.DoesNotExist):
+        render_traceroute("123456")
@@ -0,0 +1,224 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from rich_traceroute.enrichers.ripestat import RIPEstatClient
+from rich_traceroute.enrichers.throttling import TokenBucket
+from rich_traceroute.errors import ExternalSourceUnavailableError
+
+from .conftest import metrics_mock_wrapper
+
+
+class StubRIPEstatServer(threading.Thread):
+    """Minimal RIPEstat API server for the tests.
+
+    'statuses' is the list of the status codes of the next
+    responses (200 once it's empty); every response is sent
+    after 'delay' seconds.
+    """
+
+    def __init__(self):
+        super().__init__(name="StubRIPEstatServer")
+
+        self.daemon = True
+
+        self.statuses = []
+        self.delay = 0
+        self.requests = []
+        self.connections = set()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests.append(self.path)
+                server.connections.add(self.client_address)
+
+                status = server.statuses.pop(0) if server.statuses else 200
+
+                if server.delay:
+                    time.sleep(server.delay)
+
+                body = json.dumps({"status": "ok", "data": {}}).encode()
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/data/prefix-overview/data.json"
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def stub_ripestat():
+    server = StubRIPEstatServer()
+    server.start()
+
+    yield server
+
+    server.stop()
+
+
+def _metric(kind, name):
+    return [
+        record[2]
+        for record in metrics_mock_wrapper.mm.filter_records(
+            kind, stat=f"rich_traceroute.enrichers.ripestat.{name}"
+        )
+    ]
+
+
+def test_ripestat_client_keepalive(stub_ripestat):
+    client = RIPEstatClient(pool_size=2)
+
+    for _ in range(3):
+        response = client.get(stub_ripestat.url)
+        assert response.status_code == 200
+        assert response.json()["status"] == "ok"
+
+    # The same connection is reused.
+    assert len(stub_ripestat.requests) == 3
+    assert len(stub_ripestat.connections) == 1
+
+    assert len(_metric("histogram", "latency")) == 3
+    assert _metric("gauge", "pool.in_use") == [1, 1, 1]
+    assert _metric("incr", "pool.saturated") == []
+
+
+def test_ripestat_client_retries(stub_ripestat):
+    client = RIPEstatClient(pool_size=1, max_retries=2, retry_backoff=0.05)
+
+    stub_ripestat.statuses = [503, 502]
+
+    response = client.get(stub_ripestat.url)
+
+    assert response.status_code == 200
+    assert len(stub_ripestat.requests) == 3
+    assert len(_metric("incr", "retries")) == 2
+
+    # When retries are exhausted, the last response is returned.
+    stub_ripestat.statuses = [503, 503, 503, 503]
+
+    response = client.get(stub_ripestat.url)
+
+    assert response.status_code == 503
+    assert len(stub_ripestat.requests) == 6
+
+
+def test_ripestat_client_no_retry_on_client_errors(stub_ripestat):
+    client = RIPEstatClient(pool_size=1, max_retries=2, retry_backoff=0.05)
+
+    stub_ripestat.statuses = [404]
+
+    response = client.get(stub_ripestat.url)
+
+    assert response.status_code == 404
+    assert len(stub_ripestat.requests) == 1
+
+
+def test_ripestat_client_timeout(stub_ripestat):
+    client = RIPEstatClient(
+        pool_size=1, read_timeout=0.3, max_retries=1, retry_backoff=0.05
+    )
+
+    stub_ripestat.delay = 1
+
+    start = time.perf_counter()
+    with pytest.raises(requests.Timeout):
+        client.get(stub_ripestat.url)
+    elapsed = time.perf_counter() - start
+
+    # Two attempts, no deadline.
+    assert len(stub_ripestat.requests) == 2
+    assert elapsed < 1
+
+    assert len(_metric("incr", "timeouts")) == 2
+
+
+def test_ripestat_client_deadline(stub_ripestat):
+    client = RIPEstatClient(pool_size=1, max_retries=2, retry_backoff=0.05)
+
+    stub_ripestat.delay = 3
+
+    # The timeout is reduced to fit in the time left.
+    start = time.perf_counter()
+    with pytest.raises(requests.Timeout):
+        client.get(stub_ripestat.url, deadline=time.monotonic() + 1.2)
+    elapsed = time.perf_counter() - start
+
+    assert 1 < elapsed < 2
+
+    # No time left for retries.
+    assert len(stub_ripestat.requests) == 1
+
+    # Once the deadline is gone, one attempt is made anyway.
+    stub_ripestat.delay = 0
+
+    response = client.get(stub_ripestat.url, deadline=time.monotonic() - 10)
+
+    assert response.status_code == 200
+
+
+def test_ripestat_client_pool_saturation(stub_ripestat):
+    client = RIPEstatClient(pool_size=2)
+
+    stub_ripestat.delay = 0.3
+
+    threads = [
+        threading.Thread(target=client.get, args=(stub_ripestat.url,))
+        for _ in range(4)
+    ]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(_metric("gauge", "pool.in_use")) == 4
+    assert len(_metric("incr", "pool.saturated")) == 2
+    assert client.in_use == 0
+
+
+def test_ripestat_client_rate_limiter(stub_ripestat):
+    rate_limiter = TokenBucket("ripestat", rate=10, burst=1, min_rate=1)
+
+    client = RIPEstatClient(
+        pool_size=1, max_retries=1, retry_backoff=0.05, rate_limiter=rate_limiter
+    )
+
+    # Throttled by RIPEstat: the rate is halved, then
+    # slightly increased by the successful retry.
+    stub_ripestat.statuses = [429]
+
+    response = client.get(stub_ripestat.url)
+
+    assert response.status_code == 200
+    assert rate_limiter.rate == pytest.approx(5.1)
+
+    # No tokens available before the deadline.
+    rate_limiter.rate = 0.1
+    rate_limiter.tokens = 0
+
+    with pytest.raises(ExternalSourceUnavailableError):
+        client.get(stub_ripestat.url, deadline=time.monotonic() + 1)
+
+    assert len(stub_ripestat.requests) == 2
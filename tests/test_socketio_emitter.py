@@ -0,0 +1,150 @@
+from unittest.mock import MagicMock
+import time
+
+import pytest
+
+from rich_traceroute.config import (
+    SOCKET_IO_DATA_BATCH_EVENT,
+    SOCKET_IO_ENRICHMENT_COMPLETED_EVENT
+)
+from rich_traceroute.enrichers.socketio_emitter import SocketIOEmitter
+
+from .conftest import metrics_mock_wrapper
+
+
+@pytest.fixture
+def emitter(request):
+    params = getattr(request, "param", {})
+
+    socketio = MagicMock()
+
+    emitter = SocketIOEmitter(socketio=socketio, **params)
+    emitter.start()
+
+    yield emitter
+
+    if emitter.is_alive():
+        emitter.stop()
+        emitter.join()
+
+
+def _emitted(emitter):
+    return [
+        (call[0][0], call[0][1], call[1]["namespace"])
+        for call in emitter.socketio.emit.call_args_list
+    ]
+
+
+def _host(n):
+    return {"id": f"h{n}", "ip": f"192.0.2.{n}"}
+
+
+@pytest.mark.parametrize("emitter", [{"max_linger": 0.2}], indirect=True)
+def test_socketio_emitter_coalescing(emitter):
+    for n in range(3):
+        emitter.emit_host("t1", _host(n))
+    emitter.emit_host("t2", _host(10))
+
+    time.sleep(0.1)
+
+    # Still lingering.
+    assert emitter.socketio.emit.call_count == 0
+
+    time.sleep(0.3)
+
+    assert sorted(_emitted(emitter), key=lambda e: e[2]) == [
+        (
+            SOCKET_IO_DATA_BATCH_EVENT,
+            {"traceroute_id": "t1", "hosts": [_host(0), _host(1), _host(2)]},
+            "/t/t1"
+        ),
+        (
+            SOCKET_IO_DATA_BATCH_EVENT,
+            {"traceroute_id": "t2", "hosts": [_host(10)]},
+            "/t/t2"
+        ),
+    ]
+
+    assert [
+        record[2]
+        for record in metrics_mock_wrapper.mm.filter_records(
+            "histogram", stat="rich_traceroute.enrichers.socketio_emitter.batch_size"
+        )
+    ] == [3, 1]
+
+
+@pytest.mark.parametrize("emitter", [{"max_linger": 10}], indirect=True)
+def test_socketio_emitter_order(emitter):
+    """Other events flush the pending batch of their namespace."""
+
+    emitter.emit_host("t1", _host(1))
+    emitter.emit_host("t2", _host(2))
+    emitter.emit(SOCKET_IO_ENRICHMENT_COMPLETED_EVENT, {"traceroute_id": "t1"}, namespace="/t/t1")
+
+    time.sleep(0.1)
+
+    assert _emitted(emitter) == [
+        (
+            SOCKET_IO_DATA_BATCH_EVENT,
+            {"traceroute_id": "t1", "hosts": [_host(1)]},
+            "/t/t1"
+        ),
+        (
+            SOCKET_IO_ENRICHMENT_COMPLETED_EVENT,
+            {"traceroute_id": "t1"},
+            "/t/t1"
+        ),
+    ]
+
+    # Pending batches are flushed when the emitter is stopped.
+    emitter.stop()
+    emitter.join()
+
+    assert _emitted(emitter)[-1] == (
+        SOCKET_IO_DATA_BATCH_EVENT,
+        {"traceroute_id": "t2", "hosts": [_host(2)]},
+        "/t/t2"
+    )
+
+
+@pytest.mark.parametrize("emitter", [{"max_linger": 10, "max_batch": 2}], indirect=True)
+def test_socketio_emitter_max_batch(emitter):
+    for n in range(5):
+        emitter.emit_host("t1", _host(n))
+
+    time.sleep(0.1)
+
+    assert [
+        [host["id"] for host in data["hosts"]]
+        for _, data, _ in _emitted(emitter)
+    ] == [["h0", "h1"], ["h2", "h3"]]
+
+
+def test_socketio_emitter_queue_full():
+    socketio = MagicMock()
+
+    # Not started: nothing is consumed from the queue.
+    emitter = SocketIOEmitter(socketio=socketio, queue_size=2)
+
+    for n in range(3):
+        emitter.emit_host("t1", _host(n))
+
+    assert emitter.queue.qsize() == 2
+
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat="rich_traceroute.enrichers.socketio_emitter.dropped"
+    )) == 1
+
+
+@pytest.mark.parametrize("emitter", [{"max_linger": 0.05}], indirect=True)
+def test_socketio_emitter_emit_error(emitter):
+    emitter.socketio.emit.side_effect = [Exception("Broker unavailable"), None]
+
+    emitter.emit_host("t1", _host(1))
+    time.sleep(0.2)
+    emitter.emit_host("t1", _host(2))
+    time.sleep(0.2)
+
+    # The thread survived the failure.
+    assert emitter.is_alive()
+    assert emitter.socketio.emit.call_count == 2
@@ -0,0 +1,102 @@
+import time
+
+from rich_traceroute.enrichers.throttling import CircuitBreaker, TokenBucket
+
+from .conftest import metrics_mock_wrapper
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket("test", rate=20, burst=5, min_rate=1)
+
+    start = time.perf_counter()
+    for _ in range(10):
+        assert bucket.acquire()
+    elapsed = time.perf_counter() - start
+
+    # 5 from the burst, then 5 at 20/s.
+    assert 0.2 < elapsed < 0.4
+
+
+def test_token_bucket_timeout():
+    bucket = TokenBucket("test", rate=1, burst=1, min_rate=1)
+
+    assert bucket.acquire(timeout=0.1)
+
+    start = time.perf_counter()
+    assert bucket.acquire(timeout=0.1) is False
+    elapsed = time.perf_counter() - start
+
+    # It doesn't wait when the token can't be available in time.
+    assert elapsed < 0.05
+
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat="rich_traceroute.enrichers.throttling.test.rate_limited"
+    )) == 1
+
+
+def test_token_bucket_adaptive_rate():
+    bucket = TokenBucket("test", rate=8, burst=1, min_rate=1, increase_step=1)
+
+    bucket.decrease()
+    assert bucket.rate == 4
+
+    # Within the cooldown: requests that were already in flight.
+    bucket.decrease()
+    assert bucket.rate == 4
+
+    bucket.last_decrease -= TokenBucket.DECREASE_COOLDOWN
+    bucket.decrease()
+    assert bucket.rate == 2
+
+    for _ in range(3):
+        bucket.last_decrease -= TokenBucket.DECREASE_COOLDOWN
+        bucket.decrease()
+    assert bucket.rate == 1
+
+    for _ in range(10):
+        bucket.increase()
+    assert bucket.rate == 8
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=0.2)
+
+    # Consecutive failures only.
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+
+    assert breaker.is_closed
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+
+    assert not breaker.is_closed
+    assert not breaker.allow_request()
+
+    time.sleep(0.2)
+
+    # Half-open: only one trial request.
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+    # The trial failed.
+    breaker.record_failure()
+    assert not breaker.allow_request()
+
+    time.sleep(0.2)
+
+    assert breaker.allow_request()
+    breaker.record_success()
+
+    assert breaker.is_closed
+    assert breaker.allow_request()
+
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat="rich_traceroute.enrichers.throttling.test.circuit_opened"
+    )) == 2
+    assert len(metrics_mock_wrapper.mm.filter_records(
+        "incr", stat="rich_traceroute.enrichers.throttling.test.circuit_closed"
+    )) == 1
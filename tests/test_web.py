@@ -1,7 +1,7 @@
 import time
 import pytest
 
-from rich_traceroute.traceroute import Traceroute
+from rich_traceroute.traceroute import Traceroute, create_traceroute
 from rich_traceroute.web import create_app
 
 
@@ -134,3 +134,33 @@ def test_web_unexisting_traceroute(client, good_recaptcha, db):
     assert res.status_code == 200
 
     assert b'<h4 class="alert-heading">Traceroute not found.</h4>' in res.data
+
+
+def test_web_enriched_traceroute(client, db, mocker):
+    mocker.patch(
+        "rich_traceroute.traceroute.dispatch_traceroute_enrichment_job",
+        lambda job: None
+    )
+
+    raw = open("tests/data/traceroute/bsd_1.txt").read()
+    t = create_traceroute(raw)
+
+    Traceroute.update(enriched=True).where(Traceroute.id == t.id).execute()
+
+    t = Traceroute.get(Traceroute.id == t.id)
+
+    # The second time the page is served using the cache.
+    for _ in range(2):
+        res = client.get(f"/t/{t.id}")
+        assert res.status_code == 200
+
+        assert f"<h4>Traceroute ID {t.id}".encode() in res.data
+        assert t.to_json().encode() in res.data
+        assert t.to_text().encode() in res.data
+
+        for hop in t.hops:
+            for host in hop.hosts:
+                assert f'id="h_{host.id}_ip"'.encode() in res.data
+
+    res = client.get(f"/status?id={t.id}")
+    assert res.json == {"status": "enriched"}
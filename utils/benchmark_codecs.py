@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""Compare the encoding/decoding speed and the size of the messages
+exchanged over RabbitMQ using the available codecs.
+
+The legacy path (to_json_dict/from_dict with the standard json
+module, as used before codecs were introduced) is measured too,
+as a baseline.
+
+Usage:
+
+  ./utils/benchmark_codecs.py [--min-time 0.5] [--json results.json] \
+      [--compare previous_results.json]
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+import ipaddress
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from rich_traceroute.enrichers.codecs import CODECS, Codec
+from rich_traceroute.structures import (
+    EnricherJob,
+    EnricherJob_Host,
+    IPDBInfo,
+    IXPNetwork
+)
+from rich_traceroute.traceroute import record_uid
+
+
+def _job(hosts: int) -> EnricherJob:
+    return EnricherJob(
+        traceroute_id=record_uid(),
+        hosts=[
+            EnricherJob_Host(n + 1, record_uid(), f"10.0.{n // 256}.{n % 256}")
+            for n in range(hosts)
+        ]
+    )
+
+
+def _ip_infos(n: int) -> List[IPDBInfo]:
+    res = []
+
+    for i in range(n):
+        if i % 10 == 0:
+            res.append(IPDBInfo(
+                prefix=ipaddress.ip_network(f"2001:db8:{i:x}::/64"),
+                origins=None,
+                ixp_network=IXPNetwork(
+                    "Peering LAN", f"IX{i}", f"Internet Exchange n. {i}"
+                )
+            ))
+        else:
+            res.append(IPDBInfo(
+                prefix=ipaddress.ip_network(f"10.{i // 256}.{i % 256}.0/24"),
+                origins=[(65500 + i, f"AS{65500 + i} - Example Network {i}")],
+                ixp_network=None
+            ))
+
+    return res
+
+
+Target = Tuple[str, Callable[[], bytes], Callable[[bytes], object]]
+
+
+def _legacy_targets(job: EnricherJob, ip_infos: List[IPDBInfo]) -> List[Target]:
+    # Before codecs: one message per IP info.
+    return [
+        (
+            "job",
+            lambda: json.dumps(job.to_json_dict()).encode(),
+            lambda body: EnricherJob.from_dict(json.loads(body))
+        ),
+        (
+            "ip_info (single)",
+            lambda: json.dumps(ip_infos[0].to_json_dict()).encode(),
+            lambda body: IPDBInfo.from_dict(json.loads(body))
+        ),
+    ]
+
+
+def _codec_targets(codec: Codec, job: EnricherJob, ip_infos: List[IPDBInfo]) -> List[Target]:
+    return [
+        (
+            "job",
+            lambda: codec.encode_job(job),
+            codec.decode_job
+        ),
+        (
+            "ip_info (single)",
+            lambda: codec.join_ip_infos([codec.encode_ip_info(ip_infos[0])]),
+            codec.decode_ip_infos
+        ),
+        (
+            f"ip_info (batch of {len(ip_infos)})",
+            lambda: codec.join_ip_infos([
+                codec.encode_ip_info(ip_info) for ip_info in ip_infos
+            ]),
+            codec.decode_ip_infos
+        ),
+    ]
+
+
+def get_targets(hosts: int, batch_size: int) -> List[Tuple[str, List[Target]]]:
+    job = _job(hosts)
+    ip_infos = _ip_infos(batch_size)
+
+    res = [("legacy json", _legacy_targets(job, ip_infos))]
+
+    for codec in CODECS.values():
+        res.append((codec.NAME, _codec_targets(codec, job, ip_infos)))
+
+    return res
+
+
+def measure(function: Callable, min_time: float) -> dict:
+    runs = 0
+    start = time.perf_counter()
+
+    while True:
+        function()
+        runs += 1
+
+        elapsed = time.perf_counter() - start
+
+        if elapsed >= min_time:
+            break
+
+    return {
+        "runs": runs,
+        "ops_per_sec": round(runs / elapsed, 2),
+        "mean_us": round(1000000 * elapsed / runs, 2)
+    }
+
+
+def _get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except:  # noqa: E722
+        return None
+
+
+def _load_previous_results(path: str) -> Dict[Tuple[str, str, str], dict]:
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    return {
+        (r["codec"], r["message"], r["operation"]): r
+        for r in data["results"]
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Benchmark of the codecs of the RabbitMQ messages"
+    )
+    arg_parser.add_argument(
+        "--min-time", type=float, default=0.5,
+        help="Min time (seconds) spent running each operation."
+    )
+    arg_parser.add_argument(
+        "--hosts", type=int, default=30,
+        help="N. of hosts of the job."
+    )
+    arg_parser.add_argument(
+        "--batch-size", type=int, default=500,
+        help="N. of entries of the IP info batch."
+    )
+    arg_parser.add_argument(
+        "--json", default=None, dest="json_path",
+        help="Write the results in JSON format to this file."
+    )
+    arg_parser.add_argument(
+        "--compare", default=None,
+        help="JSON file produced by a previous run, to compare results with."
+    )
+
+    args = arg_parser.parse_args()
+
+    previous_results = {}
+    if args.compare:
+        previous_results = _load_previous_results(args.compare)
+
+    results = []
+
+    for codec_name, targets in get_targets(args.hosts, args.batch_size):
+        print(codec_name)
+        print("=" * len(codec_name))
+
+        for message_name, encode, decode in targets:
+            body = encode()
+
+            for operation, function in (
+                ("encode", encode),
+                ("decode", lambda: decode(body))
+            ):
+                res = measure(function, args.min_time)
+
+                line = "{message:<26} {operation:<7} {size:>8} B {ops:>12.2f} ops/s {mean:>10.2f} us".format(
+                    message=message_name,
+                    operation=operation,
+                    size=len(body),
+                    ops=res["ops_per_sec"],
+                    mean=res["mean_us"]
+                )
+
+                previous = previous_results.get((codec_name, message_name, operation))
+                if previous and previous["ops_per_sec"]:
+                    delta = 100 * (res["ops_per_sec"] / previous["ops_per_sec"] - 1)
+                    line += f" {delta:+7.1f}%"
+
+                print(line)
+
+                results.append({
+                    "codec": codec_name,
+                    "message": message_name,
+                    "operation": operation,
+                    "size": len(body),
+                    **res
+                })
+
+        print("")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(
+                {
+                    "commit": _get_git_commit(),
+                    "python": platform.python_version(),
+                    "timestamp": time.time(),
+                    "min_time": args.min_time,
+                    "results": results
+                },
+                f,
+                indent=2
+            )
+
+        print(f"Results saved to {args.json_path}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
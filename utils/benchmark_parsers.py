@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""Measure the throughput of the traceroute parsers.
+
+Every parser class from 'parsers' and the parse_raw_traceroute
+dispatcher (with and without sniffing) are timed against all the
+files in tests/data/traceroute and against some synthetic inputs
+(long traceroutes, ECMP hops with many hosts, inputs as big as the
+max length of Traceroute.raw).
+
+Usage:
+
+  ./utils/benchmark_parsers.py [--min-time 0.5] [--filter linux] \
+      [--json results.json] [--compare previous_results.json]
+
+The --json output can be used later on with --compare, to spot
+regressions introduced by a change.
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from rich_traceroute.errors import ParserError
+from rich_traceroute.traceroute import Traceroute
+from rich_traceroute.traceroute.parsers import parsers, parse_raw_traceroute
+
+
+TEST_FILES_DIR = "tests/data/traceroute"
+
+RAW_MAX_LENGTH = Traceroute.raw.max_length
+
+
+def _ip(hop_n: int, host_n: int) -> str:
+    return "10.{}.{}.{}".format(
+        (hop_n // 256) % 256, hop_n % 256, host_n + 1
+    )
+
+
+def _linux_traceroute(hops: int, hosts_per_hop: int = 1) -> str:
+    lines = [
+        f"traceroute to 192.0.2.1 (192.0.2.1), {hops} hops max, 60 byte packets"
+    ]
+
+    for hop_n in range(1, hops + 1):
+        line = f"{hop_n:>3}"
+
+        for host_n in range(hosts_per_hop):
+            ip = _ip(hop_n, host_n)
+            line += f"  {ip} ({ip})  1.{hop_n % 1000:03} ms  2.{host_n % 1000:03} ms"
+
+        lines.append(line)
+
+    return "\n".join(lines) + "\n"
+
+
+def _mtr_report(hops: int, hosts_per_hop: int = 1) -> str:
+    lines = [
+        "Start: 2021-02-07T13:51:06+0100",
+        "HOST: localhost                   Loss%   Snt   Last   Avg  Best  Wrst StDev"
+    ]
+
+    for hop_n in range(1, hops + 1):
+        lines.append(
+            f"{hop_n:>3}.|-- {_ip(hop_n, 0):<24}   0.0%    10    3.7   3.4   2.9   3.7   0.3"
+        )
+
+        for host_n in range(1, hosts_per_hop):
+            lines.append(
+                f"        {_ip(hop_n, host_n)}"
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+def _mtr_json(hops: int) -> str:
+    return json.dumps(
+        {
+            "report": {
+                "mtr": {
+                    "src": "localhost",
+                    "dst": "192.0.2.1"
+                },
+                "hubs": [
+                    {
+                        "count": hop_n,
+                        "host": _ip(hop_n, 0),
+                        "Loss%": 0.0,
+                        "Snt": 10,
+                        "Last": 3.7,
+                        "Avg": 3.4,
+                        "Best": 2.9,
+                        "Wrst": 3.7,
+                        "StDev": 0.3
+                    }
+                    for hop_n in range(1, hops + 1)
+                ]
+            }
+        },
+        indent=2
+    )
+
+
+def _max_length_input(build: Callable[[int], str]) -> str:
+    # Largest n. of hops for which the text produced by 'build'
+    # still fits into the max length of Traceroute.raw.
+    low, high = 1, 2
+
+    while len(build(high)) <= RAW_MAX_LENGTH:
+        low, high = high, high * 2
+
+    while high - low > 1:
+        middle = (low + high) // 2
+
+        if len(build(middle)) <= RAW_MAX_LENGTH:
+            low = middle
+        else:
+            high = middle
+
+    return build(low)
+
+
+def get_inputs() -> List[Tuple[str, str]]:
+    """Return the (name, raw text) of all the inputs used for the benchmark."""
+
+    res = []
+
+    for path in sorted(glob.glob(os.path.join(TEST_FILES_DIR, "*"))):
+        if not os.path.isfile(path):
+            continue
+
+        with open(path, "r") as f:
+            res.append((os.path.basename(path), f.read()))
+
+    for hops in (30, 64, 255):
+        res.append((f"synthetic_linux_{hops}_hops", _linux_traceroute(hops)))
+        res.append((f"synthetic_mtr_{hops}_hops", _mtr_report(hops)))
+        res.append((f"synthetic_mtr_json_{hops}_hops", _mtr_json(hops)))
+
+    res.append(("synthetic_linux_ecmp_30x8", _linux_traceroute(30, 8)))
+    res.append(("synthetic_mtr_ecmp_30x8", _mtr_report(30, 8)))
+    res.append(("synthetic_mtr_ecmp_30x32", _mtr_report(30, 32)))
+
+    res.append(("synthetic_linux_max_length", _max_length_input(_linux_traceroute)))
+    res.append(("synthetic_mtr_max_length", _max_length_input(_mtr_report)))
+    res.append(("synthetic_mtr_json_max_length", _max_length_input(_mtr_json)))
+
+    return res
+
+
+def get_targets() -> List[Tuple[str, Callable[[str], bool]]]:
+    """Return the (name, function) of all the parsing routines to be timed.
+
+    Each function returns True if the input was successfully parsed.
+    """
+
+    def _build_parser_target(parser_class):
+
+        def _run(raw: str) -> bool:
+            try:
+                parser_class(raw).parse()
+            except ParserError:
+                return False
+            except:  # noqa: E722
+                # Unhandled exceptions are logged and then
+                # ignored by parse_raw_traceroute as well.
+                return False
+            return True
+
+        return _run
+
+    res = [
+        (parser_class.__name__, _build_parser_target(parser_class))
+        for parser_class in parsers
+    ]
+
+    res.append((
+        "parse_raw_traceroute",
+        lambda raw: parse_raw_traceroute(raw) is not None
+    ))
+    res.append((
+        "parse_raw_traceroute(sniff=False)",
+        lambda raw: parse_raw_traceroute(raw, sniff=False) is not None
+    ))
+
+    return res
+
+
+def measure(function: Callable[[str], bool], raw: str, min_time: float) -> dict:
+    # Memory peak: measured on a dedicated run, since tracemalloc
+    # would slow down the timing runs otherwise.
+    tracemalloc.start()
+    parsed = function(raw)
+    _, mem_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    runs = 0
+    start = time.perf_counter()
+
+    while True:
+        function(raw)
+        runs += 1
+
+        elapsed = time.perf_counter() - start
+
+        if elapsed >= min_time:
+            break
+
+    return {
+        "parsed": parsed,
+        "runs": runs,
+        "ops_per_sec": round(runs / elapsed, 2),
+        "mean_ms": round(1000 * elapsed / runs, 4),
+        "mem_peak_bytes": mem_peak
+    }
+
+
+def _get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except:  # noqa: E722
+        return None
+
+
+def _load_previous_results(path: str) -> Dict[Tuple[str, str], dict]:
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    return {
+        (r["input"], r["target"]): r
+        for r in data["results"]
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Benchmark of the traceroute parsers"
+    )
+    arg_parser.add_argument(
+        "--min-time", type=float, default=0.5,
+        help="Min time (seconds) spent running each parser on each input."
+    )
+    arg_parser.add_argument(
+        "--filter", default=None,
+        help="Only use the inputs whose name contains this string."
+    )
+    arg_parser.add_argument(
+        "--json", default=None, dest="json_path",
+        help="Write the results in JSON format to this file."
+    )
+    arg_parser.add_argument(
+        "--compare", default=None,
+        help="JSON file produced by a previous run, to compare results with."
+    )
+
+    args = arg_parser.parse_args()
+
+    previous_results = {}
+    if args.compare:
+        previous_results = _load_previous_results(args.compare)
+
+    results = []
+
+    for input_name, raw in get_inputs():
+        if args.filter and args.filter not in input_name:
+            continue
+
+        print(f"{input_name} ({len(raw)} chars)")
+        print("=" * len(f"{input_name} ({len(raw)} chars)"))
+
+        for target_name, function in get_targets():
+            res = measure(function, raw, args.min_time)
+
+            line = "{target:<36} {parsed:<6} {ops:>12.2f} ops/s {mean:>10.4f} ms {mem:>10} B".format(
+                target=target_name,
+                parsed="ok" if res["parsed"] else "-",
+                ops=res["ops_per_sec"],
+                mean=res["mean_ms"],
+                mem=res["mem_peak_bytes"]
+            )
+
+            previous = previous_results.get((input_name, target_name))
+            if previous and previous["ops_per_sec"]:
+                delta = 100 * (res["ops_per_sec"] / previous["ops_per_sec"] - 1)
+                line += f" {delta:+7.1f}%"
+
+            print(line)
+
+            results.append({
+                "input": input_name,
+                "input_length": len(raw),
+                "target": target_name,
+                **res
+            })
+
+        print("")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(
+                {
+                    "commit": _get_git_commit(),
+                    "python": platform.python_version(),
+                    "timestamp": time.time(),
+                    "min_time": args.min_time,
+                    "results": results
+                },
+                f,
+                indent=2
+            )
+
+        print(f"Results saved to {args.json_path}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())